@@ -0,0 +1,65 @@
+import gzip
+import json
+import time
+
+import requests_mock
+import zstandard
+from fastapi.testclient import TestClient
+
+from prometheus_mirror.mirror import app
+
+# Bytes on the wire and CPU cost of compressing a large RawMetricTelemetryResponse (10k points, the /api/metric
+# response for a week of 1 minute samples), per encoding and level. Run with `pdm run bench`.
+
+URL = "http://bench:9090"
+POINTS = 10_000
+RUNS = 20
+BODY = {
+    "connectionDetails": {"url": URL},
+    "query": {
+        "conditions": [{"key": "__gauge__", "value": {"value": "up", "_type": "StringValue"}}],
+        "startTime": 1_555_408_501_000,
+        "endTime": 1_555_408_501_000 + POINTS * 60_000,
+        "limit": POINTS,
+    },
+}
+
+
+def encoders():
+    for level in (1, 6, 9):
+        yield f"gzip {level}", lambda data, level=level: gzip.compress(data, level), gzip.decompress
+    for level in (1, 3, 9):
+        yield (
+            f"zstd {level}",
+            lambda data, level=level: zstandard.ZstdCompressor(level=level).compress(data),
+            zstandard.ZstdDecompressor().decompress,
+        )
+
+
+def timed(function, data) -> float:
+    started = time.perf_counter()
+    for _ in range(RUNS):
+        function(data)
+    return (time.perf_counter() - started) / RUNS * 1000
+
+
+def main():
+    values = [[1_555_408_501 + i * 60, str(round(100 + (i % 97) * 1.37, 2))] for i in range(POINTS)]
+    with requests_mock.Mocker(real_http=False) as m:
+        m.register_uri("GET", f"{URL}/api/v1/query_range", json={"data": {"result": [{"values": values}]}})
+        client = TestClient(app)
+        payload = client.post("/api/metric", json=BODY, headers={"Accept-Encoding": "identity"}).content
+        print(f"{'identity':8} {len(payload):9} bytes")
+        for name, compress, decompress in encoders():
+            compressed = compress(payload)
+            print(
+                f"{name:8} {len(compressed):9} bytes  ratio {len(payload) / len(compressed):5.1f}  "
+                f"compress {timed(compress, payload):6.2f} ms  decompress {timed(decompress, compressed):5.2f} ms"
+            )
+        for accept_encoding in ("gzip", "zstd"):
+            response = client.post("/api/metric", json=BODY, headers={"Accept-Encoding": accept_encoding})
+            print(f"served with Accept-Encoding {accept_encoding}: {response.num_bytes_downloaded} bytes on the wire")
+
+
+if __name__ == "__main__":
+    main()
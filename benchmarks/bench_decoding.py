@@ -0,0 +1,49 @@
+import copy
+import json
+import timeit
+
+from prometheus_mirror.decoding import decode_mirror_request
+from prometheus_mirror.model import MirrorRequest
+
+# Decoding of a typical /api/metric body: pydantic validation of MirrorRequest versus decode_mirror_request.
+# Run with `pdm run bench`.
+
+BODY = json.dumps(
+    {
+        "connectionDetails": {
+            "url": "https://aps-workspaces.eu-west-1.amazonaws.com/workspaces/ws-1234/",
+            "request_timeout_seconds": 30,
+            "aws": {"role_arn": "arn:aws:iam::123456789012:role/mirror", "external_id": "stackstate"},
+            "cache": {"label_ttl_seconds": 60, "query_ttl_seconds": 30},
+        },
+        "requestTimeout": 15000,
+        "query": {
+            "conditions": [
+                {"key": "__gauge__", "value": {"value": "up", "_type": "StringValue"}, "_type": "EqualityCondition"},
+                {"key": "job", "value": {"value": "api", "_type": "StringValue"}, "_type": "EqualityCondition"},
+                {"key": "instance", "value": {"value": ["a", "b"], "_type": "InSetValue"}, "_type": "InCondition"},
+            ],
+            "aggregation": {"method": "MEAN", "bucketSizeMillis": 60000, "_type": "Aggregation"},
+            "startTime": 1555408501000,
+            "endTime": 1555408711000,
+            "metricField": "double",
+            "_type": "MetricsQuery",
+        },
+        "_type": "MetricsRequest",
+    }
+)
+
+
+def main(number: int = 20000):
+    body = json.loads(BODY)
+    candidates = {
+        "MirrorRequest.parse_obj": lambda: MirrorRequest.parse_obj(copy.copy(body)),
+        "decode_mirror_request": lambda: decode_mirror_request(copy.copy(body)),
+    }
+    for name, decode in candidates.items():
+        best = min(timeit.repeat(decode, number=number, repeat=5))
+        print(f"{name:26} {best / number * 1e6:8.1f} µs/request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import json
+import multiprocessing
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, Timer
+
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import StreamEnded
+
+from prometheus_mirror.model import (
+    AdmissionControlDetails,
+    Condition,
+    ConditionValue,
+    ConnectionDetails,
+    Http2Details,
+)
+from prometheus_mirror.prometheus import PrometheusClient
+
+# Concurrent query_range calls of one worker against a local Prometheus stub that answers after LATENCY seconds, over
+# HTTP/1.1 keep-alive and over HTTP/2. The stubs run in their own process, as Prometheus would, and count the
+# connections they accept. Needs the http2 extra. Run with `pdm run bench`.
+
+LATENCY = 0.02
+CONCURRENCY = 32
+CALLS = 640
+BODY = json.dumps(
+    {
+        "status": "success",
+        "data": {"result": [{"metric": {}, "values": [[1_555_408_501 + i * 30, "1"] for i in range(100)]}]},
+    }
+).encode()
+CONDITIONS = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+
+
+class Http1Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections.value += 1
+
+    def do_GET(self):
+        time.sleep(LATENCY)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class H2Stub:
+    def __init__(self, connections):
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.connections = connections
+
+    def serve_forever(self):
+        while True:
+            sock, _ = self.server.accept()
+            self.connections.value += 1
+            Thread(target=self._serve, args=(sock,), daemon=True).start()
+
+    def _serve(self, sock):
+        connection = H2Connection(H2Configuration(client_side=False))
+        send_lock = Lock()
+        connection.initiate_connection()
+        sock.sendall(connection.data_to_send())
+        while data := sock.recv(65535):
+            with send_lock:
+                for event in connection.receive_data(data):
+                    if isinstance(event, StreamEnded):
+                        Timer(LATENCY, self._respond, args=(sock, connection, send_lock, event.stream_id)).start()
+                sock.sendall(connection.data_to_send())
+
+    def _respond(self, sock, connection, send_lock, stream_id):
+        with send_lock:
+            headers = [(":status", "200"), ("content-type", "application/json"), ("content-length", str(len(BODY)))]
+            connection.send_headers(stream_id, headers)
+            for start in range(0, len(BODY), connection.max_outbound_frame_size):
+                end = start + connection.max_outbound_frame_size
+                connection.send_data(stream_id, BODY[start:end], end_stream=end >= len(BODY))
+            sock.sendall(connection.data_to_send())
+
+
+def run(name: str, config: ConnectionDetails, connections):
+    def call(_):
+        started = time.perf_counter()
+        PrometheusClient(config).get_series_values_in_range(CONDITIONS, 0, 3000)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+        latencies = sorted(pool.map(call, range(CALLS)))
+    seconds = time.perf_counter() - started
+    print(
+        f"{name:8} {CALLS / seconds:7.0f} calls/s  p50 {latencies[len(latencies) // 2] * 1000:6.1f} ms  "
+        f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:6.1f} ms  connections {connections()}"
+    )
+
+
+def serve(http2: bool, ports, connections):
+    if http2:
+        server = H2Stub(connections)
+        ports.put(server.port)
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Http1Handler)
+        server.connections = connections
+        ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_stub(http2: bool):
+    ports, connections = multiprocessing.Queue(), multiprocessing.Value("i", 0)
+    process = multiprocessing.Process(target=serve, args=(http2, ports, connections), daemon=True)
+    process.start()
+    return process, f"http://127.0.0.1:{ports.get()}", connections
+
+
+def main():
+    admission = AdmissionControlDetails(max_concurrent_requests=CONCURRENCY, max_queued_requests=CALLS)
+    for name, http2 in (("http/1.1", None), ("http/2", Http2Details(max_connections=2, prior_knowledge=True))):
+        process, url, connections = start_stub(http2 is not None)
+        run(name, ConnectionDetails(url=url, admission=admission, http2=http2), lambda: connections.value)
+        process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+
+import requests_mock
+
+from prometheus_mirror.decoding import decode_mirror_request
+from prometheus_mirror.metric_request import MetricRequest
+from prometheus_mirror.offload import MODE_INLINE, MODE_PROCESS, MODE_THREAD, Offloader
+
+# Head-of-line blocking under mixed traffic: latency of small /api/metric requests while large responses (about
+# 100k points) are decoded and converted by the same worker, once per offload mode. Run with `pdm run bench`.
+
+URL = "http://bench:9090"
+BIG_POINTS = 100_000
+SMALL_REQUESTS = 100
+
+
+def body(metric: str):
+    return {
+        "connectionDetails": {"url": URL},
+        "query": {
+            "conditions": [{"key": "__gauge__", "value": {"value": metric, "_type": "StringValue"}}],
+            "startTime": 1_555_408_501_000,
+            "endTime": 1_655_408_501_000,
+            "limit": BIG_POINTS,
+        },
+    }
+
+
+def matrix(count: int) -> str:
+    values = ",".join(f'[{1_555_408_501 + i * 30},"{i * 0.5}"]' for i in range(count))
+    return '{"status":"success","data":{"resultType":"matrix","result":[{"metric":{},"values":[' + values + "]}]}}"
+
+
+RESPONSES = {"big": matrix(BIG_POINTS), "small": matrix(20)}
+
+
+def upstream(request, context):
+    return RESPONSES[request.qs["query"][0].split("{")[0]]
+
+
+def run(mode: str):
+    Offloader.INSTANCE = Offloader(mode, 1024 * 1024, 2)
+    stop = Event()
+
+    def big_traffic():
+        while not stop.is_set():
+            MetricRequest(decode_mirror_request(body("big"))).fetch_metric()
+
+    # two large requests in flight, as the AnyIO thread pool would run them next to the small ones
+    threads = [Thread(target=big_traffic) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+    latencies = []
+    with ThreadPoolExecutor(max_workers=4) as small:
+
+        def small_request():
+            started = time.perf_counter()
+            MetricRequest(decode_mirror_request(body("small"))).fetch_metric()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+        for future in [small.submit(small_request) for _ in range(SMALL_REQUESTS)]:
+            future.result()
+    stop.set()
+    for thread in threads:
+        thread.join()
+    Offloader.INSTANCE.shutdown()
+    latencies.sort()
+    p50 = statistics.median(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{mode:8} small request latency p50 {p50:7.1f} ms  p99 {p99:7.1f} ms")
+
+
+def main():
+    with requests_mock.Mocker(real_http=False) as m:
+        m.register_uri("GET", f"{URL}/api/v1/query_range", text=upstream)
+        for mode in (MODE_INLINE, MODE_THREAD, MODE_PROCESS):
+            run(mode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import timeit
+
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+
+from prometheus_mirror.sigv4 import SigV4Signer
+
+# Cost of signing one AMP query_range call: botocore's AWSRequest and SigV4Auth, as the mirror used to sign, against
+# the mirror's signer with its cached signing key. Run with `pdm run bench`.
+
+CREDENTIALS = Credentials("AKIDEXAMPLE", "wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY", "session-token")
+URL = "https://aps-workspaces.eu-west-1.amazonaws.com/workspaces/ws-1/api/v1/query_range"
+PARAMS = {"query": 'sum(rate(http_requests_total{job="api"}[5m]))', "start": 1697112000, "end": 1697115600, "step": 60}
+RUNS = 20000
+
+
+def botocore_sign():
+    request = AWSRequest(method="GET", url=URL, params=PARAMS)
+    SigV4Auth(CREDENTIALS, "aps", "eu-west-1").add_auth(request)
+    return dict(request.headers)
+
+
+signer = SigV4Signer(CREDENTIALS, "eu-west-1", "aps")
+
+
+def cached_sign():
+    return signer.sign("GET", URL, params=PARAMS)
+
+
+def main():
+    for name, sign in (("botocore", botocore_sign), ("signer", cached_sign)):
+        seconds = min(timeit.repeat(sign, number=RUNS, repeat=3))
+        print(f"{name:8} {seconds / RUNS * 1e6:6.1f} µs per request")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import os
+import statistics
+import subprocess
+import sys
+
+# Worker boot cost: time and memory to import the mirror in a fresh interpreter, as every uvicorn worker does, with
+# and without the AWS stack loaded. Run with `pdm run bench`.
+
+RUNS = 10
+
+MEASURE = """
+import resource, sys, time
+started = time.perf_counter()
+{preload}
+import prometheus_mirror.mirror
+print(time.perf_counter() - started, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 'boto3' in sys.modules)
+"""
+
+
+def measure(preload: str):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    seconds, memory = [], []
+    for _ in range(RUNS):
+        output = subprocess.run(
+            [sys.executable, "-c", MEASURE.format(preload=preload)], capture_output=True, text=True, check=True, env=env
+        ).stdout.split()
+        seconds.append(float(output[0]) * 1000)
+        memory.append(int(output[1]) / 1024)
+    return statistics.median(seconds), statistics.median(memory), output[2] == "True"
+
+
+def main():
+    for name, preload in (("lazy", ""), ("with aws", "import boto3, botocore.auth, botocore.awsrequest")):
+        millis, megabytes, aws = measure(preload)
+        print(f"{name:8} import {millis:6.1f} ms  max rss {megabytes:6.1f} MiB  aws stack loaded: {aws}")
+
+
+if __name__ == "__main__":
+    main()
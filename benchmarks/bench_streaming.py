@@ -0,0 +1,69 @@
+import asyncio
+import tracemalloc
+
+import requests_mock
+
+from prometheus_mirror.decoding import decode_mirror_request
+from prometheus_mirror.metric_request import MetricRequest
+from prometheus_mirror.model import MetricsResponse
+
+# Peak memory of one raw /api/metric request over long ranges of 30s samples, building the whole MetricsResponse
+# against streaming it one day at a time. Run with `pdm run bench`.
+
+URL = "http://bench:9090"
+DAY = 24 * 3600
+START = 1_555_200_000
+
+
+def query_range(request, context):
+    start, end, step = (int(request.qs[name][0]) for name in ("start", "end", "step"))
+    values = ",".join(f'[{t},"{t % 1000 / 4}"]' for t in range(start, end + 1, step))
+    return '{"status":"success","data":{"result":[{"metric":{},"values":[' + values + "]}]}}"
+
+
+def body(days: int, streaming: bool):
+    connection_details = {"url": URL}
+    if streaming:
+        connection_details["streaming"] = {"min_range_seconds": DAY, "chunk_seconds": DAY}
+    return {
+        "connectionDetails": connection_details,
+        "query": {
+            "conditions": [{"key": "__gauge__", "value": {"value": "up", "_type": "StringValue"}}],
+            "startTime": START * 1000,
+            "endTime": (START + days * DAY) * 1000,
+            "limit": 10_000_000,
+        },
+    }
+
+
+async def consume(response) -> int:
+    size = 0
+    async for chunk in response.body_iterator:
+        size += len(chunk)
+    return size
+
+
+def measure(days: int, streaming: bool):
+    tracemalloc.start()
+    response = MetricRequest(decode_mirror_request(body(days, streaming))).fetch_metric()
+    if isinstance(response, MetricsResponse):
+        size = len(response.json(by_alias=True))
+    else:
+        size = asyncio.run(consume(response))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size, peak
+
+
+def main():
+    with requests_mock.Mocker(real_http=False) as m:
+        m.register_uri("GET", f"{URL}/api/v1/query_range", text=query_range)
+        for days in (7, 30, 90):
+            for streaming in (False, True):
+                size, peak = measure(days, streaming)
+                name = "streamed" if streaming else "in memory"
+                print(f"{days:3} days {name:9} response {size / 2**20:6.1f} MiB  peak {peak / 2**20:7.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
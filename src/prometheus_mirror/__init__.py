@@ -0,0 +1,4 @@
+import time
+
+# start of the worker's imports, see startup.Startup
+IMPORT_STARTED = time.perf_counter()
@@ -0,0 +1,108 @@
+import logging
+from contextlib import contextmanager
+from threading import BoundedSemaphore, Lock
+from typing import Dict, Iterator
+
+from prometheus_mirror.model import AdmissionControlDetails, ConnectionDetails
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+
+class AdmissionRejectedException(Exception):
+    def __init__(self, datasource: str, reason: str):  # pylint: disable=super-init-not-called
+        self.datasource = datasource
+        self.reason = reason
+
+    def __str__(self):
+        return f"Datasource {self.datasource} is overloaded: {self.reason}"
+
+
+class Bulkhead:
+    # Limits concurrent upstream calls per datasource, so one slow datasource cannot hold every worker thread.
+    # Callers without a slot wait in a bounded queue and are rejected straight away when that queue is full.
+    INSTANCES: Dict[str, "Bulkhead"] = {}
+
+    def __init__(self, name: str, config: AdmissionControlDetails):
+        self.name = name
+        self.config = config
+        self._slots = BoundedSemaphore(config.max_concurrent_requests)
+        self._lock = Lock()
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    @staticmethod
+    def get_instance(config: ConnectionDetails) -> "Bulkhead":
+        bulkhead = Bulkhead.INSTANCES.get(config.url, None)
+        if bulkhead is None or bulkhead.config != config.admission:
+            with lock:
+                bulkhead = Bulkhead.INSTANCES.get(config.url, None)
+                if bulkhead is None or bulkhead.config != config.admission:
+                    # first call or user changed the limits
+                    bulkhead = Bulkhead(config.url, config.admission.copy())
+                    Bulkhead.INSTANCES[config.url] = bulkhead
+        return bulkhead
+
+    @staticmethod
+    def stats() -> Dict[str, Dict[str, int]]:
+        return {name: bulkhead.snapshot() for name, bulkhead in list(Bulkhead.INSTANCES.items())}
+
+    @contextmanager
+    def admit(self) -> Iterator[None]:
+        self._acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def try_acquire(self) -> bool:
+        # a slot only if one is free right away, for optional calls such as hedges that should not queue
+        with self._lock:
+            if not self._slots.acquire(blocking=False):
+                return False
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._slots.release()
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "active": self.active,
+                "queued": self.queued,
+                "admitted": self.admitted,
+                "rejected_queue_full": self.rejected_queue_full,
+                "rejected_timeout": self.rejected_timeout,
+            }
+
+    def _acquire(self):
+        with self._lock:
+            if self._slots.acquire(blocking=False):
+                self.active += 1
+                self.admitted += 1
+                return
+            if self.queued >= self.config.max_queued_requests:
+                self.rejected_queue_full += 1
+                logger.warning(f"Rejecting request for {self.name}: wait queue full ({self.queued} waiting).")
+                raise AdmissionRejectedException(self.name, f"{self.queued} requests already waiting")
+            self.queued += 1
+
+        acquired = self._slots.acquire(timeout=self.config.queue_timeout_seconds)
+        with self._lock:
+            self.queued -= 1
+            if not acquired:
+                self.rejected_timeout += 1
+                logger.warning(f"Rejecting request for {self.name}: no slot within queue timeout.")
+                raise AdmissionRejectedException(
+                    self.name, f"no free slot within {self.config.queue_timeout_seconds} seconds"
+                )
+            self.active += 1
+            self.admitted += 1
@@ -0,0 +1,176 @@
+import math
+from bisect import bisect_left, bisect_right
+from concurrent.futures import Future
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# Evaluates the PromQL expressions PrometheusQuery generates for aggregated requests on raw samples fetched once, so
+# that mean, percentiles, min, max, ... of one stream cost a single upstream read. Semantics follow Prometheus 2.x
+# (and Amazon Managed Service for Prometheus): closed range selector windows, a 5 minute lookback for instant values
+# and extrapolated `increase`.
+
+LOOKBACK_MILLIS = 5 * 60 * 1000
+SUBQUERY_STEP_MILLIS = 60 * 1000  # PrometheusQuery.default_discretion_interval_seconds
+
+QUANTILES = {
+    "percentile_25": 0.25,
+    "percentile_50": 0.50,
+    "percentile_75": 0.75,
+    "percentile_90": 0.90,
+    "percentile_95": 0.95,
+    "percentile_98": 0.98,
+    "percentile_99": 0.99,
+}
+METHODS = {"mean", "max", "min", "sum", "event_count", *QUANTILES}
+
+
+class RawSeries:
+    def __init__(self, labels: Dict[str, str], samples: Sequence[Tuple[int, float]]):
+        self.labels = labels
+        self.timestamps = [timestamp for timestamp, _ in samples]
+        self.values = [value for _, value in samples]
+        # reset corrected running value, turns `increase` over any window into a difference of two entries
+        self.corrected: List[float] = []
+        offset = 0.0
+        previous = None
+        for value in self.values:
+            if previous is not None and value < previous:
+                offset += previous
+            self.corrected.append(value + offset)
+            previous = value
+
+    def window(self, start: int, end: int) -> Tuple[int, int]:
+        # indices of the samples with start <= timestamp <= end
+        return bisect_left(self.timestamps, start), bisect_right(self.timestamps, end)
+
+    def instant(self, timestamp: int) -> Optional[float]:
+        index = bisect_right(self.timestamps, timestamp) - 1
+        if index < 0 or self.timestamps[index] < timestamp - LOOKBACK_MILLIS:
+            return None
+        return self.values[index]
+
+    def increase(self, start: int, end: int) -> Optional[float]:
+        first, last = self.window(start, end)
+        count = last - first
+        if count < 2:
+            return None
+        last -= 1
+        result = self.corrected[last] - self.corrected[first]
+        first_value = self.values[first]
+        duration_to_start = (self.timestamps[first] - start) / 1000.0
+        duration_to_end = (end - self.timestamps[last]) / 1000.0
+        sampled_interval = (self.timestamps[last] - self.timestamps[first]) / 1000.0
+        average_interval = sampled_interval / (count - 1)
+        if result > 0 and first_value >= 0:
+            # a counter does not extrapolate below zero
+            duration_to_start = min(duration_to_start, sampled_interval * (first_value / result))
+        threshold = average_interval * 1.1
+        interval = sampled_interval
+        interval += duration_to_start if duration_to_start < threshold else average_interval / 2
+        interval += duration_to_end if duration_to_end < threshold else average_interval / 2
+        return result * (interval / sampled_interval)
+
+
+def evaluate(
+    series: Sequence[RawSeries], request_type: str, method: str, start: int, end: int, step: int, window: int
+) -> List[List[Any]]:
+    # Same points as query_range(to_prometheus(), start, end, step); timestamps in seconds, like the Prometheus API.
+    if len(series) == 0:
+        return []
+    points = []
+    window_millis = window * 1000
+    for timestamp in range(start, end + 1, step):
+        now = timestamp * 1000
+        value: Optional[float]
+        if request_type == "__counter__":
+            # <method>_over_time(increase(selector[window])[window:60s])
+            first = -(-(now - window_millis) // SUBQUERY_STEP_MILLIS) * SUBQUERY_STEP_MILLIS
+            increases = [
+                increase
+                for at in range(first, now + 1, SUBQUERY_STEP_MILLIS)
+                if (increase := series[0].increase(at - window_millis, at)) is not None
+            ]
+            value = _over_time(method, increases)
+        elif method == "event_count":
+            # count_over_time(selector[window])
+            first, last = series[0].window(now - window_millis, now)
+            value = float(last - first) if last > first else None
+        else:
+            # avg, quantile, max, min and sum aggregate over all series matching the selector
+            instants = [instant for serie in series if (instant := serie.instant(now)) is not None]
+            value = _over_time(method, instants)
+        if value is not None:
+            points.append([timestamp, value])
+    return points
+
+
+def _over_time(method: str, values: List[float]) -> Optional[float]:
+    if not values:
+        return None
+    if method == "mean":
+        return sum(values) / len(values)
+    if method == "sum":
+        return float(sum(values))
+    if method == "event_count":
+        return float(len(values))
+    if method == "max":
+        return _extreme(values, lambda value, current: value > current)
+    if method == "min":
+        return _extreme(values, lambda value, current: value < current)
+    return _quantile(QUANTILES[method], values)
+
+
+def _extreme(values: List[float], better: Callable[[float, float], bool]) -> float:
+    # NaN only wins when there is nothing else, as in Prometheus
+    result = values[0]
+    for value in values[1:]:
+        if better(value, result) or math.isnan(result):
+            result = value
+    return result
+
+
+def _quantile(q: float, values: List[float]) -> float:
+    ordered = sorted(values)
+    rank = q * (len(ordered) - 1)
+    lower = max(0, math.floor(rank))
+    upper = min(len(ordered) - 1, lower + 1)
+    weight = rank - math.floor(rank)
+    return ordered[lower] * (1 - weight) + ordered[upper] * weight
+
+
+class SingleFlight:
+    # Concurrent requests for the same raw samples wait for the one upstream call already in flight.
+    def __init__(self):
+        self._lock = Lock()
+        self._calls: Dict[str, Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key: str, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            future = self._calls.get(key, None)
+            leader = future is None
+            if future is None:
+                future = self._calls[key] = Future()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return future.result()
+        try:
+            result = compute()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {"raw_fetches": self.calls, "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+
+single_flight = SingleFlight()
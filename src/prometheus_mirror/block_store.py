@@ -0,0 +1,264 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from bisect import bisect_left
+from operator import itemgetter
+from threading import Lock
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from prometheus_mirror.model import Settings
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+MAGIC = b"PMB1"
+PREAMBLE = struct.Struct("<4sI")
+EVICTION_CHECK_INTERVAL = 50
+# Prometheus rejects range queries of more evaluations per series
+MAX_POINTS_PER_QUERY = 11_000
+
+Series = Dict[str, Any]
+
+
+class BlockStore:
+    # Persistent store of query_range results for time ranges that no longer change. A block holds the evaluations
+    # of one (connection, query, step) at `block_points` step-aligned timestamps. Each block is one file:
+    #   magic | header length | JSON header (series labels, offsets) | int64 timestamps | float64 values
+    # The sample columns are read through a memory map, so only the blocks a request touches are paged in.
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, mode=0o700, exist_ok=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"path": self.root, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def query_range(
+        self,
+        namespace: str,
+        query: str,
+        start: int,
+        end: int,
+        step: int,
+        block_points: int,
+        immutable_before: int,
+        fetch: Callable[[int, int], List[Series]],
+    ) -> List[Series]:
+        # Blocks not stored yet are fetched with one upstream query per run of consecutive blocks, together with the
+        # recent tail when the run reaches it, in runs of at most MAX_POINTS_PER_QUERY evaluations.
+        span = step * block_points
+        first_eval = -(-start // step) * step
+        directory = self._directory(namespace, query, step, block_points)
+        max_run = max(MAX_POINTS_PER_QUERY // block_points, 1)
+        merged: Dict[Tuple, Series] = {}
+        run: List[int] = []
+        block_start = first_eval - first_eval % span
+        while block_start <= end and block_start + span <= immutable_before:
+            series = self._read(os.path.join(directory, f"{block_start}.blk"))
+            if series is None:
+                run.append(block_start)
+                if len(run) == max_run:
+                    self._fetch_run(merged, directory, run, step, block_points, start, end, None, fetch)
+                    run = []
+            else:
+                with self._lock:
+                    self.hits += 1
+                if run:
+                    self._fetch_run(merged, directory, run, step, block_points, start, end, None, fetch)
+                    run = []
+                for serie in series:
+                    self._merge(merged, serie, start, end)
+            block_start += span
+        # recent part of the range, still subject to change
+        tail_start = max(block_start, first_eval) if block_start <= end else None
+        if run:
+            with_tail = tail_start is not None and (end - run[0]) // step < MAX_POINTS_PER_QUERY
+            self._fetch_run(
+                merged, directory, run, step, block_points, start, end, tail_start if with_tail else None, fetch
+            )
+            if with_tail:
+                tail_start = None
+        if tail_start is not None:
+            for serie in fetch(tail_start, end):
+                self._merge(merged, serie, start, end)
+        return list(merged.values())
+
+    def _directory(self, namespace: str, query: str, step: int, block_points: int) -> str:
+        key = hashlib.sha256(f"{namespace}\n{query}\n{step}\n{block_points}".encode()).hexdigest()
+        return os.path.join(self.root, key[:2], key)
+
+    def _fetch_run(
+        self,
+        merged: Dict[Tuple, Series],
+        directory: str,
+        run: List[int],
+        step: int,
+        block_points: int,
+        start: int,
+        end: int,
+        tail_start: Optional[int],
+        fetch: Callable[[int, int], List[Series]],
+    ):
+        # one upstream query for consecutive blocks, and the tail after them up to `end` when `tail_start` is given;
+        # the result is split into the blocks, which are stored, and merged into the result of the request
+        span = step * block_points
+        run_end = run[-1] + span
+        with self._lock:
+            self.misses += len(run)
+        fetched = fetch(run[0], end if tail_start is not None else run_end - step)
+        stored = [
+            {"metric": serie.get("metric", {}), "values": [[int(t), float(v)] for t, v in serie["values"]]}
+            for serie in fetched
+        ]
+        for block_start in run:
+            block = []
+            for serie in stored:
+                values = serie["values"]
+                # samples are ordered by timestamp
+                first = bisect_left(values, block_start, key=itemgetter(0))
+                last = bisect_left(values, block_start + span, lo=first, key=itemgetter(0))
+                if last > first:
+                    block.append({"metric": serie["metric"], "values": values[first:last]})
+            self._write(os.path.join(directory, f"{block_start}.blk"), block)
+        for serie, raw in zip(stored, fetched):
+            self._merge(merged, {"metric": serie["metric"], "values": serie["values"]}, start, min(end, run_end - 1))
+            if tail_start is not None:
+                # the tail is returned as Prometheus sent it, like tails fetched on their own
+                self._merge(merged, raw, max(start, run_end), end)
+
+    @staticmethod
+    def _merge(merged: Dict[Tuple, Series], serie: Series, start: int, end: int):
+        labels = tuple(sorted(serie.get("metric", {}).items()))
+        target = merged.setdefault(labels, {"metric": serie.get("metric", {}), "values": []})
+        target["values"].extend(value for value in serie["values"] if start <= value[0] <= end)
+
+    def _read(self, path: str) -> Optional[List[Series]]:
+        try:
+            with open(path, "rb") as file:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    series = self._decode(mapped)
+            os.utime(path)  # recently used, keeps the block away from eviction
+            return series
+        except FileNotFoundError:
+            return None
+        except (ValueError, OSError) as e:
+            logger.warning(f"Dropping unreadable block {path}: {e}")
+            self._remove(path)
+            return None
+
+    @staticmethod
+    def _decode(mapped: mmap.mmap) -> List[Series]:
+        magic, header_length = PREAMBLE.unpack_from(mapped, 0)
+        if magic != MAGIC:
+            raise ValueError("not a block file")
+        header = json.loads(mapped[PREAMBLE.size : PREAMBLE.size + header_length])
+        columns_offset = _align(PREAMBLE.size + header_length)
+        total = header["samples"]
+        view = memoryview(mapped)
+        try:
+            timestamps = view[columns_offset : columns_offset + 8 * total].cast("q")
+            values = view[columns_offset + 8 * total : columns_offset + 16 * total].cast("d")
+            series = []
+            for entry in header["series"]:
+                offset, count = entry["offset"], entry["count"]
+                series.append(
+                    {
+                        "metric": entry["metric"],
+                        "values": [[timestamps[i], values[i]] for i in range(offset, offset + count)],
+                    }
+                )
+            timestamps.release()
+            values.release()
+        finally:
+            view.release()
+        return series
+
+    def _write(self, path: str, series: List[Series]):
+        timestamps = array("q")
+        values = array("d")
+        entries = []
+        for serie in series:
+            entries.append(
+                {"metric": serie.get("metric", {}), "offset": len(timestamps), "count": len(serie["values"])}
+            )
+            for timestamp, value in serie["values"]:
+                timestamps.append(timestamp)
+                values.append(value)
+        header = json.dumps({"series": entries, "samples": len(timestamps)}).encode()
+        padding = _align(PREAMBLE.size + len(header)) - PREAMBLE.size - len(header)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                file.write(PREAMBLE.pack(MAGIC, len(header)))
+                file.write(header)
+                file.write(b"\0" * padding)
+                file.write(timestamps.tobytes())
+                file.write(values.tobytes())
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to store block {path}: {e}")
+            self._remove(temp_path)
+            return
+        with self._lock:
+            self._writes += 1
+            check = self._writes % EVICTION_CHECK_INTERVAL == 1
+        if check:
+            self._evict()
+
+    def _evict(self):
+        blocks = []
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                blocks.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in blocks)
+        for _, size, path in sorted(blocks):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _align(offset: int) -> int:
+    return -(-offset // 8) * 8
+
+
+_instance: Optional[BlockStore] = None
+
+
+def get_block_store() -> Optional[BlockStore]:
+    global _instance
+    if _instance is None:
+        with lock:
+            if _instance is None:
+                settings = Settings()
+                if settings.BLOCK_STORE_PATH:
+                    logger.info(f"Using block store {settings.BLOCK_STORE_PATH}.")
+                    _instance = BlockStore(settings.BLOCK_STORE_PATH, settings.BLOCK_STORE_MAX_BYTES)
+    return _instance
@@ -0,0 +1,180 @@
+import logging
+import zlib
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+GZIP = "gzip"
+ZSTD = "zstd"
+
+# body chunks of at least this size are compressed on the thread pool instead of the event loop; zlib and zstandard
+# release the GIL while compressing
+THREADPOOL_BYTES = 64 * 1024
+
+
+class _Encoder:
+    def __init__(self, encoding: str, level: int):
+        if encoding == GZIP:
+            self._compressor: Any = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            import zstandard
+
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+def negotiate(accept_encoding: str, supported: List[str]) -> Optional[str]:
+    # Picks the encoding with the highest quality in Accept-Encoding, ties go to the order of `supported`.
+    qualities: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, parameters = part.partition(";")
+        name = name.strip().lower()
+        quality = 1.0
+        parameter, _, value = parameters.partition("=")
+        if parameter.strip() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        if name:
+            qualities[name] = quality
+    best: Optional[Tuple[float, int]] = None
+    chosen = None
+    for rank, encoding in enumerate(supported):
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > 0 and (best is None or (quality, -rank) > best):
+            best, chosen = (quality, -rank), encoding
+    return chosen
+
+
+class CompressionMiddleware:
+    # Compresses responses of at least `minimum_size` bytes with the best encoding StackState accepts. Raw metric
+    # telemetry is a very repetitive JSON of timestamps and values, it shrinks to a fraction of its size.
+    STATS: Dict[str, Dict[str, int]] = {}
+
+    def __init__(
+        self, app: ASGIApp, encodings: List[str], minimum_size: int = 1024, gzip_level: int = 6, zstd_level: int = 3
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = {GZIP: gzip_level, ZSTD: zstd_level}
+        self.encodings = []
+        for encoding in encodings:
+            if encoding == ZSTD:
+                try:
+                    import zstandard  # noqa: F401 pylint: disable=unused-import
+                except ImportError:
+                    logger.warning("zstd compression needs the zstd extra, install aws-prometheus-mirror[zstd]")
+                    continue
+            elif encoding != GZIP:
+                raise ValueError(f"Unsupported response encoding {encoding}")
+            self.encodings.append(encoding)
+
+    @staticmethod
+    def stats() -> Dict[str, Dict[str, int]]:
+        with lock:
+            return {encoding: dict(counters) for encoding, counters in CompressionMiddleware.STATS.items()}
+
+    @staticmethod
+    def _record(encoding: str, bytes_in: int, bytes_out: int):
+        with lock:
+            counters = CompressionMiddleware.STATS.setdefault(encoding, {"responses": 0, "bytes_in": 0, "bytes_out": 0})
+            counters["responses"] += 1
+            counters["bytes_in"] += bytes_in
+            counters["bytes_out"] += bytes_out
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http" and self.encodings:
+            encoding = negotiate(Headers(scope=scope).get("Accept-Encoding", ""), self.encodings)
+            if encoding:
+                responder = _Responder(self.app, encoding, self.levels[encoding], self.minimum_size)
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class _Responder:
+    def __init__(self, app: ASGIApp, encoding: str, level: int, minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.send: Send
+        self.start_message: Optional[Message] = None
+        self.encoder: Optional[_Encoder] = None
+        self.passthrough = False
+        self.buffer = b""
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message):
+        if message["type"] == "http.response.start":
+            # held back until enough of the body is known to tell whether it is worth compressing
+            self.start_message = message
+            self.passthrough = "content-encoding" in Headers(raw=message["headers"])
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+        if self.passthrough:
+            if self.start_message is not None:
+                start_message, self.start_message = self.start_message, None
+                await self.send(start_message)
+            await self.send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start_message is not None:
+            # responses of the http middleware arrive in chunks even when they are small
+            self.buffer += body
+            if more_body and len(self.buffer) < self.minimum_size:
+                return
+            start_message, self.start_message = self.start_message, None
+            body, self.buffer = self.buffer, b""
+            if not more_body and len(body) < self.minimum_size:
+                self.passthrough = True
+                await self.send(start_message)
+                await self.send({"type": "http.response.body", "body": body, "more_body": False})
+                return
+            headers = MutableHeaders(raw=start_message["headers"])
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            self.encoder = _Encoder(self.encoding, self.level)
+            compressed = await self._compress(body, more_body)
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                headers["Content-Length"] = str(len(compressed))
+            await self.send(start_message)
+        else:
+            compressed = await self._compress(body, more_body)
+        await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+        if not more_body:
+            CompressionMiddleware._record(self.encoding, self.bytes_in, self.bytes_out)
+
+    async def _compress(self, body: bytes, more_body: bool) -> bytes:
+        assert self.encoder is not None
+        compress = self.encoder.compress if more_body else self.encoder.finish
+        if len(body) >= THREADPOOL_BYTES:
+            compressed = await run_in_threadpool(compress, body)
+        else:
+            compressed = compress(body)
+        self.bytes_in += len(body)
+        self.bytes_out += len(compressed)
+        return compressed
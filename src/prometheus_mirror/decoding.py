@@ -0,0 +1,148 @@
+import hashlib
+import json
+from threading import Lock
+from typing import Any, Dict, List, Tuple, Type, TypeVar, Union
+
+from cachetools import LRUCache
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON, ModelField, UndefinedType
+
+from prometheus_mirror.model import ConditionValue, ConnectionDetails, MirrorRequest
+
+lock = Lock()
+
+Model = TypeVar("Model", bound=BaseModel)
+
+# Validated connection details by a digest of their JSON, StackState repeats the same few datasources in every request.
+# The digest keeps AWS secrets out of the keys.
+connection_details_cache: LRUCache = LRUCache(maxsize=256)
+
+
+# Models with their own __init__ that ends up with the same values as construct() for exactly typed input:
+# ConditionValue copies `_type`, which is a required str, into type_descriptor.
+CONSTRUCTIBLE = {ConditionValue}
+
+IMMUTABLE = {type(None), str, int, bool, float}
+
+ANY = 0
+SCALAR = 1
+MODEL = 2
+
+Plan = List[Tuple[str, str, bool, int, Any, bool, Union[bool, UndefinedType], ModelField]]
+
+# per model: (name, alias, is list, kind, declared type, allow None, required, field)
+plans: Dict[type, Plan] = {}
+
+
+class _Fallback(Exception):
+    pass
+
+
+def decode_mirror_request(body: Any) -> MirrorRequest:
+    # Builds the MirrorRequest tree without running pydantic's validators when every value already has exactly the
+    # declared type, which is what StackState sends. Anything else (coercions, missing or invalid fields) goes
+    # through MirrorRequest validation, so results and validation errors are the same as with a `MirrorRequest`
+    # endpoint parameter.
+    try:
+        return _construct(MirrorRequest, body)
+    except _Fallback:
+        pass
+    try:
+        # validate() rather than parse_obj() reports non-object bodies the way FastAPI's body field does
+        return MirrorRequest.validate(body)
+    except (ValidationError, TypeError, ValueError, AssertionError) as e:
+        raise RequestValidationError([ErrorWrapper(e, ("body",))], body=body)
+
+
+def _construct(model: Type[Model], data: Any) -> Model:
+    if model is ConnectionDetails:
+        return _connection_details(data)  # type: ignore
+    if type(data) is not dict:
+        raise _Fallback()
+    plan = plans.get(model, None) or _plan(model)
+    values: Dict[str, Any] = {}
+    fields_set = set()
+    for name, alias, is_list, kind, declared, allow_none, required, field in plan:
+        if alias not in data:
+            if required:
+                raise _Fallback()
+            values[name] = field.default if type(field.default) in IMMUTABLE else field.get_default()
+            continue
+        value = data[alias]
+        if value is None:
+            if not allow_none:
+                raise _Fallback()
+        elif is_list:
+            if type(value) is not list:
+                raise _Fallback()
+            value = [_single(kind, declared, item) for item in value]
+        elif kind == SCALAR:
+            if type(value) is not declared:
+                raise _Fallback()
+        elif kind == MODEL:
+            value = _construct(declared, value)
+        values[name] = value
+        fields_set.add(name)
+    # what BaseModel.construct() does, without its per-field alias lookups
+    instance = model.__new__(model)
+    object.__setattr__(instance, "__dict__", values)
+    object.__setattr__(instance, "__fields_set__", fields_set)
+    return instance
+
+
+def _single(kind: int, declared: Any, value: Any) -> Any:
+    if kind == MODEL:
+        return _construct(declared, value)
+    if kind == SCALAR and type(value) is not declared:
+        raise _Fallback()
+    return value
+
+
+def _plan(model: Type[BaseModel]) -> Plan:
+    if model.__init__ is not BaseModel.__init__ and model not in CONSTRUCTIBLE:
+        raise _Fallback()
+    if model.__private_attributes__ or model.__pre_root_validators__ or model.__post_root_validators__:
+        raise _Fallback()
+    plan: Plan = []
+    for name, field in model.__fields__.items():
+        if field.shape not in (SHAPE_SINGLETON, SHAPE_LIST) or field.shape == SHAPE_SINGLETON and field.sub_fields:
+            raise _Fallback()  # unions, dicts, tuples, ...
+        if field.class_validators:
+            raise _Fallback()
+        declared = field.type_
+        if declared is Any:
+            kind = ANY
+        elif declared in (str, int, bool, float):
+            kind = SCALAR
+        elif isinstance(declared, type) and issubclass(declared, BaseModel):
+            kind = MODEL
+        else:
+            raise _Fallback()
+        plan.append(
+            (name, field.alias, field.shape == SHAPE_LIST, kind, declared, field.allow_none, field.required, field)
+        )
+    plans[model] = plan
+    return plan
+
+
+def _connection_details(data: Any) -> ConnectionDetails:
+    if type(data) is not dict:
+        raise _Fallback()
+    try:
+        key = hashlib.sha256(json.dumps(data, sort_keys=True).encode()).digest()
+    except (TypeError, ValueError):
+        raise _Fallback()
+    with lock:
+        cached = connection_details_cache.get(key, None)
+    if cached is not None:
+        # a copy, so that a request changing its details does not change those of the next requests
+        return cached.copy()
+    try:
+        details = ConnectionDetails.parse_obj(data)
+    except ValidationError:
+        raise _Fallback()
+    with lock:
+        connection_details_cache[key] = details
+    return details.copy()
@@ -0,0 +1,45 @@
+import math
+from typing import Any, List, Sequence
+
+# Points are `[value, timestamp]` pairs as in RawMetricTelemetryResponse.
+
+
+def lttb(points: List[List[Any]], max_points: int) -> List[List[Any]]:
+    if max_points >= len(points) or max_points < 3:
+        return points
+    selected = lttb_indices([point[0] for point in points], [point[1] for point in points], max_points)
+    return [points[index] for index in selected]
+
+
+def lttb_indices(values: Sequence[float], timestamps: Sequence[float], max_points: int) -> List[int]:
+    # Largest-Triangle-Three-Buckets (Steinarsson, 2013): keeps the first and last point and from every bucket in
+    # between the point spanning the largest triangle with the previously kept point and the next bucket's average,
+    # so peaks and dips survive the reduction. Returns the indices of the kept points, so that callers only build
+    # those.
+    count = len(values)
+    if max_points >= count or max_points < 3:
+        return list(range(count))
+    every = (count - 2) / (max_points - 2)
+    sampled = [0]
+    previous = 0
+    for bucket in range(max_points - 2):
+        bucket_start = int(bucket * every) + 1
+        next_start = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, count)
+        average_value = sum(values[next_start:next_end]) / (next_end - next_start)
+        average_timestamp = sum(timestamps[next_start:next_end]) / (next_end - next_start)
+
+        previous_value, previous_timestamp = values[previous], timestamps[previous]
+        # ±Inf values make areas infinite or NaN, a bucket without a finite area keeps its first point
+        selected, max_area = bucket_start, -1.0
+        for index in range(bucket_start, next_start):
+            area = abs(
+                (previous_timestamp - average_timestamp) * (values[index] - previous_value)
+                - (previous_timestamp - timestamps[index]) * (average_value - previous_value)
+            )
+            if area > max_area and math.isfinite(area):
+                selected, max_area = index, area
+        sampled.append(selected)
+        previous = selected
+    sampled.append(count - 1)
+    return sampled
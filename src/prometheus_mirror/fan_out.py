@@ -0,0 +1,163 @@
+import logging
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+from prometheus_mirror.model import ConnectionDetails, FanOutDetails
+from prometheus_mirror.profiler import profiler
+from prometheus_mirror.response_limits import ResponseTooLargeException
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="fan-out")
+
+FIRST_SUCCESS = "first_success"
+MERGE_ALL = "merge_all"
+MERGE_AVAILABLE = "merge_available"
+PREFER_PRIMARY = "prefer_primary"
+
+T = TypeVar("T")
+
+
+class FanOut:
+    # Sends a call to every endpoint of a datasource at once: the `url` of the datasource, the primary, followed by
+    # the `urls` of the fan_out block. merge_all merges the answers of all endpoints and fails when one of them fails,
+    # merge_available merges the answers of the endpoints that answer, first_success takes the first answer,
+    # prefer_primary asks the others only when the primary fails or is slower than fallback_after_seconds. Apart from
+    # merge_all, a call fails when no endpoint answers.
+    INSTANCES: Dict[str, "FanOut"] = {}
+
+    def __init__(self, name: str, config: FanOutDetails):
+        self.name = name
+        self.config = config
+        self.endpoints = [name] + [url if not url.endswith("/") else url[:-1] for url in config.urls]
+        self._lock = Lock()
+        self.calls = 0
+        self.answers: Dict[str, int] = defaultdict(int)
+        self.failures: Dict[str, int] = defaultdict(int)
+
+    @staticmethod
+    def get_instance(config: ConnectionDetails) -> Optional["FanOut"]:
+        if config.fan_out is None:
+            # the primary's endpoint client has the url of the datasource, its fan-out stays registered
+            return None
+        fan_out = FanOut.INSTANCES.get(config.url, None)
+        if fan_out is None or fan_out.config != config.fan_out:
+            with lock:
+                fan_out = FanOut.INSTANCES.get(config.url, None)
+                if fan_out is None or fan_out.config != config.fan_out:
+                    url = config.url if not config.url.endswith("/") else config.url[:-1]
+                    fan_out = FanOut(url, config.fan_out.copy())
+                    FanOut.INSTANCES[config.url] = fan_out
+        return fan_out
+
+    @staticmethod
+    def stats() -> Dict[str, Dict[str, Any]]:
+        return {name: fan_out.snapshot() for name, fan_out in list(FanOut.INSTANCES.items())}
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"calls": self.calls, "answers": dict(self.answers), "failures": dict(self.failures)}
+
+    def endpoint_configs(self, config: ConnectionDetails) -> List[ConnectionDetails]:
+        # the datasource's settings for each endpoint on its own
+        return [config.copy(update={"url": url, "fan_out": None}) for url in self.endpoints]
+
+    def run(self, calls: Sequence[Callable[[], T]], merge: Callable[[List[T]], T]) -> T:
+        # `calls` holds the call for every endpoint, in the order of the endpoints
+        with self._lock:
+            self.calls += 1
+        if self.config.mode == PREFER_PRIMARY:
+            primary = executor.submit(profiler.propagating(calls[0]))
+            done, _ = wait([primary], timeout=self.config.fallback_after_seconds)
+            error = primary.exception() if done else None
+            if done and error is None:
+                return self._answered(0, primary)
+            futures = {
+                executor.submit(profiler.propagating(call)): index for index, call in enumerate(calls) if index > 0
+            }
+            if error is not None:
+                self._failed(0, error)
+            else:
+                futures[primary] = 0
+            return self._first_answer(futures, error)
+
+        futures = {executor.submit(profiler.propagating(call)): index for index, call in enumerate(calls)}
+        if self.config.mode == FIRST_SUCCESS:
+            return self._first_answer(futures, None)
+
+        results: List[T] = []
+        first_error: Optional[BaseException] = None
+        for future, index in futures.items():
+            error = future.exception()
+            if isinstance(error, ResponseTooLargeException):
+                # leaving the endpoint out would merge an incomplete result
+                self._failed(index, error)
+                raise error
+            if error is not None:
+                self._failed(index, error)
+                first_error = first_error or error
+            else:
+                results.append(self._answered(index, future))
+        if first_error is not None and self.config.mode == MERGE_ALL:
+            # the merge would silently miss the series of the failed endpoint, and be cached like a complete one
+            raise first_error
+        if not results:
+            assert first_error is not None
+            raise first_error
+        return merge(results) if len(results) > 1 else results[0]
+
+    def _first_answer(self, futures: Dict["Future[T]", int], first_error: Optional[BaseException]) -> T:
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda f: futures[f]):
+                error = future.exception()
+                if error is None:
+                    return self._answered(futures[future], future)
+                self._failed(futures[future], error)
+                first_error = first_error or error
+        assert first_error is not None
+        raise first_error
+
+    def _answered(self, index: int, future: "Future[T]") -> T:
+        with self._lock:
+            self.answers[self.endpoints[index]] += 1
+        return future.result()
+
+    def _failed(self, index: int, error: BaseException):
+        logger.warning(f"Fan-out call to [{self.endpoints[index]}] failed: {error}")
+        with self._lock:
+            self.failures[self.endpoints[index]] += 1
+
+
+def merge_series(results: List[List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    # Series of the same labels are merged into one; of samples at the same timestamp the one of the earliest
+    # endpoint is kept, so HA pairs fill each other's gaps.
+    merged: Dict[FrozenSet[Tuple[str, str]], Tuple[Dict[str, str], Dict[Any, Any]]] = {}
+    for result in results:
+        for serie in result:
+            _, points = merged.setdefault(frozenset(serie["metric"].items()), (serie["metric"], {}))
+            for timestamp, value in serie["values"]:
+                points.setdefault(timestamp, value)
+    return [
+        {"metric": metric, "values": [[timestamp, points[timestamp]] for timestamp in sorted(points)]}
+        for metric, points in merged.values()
+    ]
+
+
+def merge_label_values(results: List[List[str]]) -> List[str]:
+    return sorted(set().union(*results))
@@ -0,0 +1,274 @@
+import logging
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Event, Lock
+from typing import Any, Callable, Deque, Dict, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from prometheus_mirror.admission import Bulkhead
+from prometheus_mirror.model import ConnectionDetails, HedgingDetails
+from prometheus_mirror.profiler import profiler
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+PRIMARY = "primary"
+HEDGE = "hedge"
+
+# how to interrupt the call each thread is waiting on, see `abortable`
+_in_flight: Dict[int, Callable[[], Any]] = {}
+
+
+class LatencyTracker:
+    def __init__(self, size: int):
+        self._latencies: Deque[float] = deque(maxlen=size)
+        self._lock = Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, percentile: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < max(min_samples, 1):
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100.0))
+        return ordered[index]
+
+
+class Hedger:
+    # Starts a second identical request when the first one is slower than the configured percentile of recent
+    # latencies. Every request deposits `max_hedge_fraction` tokens and every hedge withdraws one, so hedges never
+    # exceed that fraction of the traffic. A hedge also needs a free slot of the datasource's bulkhead, and a 5xx
+    # response loses the race like a failed call.
+    # The first request is sent from the caller's thread, which keeps its bulkhead slot until that request is done.
+    # Hedges run on a pool of the datasource no larger than its bulkhead; a hedge that wins interrupts the first
+    # request, so the caller answers with the hedge's response.
+    INSTANCES: Dict[str, "Hedger"] = {}
+
+    def __init__(self, name: str, config: HedgingDetails, max_workers: int = 8):
+        self.name = name
+        self.config = config
+        self.max_workers = max_workers
+        self.latencies = LatencyTracker(config.latency_window)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self._tokens = 1.0
+        self._lock = Lock()
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    @staticmethod
+    def get_instance(config: ConnectionDetails) -> Optional["Hedger"]:
+        if config.hedging is None:
+            Hedger.INSTANCES.pop(config.url, None)
+            return None
+        max_workers = config.admission.max_concurrent_requests
+        hedger = Hedger.INSTANCES.get(config.url, None)
+        if hedger is None or hedger.config != config.hedging or hedger.max_workers != max_workers:
+            with lock:
+                hedger = Hedger.INSTANCES.get(config.url, None)
+                if hedger is None or hedger.config != config.hedging or hedger.max_workers != max_workers:
+                    # first call or user changed the hedging or admission limits
+                    hedger = Hedger(config.url, config.hedging.copy(), max_workers)
+                    Hedger.INSTANCES[config.url] = hedger
+        return hedger
+
+    @staticmethod
+    def stats() -> Dict[str, Dict[str, float | int | None]]:
+        return {name: hedger.snapshot() for name, hedger in list(Hedger.INSTANCES.items())}
+
+    def snapshot(self) -> Dict[str, float | int | None]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "hedge_delay_seconds": self.hedge_delay(),
+            }
+
+    def hedge_delay(self) -> Optional[float]:
+        delay = self.latencies.percentile(self.config.percentile, self.config.min_samples)
+        return None if delay is None else max(delay, self.config.min_delay_seconds)
+
+    def call(
+        self,
+        send: Callable[[], requests.Response],
+        may_hedge: Callable[[], bool] = lambda: True,
+        bulkhead: Optional[Bulkhead] = None,
+    ) -> requests.Response:
+        with self._lock:
+            self.requests += 1
+            self._tokens = min(self.config.max_tokens, self._tokens + self.config.max_hedge_fraction)
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._timed(send)
+
+        race = _Race(threading.get_ident(), delay)
+        hedge = self._executor.submit(profiler.propagating(self._hedge), send, may_hedge, bulkhead, race)
+        try:
+            response = self._timed(send)
+        except Exception:
+            # failed, or interrupted by a hedge that won: the hedge answers when it succeeds
+            race.settled.set()
+            hedged = hedge.result()
+            if hedged is not None and _succeeded(hedged):
+                return hedged
+            if hedged is not None:
+                hedged.close()
+            raise
+        if _succeeded(response) and race.claim(PRIMARY):
+            self._discard(hedge)
+            return response
+        race.settled.set()
+        hedged = hedge.result()
+        if hedged is not None and _succeeded(hedged):
+            response.close()
+            return hedged
+        # both failed, the first request's response goes through the retries
+        if hedged is not None:
+            hedged.close()
+        return response
+
+    def _hedge(
+        self,
+        send: Callable[[], requests.Response],
+        may_hedge: Callable[[], bool],
+        bulkhead: Optional[Bulkhead],
+        race: "_Race",
+    ) -> Optional[requests.Response]:
+        # the delay counts from the call, not from when a worker picked the hedge up
+        if race.settled.wait(max(race.deadline - time.monotonic(), 0)) or not self._withdraw():
+            return None
+        # the first request holds the caller's slot, the hedge takes one of its own without queueing for it
+        admitted = bulkhead is None or bulkhead.try_acquire()
+        if not admitted or not may_hedge():
+            if admitted and bulkhead is not None:
+                bulkhead.release()
+            with self._lock:
+                self._tokens += 1
+            return None
+        with self._lock:
+            self.hedged += 1
+
+        logger.info(f"Hedging request to {self.name} after {race.delay:.3f}s.")
+        try:
+            response = self._timed(send)
+        finally:
+            if bulkhead is not None:
+                bulkhead.release()
+        if _succeeded(response) and race.claim(HEDGE):
+            with self._lock:
+                self.hedge_wins += 1
+            # the caller is still waiting for the first request
+            _abort(race.caller)
+        return response
+
+    def _withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _timed(self, send: Callable[[], requests.Response]) -> requests.Response:
+        # streamed responses (response limits, remote read) return with their headers, their latency leaves out the
+        # download of the body, which is read after the race
+        start = time.monotonic()
+        response = send()
+        self.latencies.record(time.monotonic() - start)
+        return response
+
+    @staticmethod
+    def _discard(future: "Future[Optional[requests.Response]]"):
+        # a hedge already on the wire runs on, release its connection once it completes
+        def close(done: "Future[Optional[requests.Response]]"):
+            if done.exception() is None and (response := done.result()) is not None:
+                response.close()
+
+        future.add_done_callback(close)
+
+
+class _Race:
+    # between the first request on the caller's thread and its hedge, the first successful response wins
+    def __init__(self, caller: int, delay: float):
+        self.caller = caller
+        self.delay = delay
+        self.deadline = time.monotonic() + delay
+        # set once the first request is done, a hedge that has not started yet no longer starts
+        self.settled = Event()
+        self._lock = Lock()
+        self._winner: Optional[str] = None
+
+    def claim(self, attempt: str) -> bool:
+        with self._lock:
+            if self._winner is None:
+                self._winner = attempt
+            won = self._winner == attempt
+        self.settled.set()
+        return won
+
+
+def _succeeded(response: requests.Response) -> bool:
+    return response.status_code < 500
+
+
+@contextmanager
+def abortable(abort: Callable[[], Any]) -> Iterator[None]:
+    # Transports wrap the wait for a response in this, with a function interrupting that wait from another thread.
+    # A hedge that wins uses it to stop the caller's first request, which then fails with a connection error.
+    ident = threading.get_ident()
+    _in_flight[ident] = abort
+    try:
+        yield
+    finally:
+        _in_flight.pop(ident, None)
+
+
+def _abort(ident: int):
+    abort = _in_flight.get(ident)
+    if abort is None:
+        return
+    try:
+        abort()
+    except Exception as e:  # pylint: disable=broad-except
+        logger.debug(f"Interrupting a request failed: {e}")
+
+
+def _shutdown(connection: Any):
+    # shuts the socket down under the thread blocked on it, the socket itself is closed by that thread; the plain
+    # socket method, as SSLSocket.shutdown drops the TLS state the blocked read still uses
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+
+
+class _AbortableHTTPConnectionPool(HTTPConnectionPool):
+    def _make_request(self, conn: Any, *args: Any, **kwargs: Any) -> Any:
+        with abortable(lambda: _shutdown(conn)):
+            return super()._make_request(conn, *args, **kwargs)
+
+
+class _AbortableHTTPSConnectionPool(HTTPSConnectionPool):
+    def _make_request(self, conn: Any, *args: Any, **kwargs: Any) -> Any:
+        with abortable(lambda: _shutdown(conn)):
+            return super()._make_request(conn, *args, **kwargs)
+
+
+class AbortableHTTPAdapter(HTTPAdapter):
+    # HTTP/1.1 transport whose calls can be interrupted by a hedge while they wait for the response headers
+    def init_poolmanager(self, *args: Any, **kwargs: Any):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _AbortableHTTPConnectionPool,
+            "https": _AbortableHTTPSConnectionPool,
+        }
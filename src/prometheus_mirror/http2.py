@@ -0,0 +1,204 @@
+import asyncio
+from concurrent.futures import CancelledError
+from threading import Lock, Thread
+from typing import Any, Awaitable, Iterator, Optional, TypeVar
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from prometheus_mirror.hedging import abortable
+from prometheus_mirror.model import Http2Details
+
+T = TypeVar("T")
+
+
+class Http2UnavailableException(Exception):
+    def __str__(self):
+        return "HTTP/2 needs the http2 extra, install aws-prometheus-mirror[http2]"
+
+
+class Http2Adapter(BaseAdapter):
+    # requests transport adapter that sends over HTTP/2 with httpx, so concurrent calls of the worker share a few
+    # multiplexed connections. Mounted on the datasource's pooled session, signing, retries, hedging and response
+    # handling stay the same as over HTTP/1.1.
+    # The connections are driven by httpx's async client on an event loop thread of the adapter: the sync client
+    # opens streams from several threads without a lock, which breaks HTTP/2's ordering of stream ids.
+    def __init__(self, config: Http2Details):
+        super().__init__()
+        try:
+            import h2  # noqa: F401 pylint: disable=unused-import
+            import httpx
+        except ImportError:
+            raise Http2UnavailableException()
+        self._httpx = httpx
+        limits = httpx.Limits(max_connections=config.max_connections, max_keepalive_connections=config.max_connections)
+        # no client timeout, as with requests the call waits as long as the server takes
+        self._client = httpx.AsyncClient(http1=not config.prior_knowledge, http2=True, limits=limits, timeout=None)
+        self._loop = asyncio.new_event_loop()
+        Thread(target=_run_until_stopped, args=(self._loop,), name="http2", daemon=True).start()
+        # calls whose response is not fully read yet, the loop is only stopped once there are none
+        self._lock = Lock()
+        self._active = 0
+        self._closing = False
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        timeout: Any = None,
+        verify: Any = True,
+        cert: Any = None,
+        proxies: Any = None,
+    ) -> requests.Response:
+        httpx = self._httpx
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        # the mirror sends bytes or str bodies and str headers
+        headers: Any = dict(request.headers)
+        body: Any = request.body
+        upstream_request = self._client.build_request(
+            request.method or "GET", request.url or "", headers=headers, content=body, timeout=httpx.Timeout(timeout)
+        )
+        with self._lock:
+            if self._closing:
+                raise requests.exceptions.ConnectionError("HTTP/2 adapter is closed", request=request)
+            self._active += 1
+        try:
+            # a hedge that won cancels the wait for the response
+            call = asyncio.run_coroutine_threadsafe(self._send(upstream_request, stream), self._loop)
+            with abortable(call.cancel):
+                upstream = call.result()
+        except CancelledError:
+            self._release()
+            raise requests.exceptions.ConnectionError("Request interrupted by a hedge", request=request)
+        except httpx.TimeoutException as e:
+            self._release()
+            raise requests.exceptions.Timeout(e, request=request)
+        except httpx.TransportError as e:
+            self._release()
+            raise requests.exceptions.ConnectionError(e, request=request)
+        except BaseException:
+            self._release()
+            raise
+        if not stream:
+            self._release()
+
+        response = requests.Response()
+        response.status_code = upstream.status_code
+        response.headers = CaseInsensitiveDict(upstream.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.reason = upstream.reason_phrase
+        response.url = request.url or ""
+        response.raw = _RawBody(self, upstream)
+        response.request = request
+        return response
+
+    async def _send(self, upstream_request: Any, stream: bool) -> Any:
+        upstream = await self._client.send(upstream_request, stream=True)
+        if not stream:
+            # one trip to the event loop for the whole call
+            try:
+                await upstream.aread()
+            finally:
+                await upstream.aclose()
+        return upstream
+
+    def run(self, awaitable: Awaitable[T]) -> T:
+        async def call() -> T:
+            return await awaitable
+
+        return asyncio.run_coroutine_threadsafe(call(), self._loop).result()
+
+    def close(self):
+        # the session can be closed while other threads still read responses through it, the connections and the
+        # loop are shut down after the last of them
+        with self._lock:
+            self._closing = True
+            idle = self._active == 0
+        if idle:
+            self._shutdown()
+
+    def _release(self):
+        with self._lock:
+            self._active -= 1
+            idle = self._closing and self._active == 0
+        if idle:
+            self._shutdown()
+
+    def _shutdown(self):
+        async def shutdown():
+            try:
+                await self._client.aclose()
+            finally:
+                self._loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop)
+
+    def __del__(self):
+        # a replaced session is dropped rather than closed, its loop thread stops with it
+        if not getattr(self, "_closing", True) and self._loop.is_running():
+            self._closing = True
+            self._shutdown()
+
+
+def _run_until_stopped(loop: asyncio.AbstractEventLoop):
+    # not a method, the thread must not keep the adapter alive
+    loop.run_forever()
+    loop.close()
+
+
+class _RawBody:
+    # the part of urllib3's HTTPResponse that requests reads bodies through; httpx has already undone any
+    # content encoding
+    def __init__(self, adapter: Http2Adapter, upstream: Any):
+        self._adapter = adapter
+        self._upstream = upstream
+        self._chunks: Optional[Iterator[bytes]] = None
+        self._buffer = b""
+        self._closed = False
+        # responses read on the event loop already were released by the adapter
+        self._upstream_streamed = not upstream.is_stream_consumed
+
+    def stream(self, chunk_size: int = 65536, decode_content: bool = True) -> Iterator[bytes]:
+        if self._upstream.is_stream_consumed:
+            yield from self._upstream.iter_bytes(chunk_size)
+            return
+        chunks = self._upstream.aiter_bytes(chunk_size)
+        try:
+            while True:
+                try:
+                    yield self._adapter.run(chunks.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.close()
+
+    def read(self, amount: Optional[int] = None, **kwargs: Any) -> bytes:
+        if self._chunks is None:
+            self._chunks = self.stream()
+        while amount is None or len(self._buffer) < amount:
+            chunk = next(self._chunks, b"")
+            if not chunk:
+                break
+            self._buffer += chunk
+        if amount is None:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:amount], self._buffer[amount:]
+        return data
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if not self._upstream.is_closed:
+                self._adapter.run(self._upstream.aclose())
+        finally:
+            if self._upstream_streamed:
+                self._adapter._release()
+
+    def release_conn(self):
+        self.close()
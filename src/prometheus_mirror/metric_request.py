@@ -1,9 +1,15 @@
+import json
 import logging
-from typing import Any, Optional, Sequence, Tuple
+import math
+import sys
+from bisect import bisect_right
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
 
 from fastapi.encoders import jsonable_encoder
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
 
+from prometheus_mirror.admission import AdmissionRejectedException
+from prometheus_mirror.downsampling import lttb, lttb_indices
 from prometheus_mirror.model import (
     AggregatedMetricTelemetryResponse,
     MetricsNotFoundError,
@@ -13,6 +19,7 @@ from prometheus_mirror.model import (
     RawMetricTelemetryResponse,
     RemoteMirrorError,
 )
+from prometheus_mirror.offload import POINT_BYTES, Offloader
 from prometheus_mirror.prometheus import (
     NAN_AS_ZERO,
     InvalidPrometheusDataException,
@@ -22,6 +29,8 @@ from prometheus_mirror.prometheus import (
     RequiredFieldException,
     TooManyMetricsException,
 )
+from prometheus_mirror.response_limits import ResponseTooLargeException
+from prometheus_mirror.samples import SampleBlock
 
 logger = logging.getLogger(__name__)
 
@@ -30,7 +39,7 @@ class MetricRequest:
     def __init__(self, request: MirrorRequest):
         self.request = request
 
-    def fetch_metric(self) -> MetricsResponse | JSONResponse:
+    def fetch_metric(self) -> MetricsResponse | JSONResponse | StreamingResponse:
         query = self.request.query
         try:
             start_timestamp = int(query.start_time / 1000)
@@ -48,6 +57,23 @@ class MetricRequest:
             limit = query.limit
             client = PrometheusClient.get_instance(self.request.connection_details)
             nan_interpretation = client.nan_interpretation
+            downsampling = self.request.connection_details.downsampling
+            streaming = self.request.connection_details.streaming
+            if (
+                streaming
+                and not aggregation
+                and not downsampling
+                and end_timestamp - start_timestamp >= streaming.min_range_seconds
+            ):
+                chunks = client.iter_series_values_in_range(
+                    query.conditions, start_timestamp, end_timestamp, window_seconds, limit, streaming.chunk_seconds
+                )
+                # the first chunk is fetched before anything is sent, so its errors get the usual error responses
+                first_chunk = next(chunks)
+                return StreamingResponse(
+                    MetricRequest._stream_raw_points(end_timestamp_millis, nan_interpretation, first_chunk, chunks),
+                    media_type="application/json",
+                )
             result = client.get_series_values_in_range(
                 query.conditions,
                 start_timestamp,
@@ -56,8 +82,15 @@ class MetricRequest:
                 window_seconds,
                 limit,
             )
-            metrics_response = self._make_metric_response(
-                query, window, end_timestamp_millis, result, nan_interpretation
+            metrics_response = Offloader.get_instance().run(
+                len(result) * POINT_BYTES,
+                MetricRequest._make_metric_response,
+                query,
+                window,
+                end_timestamp_millis,
+                result,
+                nan_interpretation,
+                downsampling.max_points if downsampling else None,
             )
             return metrics_response
         except InvalidPrometheusDataException as e:
@@ -70,6 +103,10 @@ class MetricRequest:
             return self.error_response(self.generic_error("Too many metrics.", f"{e}"))
         except PrometheusException as e:
             return self.error_response(self.generic_error("Prometheus error.", f"{e}"))
+        except AdmissionRejectedException as e:
+            return self.error_response(self.generic_error("Too many requests.", f"{e}"), status_code=503)
+        except ResponseTooLargeException as e:
+            return self.error_response(self.generic_error("Prometheus response too large.", f"{e}"))
         except Exception as e:  # pylint: disable=broad-except
             return self.error_response(self.generic_error("Unexpected error.", f"{e}"))
 
@@ -78,34 +115,113 @@ class MetricRequest:
         query: Query,
         window: int,
         end_timestamp_millis: int,
-        result: Sequence[Tuple[int, float]],
+        result: Sequence[Tuple[int, float]] | SampleBlock,
         nan_interpretation: str,
+        max_points: Optional[int] = None,
     ) -> MetricsResponse:
         if query.aggregation:
+            values = result.decode() if isinstance(result, SampleBlock) else result
             return MetricRequest._make_agg_metric_response(
-                end_timestamp_millis, nan_interpretation, result, int(window)
+                end_timestamp_millis, nan_interpretation, values, int(window)
             )
         else:
-            return MetricRequest._make_raw_metric_response(end_timestamp_millis, nan_interpretation, result)
+            return MetricRequest._make_raw_metric_response(end_timestamp_millis, nan_interpretation, result, max_points)
 
     @staticmethod
-    def _make_raw_metric_response(end_timestamp_millis, nan_interpretation, result):
-        points = []
-        for value in result:
-            timestamp = value[0] * 1000
-            value_str = value[1]
-            if timestamp <= end_timestamp_millis:
-                if str(value_str).lower() == "nan":
-                    if nan_interpretation == NAN_AS_ZERO:
-                        points.append([0.0, timestamp])
-                    else:
-                        logger.error(f"Skipping NaN value for timestampt: {value_str}.")
-                else:
-                    points.append([float(value_str), timestamp])
+    def _make_raw_metric_response(end_timestamp_millis, nan_interpretation, result, max_points=None):
+        if isinstance(result, SampleBlock):
+            points = MetricRequest._block_points(end_timestamp_millis, nan_interpretation, result, max_points)
+        else:
+            if max_points and len(result) > max_points:
+                result = MetricRequest._downsample(end_timestamp_millis, nan_interpretation, result, max_points)
+            points = MetricRequest._raw_points(end_timestamp_millis, nan_interpretation, result)
         response = MetricsResponse()
         response.telemetry = RawMetricTelemetryResponse(points=points)
         return response
 
+    @staticmethod
+    def _downsample(end_timestamp_millis, nan_interpretation, result, max_points) -> List[Any]:
+        # LTTB over the samples as Prometheus returned them, only the kept samples are turned into points. NaN
+        # samples are zeroed or dropped first, so they never end up in a bucket.
+        samples, values, timestamps = [], [], []
+        for sample in result:
+            timestamp = round(sample[0] * 1000)
+            if timestamp > end_timestamp_millis:
+                continue
+            value = float(sample[1])
+            if math.isnan(value):
+                if nan_interpretation != NAN_AS_ZERO:
+                    logger.error(f"Skipping NaN value for timestampt: {sample[1]}.")
+                    continue
+                value = 0.0
+            samples.append(sample)
+            values.append(value)
+            timestamps.append(timestamp)
+        return [samples[index] for index in lttb_indices(values, timestamps, max_points)]
+
+    @staticmethod
+    def _raw_points(end_timestamp_millis, nan_interpretation, result) -> List[List[Any]]:
+        points: List[List[Any]] = []
+        for value in result:
+            timestamp = round(value[0] * 1000)  # remote read timestamps can be fractional seconds
+            if timestamp <= end_timestamp_millis:
+                MetricRequest._append_point(points, float(value[1]), timestamp, nan_interpretation)
+        return points
+
+    @staticmethod
+    def _block_points(end_timestamp_millis, nan_interpretation, block: SampleBlock, max_points) -> List[List[Any]]:
+        # the points of a cached block straight from its columns, without `[seconds, value]` lists in between
+        timestamps, values = block.columns()
+        count = bisect_right(timestamps, end_timestamp_millis)
+        if count < len(timestamps):
+            del timestamps[count:]
+            del values[count:]
+        if all(map(math.isfinite, values)):
+            if max_points and count > max_points:
+                return [[values[index], timestamps[index]] for index in lttb_indices(values, timestamps, max_points)]
+            return [[value, timestamp] for value, timestamp in zip(values, timestamps)]
+        points: List[List[Any]] = []
+        for value, timestamp in zip(values, timestamps):
+            MetricRequest._append_point(points, value, timestamp, nan_interpretation)
+        # NaN samples are zeroed or dropped first, so they never end up in a bucket
+        return lttb(points, max_points) if max_points else points
+
+    @staticmethod
+    def _append_point(points: List[List[Any]], value: float, timestamp: int, nan_interpretation: str):
+        if math.isnan(value):
+            if nan_interpretation == NAN_AS_ZERO:
+                points.append([0.0, timestamp])
+            else:
+                logger.error(f"Skipping NaN value for timestampt: {value}.")
+        elif math.isinf(value):
+            # JSON has no infinities, they become the largest finite values of their sign
+            points.append([math.copysign(sys.float_info.max, value), timestamp])
+        else:
+            points.append([value, timestamp])
+
+    @staticmethod
+    def _stream_raw_points(
+        end_timestamp_millis: int, nan_interpretation: str, first_chunk: List[Any], chunks: Iterator[List[Any]]
+    ) -> Iterator[bytes]:
+        # Writes the same JSON as a MetricsResponse with raw telemetry, with `isPartial` after the points: a failure
+        # after the first chunk can no longer change the status code, it ends the points and marks them partial.
+        yield b'{"_type":"MetricsResponse","telemetry":{"_type":"RawMetricTelemetry","points":['
+        is_partial = False
+        separator = b""
+        chunk: Optional[List[Any]] = first_chunk
+        while chunk is not None:
+            points = MetricRequest._raw_points(end_timestamp_millis, nan_interpretation, chunk)
+            if points:
+                yield separator + json.dumps(points, separators=(",", ":"), allow_nan=False)[1:-1].encode()
+                separator = b","
+            try:
+                chunk = next(chunks, None)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"Streaming stopped after a partial response: {e}")
+                is_partial = True
+                chunk = None
+        yield b'],"dataFormat":["value","timestamp"],"isPartial":' + (b"true" if is_partial else b"false") + b"}}"
+
     @staticmethod
     def _make_agg_metric_response(end_timestamp_millis, nan_interpretation, result, window):
         points = []
@@ -134,6 +250,6 @@ class MetricRequest:
         return MetricsNotFoundError(metric=metric, details=details)
 
     @staticmethod
-    def error_response(error: Any) -> JSONResponse:
+    def error_response(error: Any, status_code: int = 500) -> JSONResponse:
         logger.error(f"Request error: {error}")
-        return JSONResponse(status_code=500, content=jsonable_encoder(error))
+        return JSONResponse(status_code=status_code, content=jsonable_encoder(error))
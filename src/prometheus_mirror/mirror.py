@@ -1,13 +1,21 @@
+import hmac
 import logging
 import traceback
-from typing import List
+from typing import Any, List, Optional
 
 import uvicorn
-from fastapi import FastAPI, Request
+from fastapi import Body, FastAPI, Query, Request
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+from prometheus_mirror.admission import AdmissionRejectedException, Bulkhead
+from prometheus_mirror.aggregation import single_flight
+from prometheus_mirror.block_store import get_block_store
+from prometheus_mirror.compression import CompressionMiddleware
+from prometheus_mirror.decoding import decode_mirror_request
+from prometheus_mirror.fan_out import FanOut
+from prometheus_mirror.hedging import Hedger
 from prometheus_mirror.metric_request import MetricRequest
 from prometheus_mirror.model import (
     FieldDescriptor,
@@ -20,7 +28,17 @@ from prometheus_mirror.model import (
     TestConnectionResponse,
     ValueDescriptor,
 )
+from prometheus_mirror.negative_cache import negative_cache
+from prometheus_mirror.offload import Offloader
+from prometheus_mirror.prefetch import Prefetcher
+from prometheus_mirror.profiler import ProfilerBusyException, format_collapsed, profiler
 from prometheus_mirror.prometheus import PrometheusClient
+from prometheus_mirror.recording_rules import RecordingRules
+from prometheus_mirror.response_limits import ResponseLimits
+from prometheus_mirror.scheduler import StandingQueryScheduler
+from prometheus_mirror.shared_cache import get_cache
+from prometheus_mirror.startup import Startup
+from prometheus_mirror.throttling import Throttle
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.StreamHandler())
@@ -28,6 +46,12 @@ logger.setLevel(logging.INFO)
 
 settings = Settings()
 app = FastAPI()
+Startup.get_instance().imported()
+
+
+@app.on_event("startup")
+def prewarm():
+    Startup.get_instance().prewarm(settings.PREWARM_CONNECTIONS)
 
 
 @app.exception_handler(RequestValidationError)
@@ -43,6 +67,22 @@ async def validation_exception_handler(request, exc):
     )
 
 
+@app.exception_handler(AdmissionRejectedException)
+async def admission_rejected_handler(request, exc):
+    return JSONResponse(
+        status_code=503,
+        content=jsonable_encoder(RemoteMirrorError(summary="Too many requests.", details=str(exc))),
+    )
+
+
+@app.exception_handler(ProfilerBusyException)
+async def profiler_busy_handler(request, exc):
+    return JSONResponse(
+        status_code=409,
+        content=jsonable_encoder(RemoteMirrorError(summary="Profiler busy.", details=str(exc))),
+    )
+
+
 @app.middleware("http")
 async def handle_uncaught_exceptions(request: Request, call_next):
     try:
@@ -62,6 +102,16 @@ async def handle_uncaught_exceptions(request: Request, call_next):
     return response
 
 
+# added last so it is the outermost middleware and compresses the final response
+app.add_middleware(
+    CompressionMiddleware,
+    encodings=settings.COMPRESSION_ENCODINGS,
+    minimum_size=settings.COMPRESSION_MIN_BYTES,
+    gzip_level=settings.COMPRESSION_GZIP_LEVEL,
+    zstd_level=settings.COMPRESSION_ZSTD_LEVEL,
+)
+
+
 @app.get("/")
 async def root():
     return {"app": "StackState Prometheus Mirror"}
@@ -72,10 +122,52 @@ async def healthcheck():
     return {"app": "StackState Prometheus Mirror", "status": "OK"}
 
 
+@app.get("/stats")
+async def stats():
+    return {
+        "admission": Bulkhead.stats(),
+        "throttling": Throttle.stats(),
+        "hedging": Hedger.stats(),
+        "cache": get_cache().snapshot(),
+        "block_store": block_store.snapshot() if (block_store := get_block_store()) else None,
+        "standing_queries": StandingQueryScheduler.get_instance().stats(),
+        "local_aggregation": single_flight.snapshot(),
+        "negative_cache": negative_cache.snapshot(),
+        "offload": Offloader.get_instance().stats(),
+        "startup": Startup.get_instance().stats(),
+        "compression": CompressionMiddleware.stats(),
+        "recording_rules": RecordingRules.stats(),
+        "fan_out": FanOut.stats(),
+        "response_limits": ResponseLimits.stats(),
+        "prefetch": Prefetcher.stats(),
+        "profiler": profiler.snapshot(),
+    }
+
+
+@app.get("/admin/profile")
+def profile(
+    request: Request,
+    seconds: float = Query(10, gt=0, le=60),
+    interval_ms: float = Query(10, ge=1, le=1000),
+    route: Optional[str] = None,
+    datasource: Optional[str] = None,
+    idle: bool = False,
+):
+    # samples the stacks of this worker for `seconds`, of the requests to `route` or `datasource` when given
+    token = request.headers.get("X-MIRROR-ADMIN-TOKEN", "")
+    if settings.ADMIN_TOKEN is None or not hmac.compare_digest(token.encode(), settings.ADMIN_TOKEN.encode()):
+        details = "Admin endpoints are disabled." if settings.ADMIN_TOKEN is None else "Invalid admin token."
+        error = RemoteMirrorError(summary="Unauthorized.", details=details)  # type: ignore
+        return JSONResponse(status_code=401, content=jsonable_encoder(error))
+    stacks = profiler.profile(seconds, interval_ms / 1000, route, datasource.rstrip("/") if datasource else None, idle)
+    return PlainTextResponse(format_collapsed(stacks))
+
+
 @app.post("/api/connection")
-async def check_connection(request: TestConnectionRequest):
-    client = PrometheusClient.get_instance(request.connection_details, check_connection=True)
-    status_code, details = client.test_connection()
+def check_connection(request: TestConnectionRequest):
+    with profiler.tagged(route="/api/connection", datasource=request.connection_details.url.rstrip("/")):
+        client = PrometheusClient.get_instance(request.connection_details, check_connection=True)
+        status_code, details = client.test_connection()
     if status_code == 200:
         return TestConnectionResponse()
     else:
@@ -86,12 +178,20 @@ async def check_connection(request: TestConnectionRequest):
 
 
 @app.post("/api/metric")
-async def fetch_metric(request: MirrorRequest):
-    return MetricRequest(request).fetch_metric()
+def fetch_metric(body: Any = Body(...)):
+    with profiler.tagged(route="/api/metric"):
+        request = decode_mirror_request(body)
+        with profiler.tagged(datasource=request.connection_details.url.rstrip("/")):
+            return MetricRequest(request).fetch_metric()
 
 
 @app.post("/api/field/value")
-async def fetch_field_value(request: MirrorRequest):
+def fetch_field_value(request: MirrorRequest):
+    with profiler.tagged(route="/api/field/value", datasource=request.connection_details.url.rstrip("/")):
+        return _fetch_field_value(request)
+
+
+def _fetch_field_value(request: MirrorRequest):
     query = request.query
     client = PrometheusClient.get_instance(request.connection_details)
     if not query.field:  # done because of mypy and the optional type
@@ -108,7 +208,12 @@ async def fetch_field_value(request: MirrorRequest):
 
 
 @app.post("/api/field/name")
-async def fetch_field_name(request: MirrorRequest):
+def fetch_field_name(request: MirrorRequest):
+    with profiler.tagged(route="/api/field/name", datasource=request.connection_details.url.rstrip("/")):
+        return _fetch_field_name(request)
+
+
+def _fetch_field_name(request: MirrorRequest):
     field_response = FieldNameResponse()
     field_names = ["__counter__", "__gauge__", "~"]
     client = PrometheusClient.get_instance(request.connection_details)
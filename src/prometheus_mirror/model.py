@@ -14,11 +14,133 @@ class AwsConnectionDetails(BaseModel):
     role_session_name: str = Field(default="StackState-Prometheus-Mirror")
 
 
+class AdmissionControlDetails(BaseModel):
+    max_concurrent_requests: int = Field(default=8, ge=1)
+    max_queued_requests: int = Field(default=16, ge=0)
+    queue_timeout_seconds: float = Field(default=5.0, ge=0)
+
+
+class RateLimitDetails(BaseModel):
+    requests_per_second: float = Field(default=10.0, gt=0)
+    burst: int = Field(default=20, ge=1)
+    max_wait_seconds: float = Field(default=5.0, ge=0)
+
+
+class RetryDetails(BaseModel):
+    max_retries: int = Field(default=2, ge=0)
+    base_backoff_seconds: float = Field(default=0.1, ge=0)
+    max_backoff_seconds: float = Field(default=5.0, ge=0)
+    budget_ratio: float = Field(default=0.1, ge=0)
+    budget_max_tokens: float = Field(default=10.0, ge=0)
+
+
+class HedgingDetails(BaseModel):
+    percentile: float = Field(default=95.0, gt=0, le=100)
+    max_hedge_fraction: float = Field(default=0.05, ge=0, le=1)
+    min_samples: int = Field(default=20, ge=1)
+    min_delay_seconds: float = Field(default=0.05, ge=0)
+    latency_window: int = Field(default=200, ge=1)
+    max_tokens: float = Field(default=5.0, ge=1)
+
+
+class CacheDetails(BaseModel):
+    label_ttl_seconds: int = Field(default=60, ge=0)
+    query_ttl_seconds: int = Field(default=30, ge=0)
+
+
+class BlockStoreDetails(BaseModel):
+    immutable_after_seconds: int = Field(default=300, ge=0)
+    block_points: int = Field(default=240, ge=1)
+
+
+class StandingQueryDetails(BaseModel):
+    min_hits: int = Field(default=3, ge=1)
+    refresh_seconds: int = Field(default=30, ge=1)
+    window_seconds: int = Field(default=6 * 3600, ge=60)
+    idle_seconds: int = Field(default=600, ge=1)
+    max_concurrent_refreshes: int = Field(default=2, ge=1)
+
+
+class RemoteReadDetails(BaseModel):
+    path: str = Field(default="api/v1/read")
+    streamed: bool = Field(default=True)
+
+
+class DownsamplingDetails(BaseModel):
+    max_points: int = Field(default=1000, ge=3)
+
+
+class LocalAggregationDetails(BaseModel):
+    raw_ttl_seconds: int = Field(default=30, ge=0)
+    max_range_seconds: int = Field(default=7 * 24 * 3600, ge=60)
+
+
+class NegativeCacheDetails(BaseModel):
+    ttl_seconds: int = Field(default=30, ge=1)
+
+
+class SeriesPreflightDetails(BaseModel):
+    ttl_seconds: int = Field(default=60, ge=1)
+
+
+class Http2Details(BaseModel):
+    max_connections: int = Field(default=2, ge=1)
+    prior_knowledge: bool = Field(default=False)
+
+
+class StreamingDetails(BaseModel):
+    min_range_seconds: int = Field(default=7 * 24 * 3600, ge=0)
+    chunk_seconds: int = Field(default=24 * 3600, ge=60)
+
+
+class RecordingRulesDetails(BaseModel):
+    path: Optional[str] = Field(default=None)
+    refresh_seconds: int = Field(default=300, ge=1)
+
+
+class FanOutDetails(BaseModel):
+    urls: List[str] = Field(min_items=1)
+    mode: str = Field(default="merge_all", regex="^(first_success|merge_all|merge_available|prefer_primary)$")
+    fallback_after_seconds: Optional[float] = Field(default=None, gt=0)
+
+
+class ResponseLimitsDetails(BaseModel):
+    max_bytes: Optional[int] = Field(default=None, ge=1)
+    max_series: Optional[int] = Field(default=None, ge=1)
+    max_samples: Optional[int] = Field(default=None, ge=1)
+
+
+class PrefetchDetails(BaseModel):
+    budget_per_minute: float = Field(default=60.0, gt=0)
+    burst: int = Field(default=10, ge=1)
+    max_in_flight: int = Field(default=1, ge=1)
+    max_load: float = Field(default=0.5, ge=0, le=1)
+    max_zoom_ratio: float = Field(default=4.0, ge=1)
+
+
 class ConnectionDetails(BaseModel):
     url: str
     request_timeout_seconds: int = Field(default=30)
     nan_interpretation: str = Field(default="ZERO")
     aws: Optional[AwsConnectionDetails]
+    admission: AdmissionControlDetails = Field(default_factory=AdmissionControlDetails)
+    rate_limit: Optional[RateLimitDetails]
+    retry: RetryDetails = Field(default_factory=RetryDetails)
+    hedging: Optional[HedgingDetails]
+    cache: Optional[CacheDetails]
+    block_store: Optional[BlockStoreDetails]
+    standing_queries: Optional[StandingQueryDetails]
+    remote_read: Optional[RemoteReadDetails]
+    downsampling: Optional[DownsamplingDetails]
+    local_aggregation: Optional[LocalAggregationDetails]
+    negative_cache: Optional[NegativeCacheDetails]
+    series_preflight: Optional[SeriesPreflightDetails]
+    http2: Optional[Http2Details]
+    streaming: Optional[StreamingDetails]
+    recording_rules: Optional[RecordingRulesDetails]
+    fan_out: Optional[FanOutDetails]
+    response_limits: Optional[ResponseLimitsDetails]
+    prefetch: Optional[PrefetchDetails]
 
 
 class TestConnectionRequest(BaseModel):
@@ -135,6 +257,20 @@ class TestConnectionResponse(BaseModel):
 
 class Settings(BaseSettings):
     API_KEY: str = "unsecure"
+    ADMIN_TOKEN: Optional[str] = None
     RELOAD: bool = False
     PORT: int = 9900
     WORKERS: int = 1
+    SHARED_CACHE_PATH: Optional[str] = None
+    SHARED_CACHE_MAX_ENTRIES: int = 10000
+    SHARED_CACHE_LEASE_SECONDS: float = 30.0
+    BLOCK_STORE_PATH: Optional[str] = None
+    BLOCK_STORE_MAX_BYTES: int = 1024 * 1024 * 1024
+    OFFLOAD_MODE: str = "inline"
+    OFFLOAD_THRESHOLD_BYTES: int = 1024 * 1024
+    OFFLOAD_WORKERS: int = 2
+    PREWARM_CONNECTIONS: List[ConnectionDetails] = []
+    COMPRESSION_ENCODINGS: List[str] = ["zstd", "gzip"]
+    COMPRESSION_MIN_BYTES: int = 1024
+    COMPRESSION_GZIP_LEVEL: int = 6
+    COMPRESSION_ZSTD_LEVEL: int = 3
@@ -0,0 +1,53 @@
+from threading import Lock
+from typing import Any, Dict, Optional, Tuple
+
+from prometheus_mirror.shared_cache import get_cache
+
+NOT_FOUND = "not_found"
+TOO_MANY_METRICS = "too_many_metrics"
+
+
+class NegativeCache:
+    # Remembers queries that ended in "metric not found" or "too many metrics" for a short while, so misconfigured
+    # streams polled every interval don't run a full range query each time. Entries live in the shared cache.
+    def __init__(self):
+        self._lock = Lock()
+        self.hits = {NOT_FOUND: 0, TOO_MANY_METRICS: 0}
+        self.stored = 0
+
+    @staticmethod
+    def _key(url: str, query: str, bounds: Optional[Tuple[int, int]] = None) -> str:
+        key = f"negative:{url}:{query}"
+        return key if bounds is None else f"{key}:{bounds[0]}:{bounds[1]}"
+
+    def get(self, url: str, query: str, bounds: Optional[Tuple[int, int]] = None) -> Optional[Tuple[str, Any]]:
+        # entries of the query as a whole first, then those of the bounds of the request
+        entry = get_cache().get(self._key(url, query))
+        if entry is None and bounds is not None:
+            entry = get_cache().get(self._key(url, query, bounds))
+        if entry is None:
+            return None
+        with self._lock:
+            self.hits[entry["kind"]] += 1
+        return entry["kind"], entry["detail"]
+
+    def remember(
+        self,
+        url: str,
+        query: str,
+        kind: str,
+        detail: Any,
+        ttl_seconds: int,
+        bounds: Optional[Tuple[int, int]] = None,
+    ):
+        # an entry with bounds only answers requests within the same bounds
+        get_cache().set(self._key(url, query, bounds), {"kind": kind, "detail": detail}, ttl_seconds)
+        with self._lock:
+            self.stored += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": dict(self.hits), "stored": self.stored}
+
+
+negative_cache = NegativeCache()
@@ -0,0 +1,74 @@
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from prometheus_mirror.model import Settings
+from prometheus_mirror.profiler import profiler
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+MODE_INLINE = "inline"
+MODE_THREAD = "thread"
+MODE_PROCESS = "process"
+
+# rough size of one `[timestamp, "value"]` pair in a Prometheus response, used to size point building work
+POINT_BYTES = 32
+
+T = TypeVar("T")
+
+
+class Offloader:
+    # Runs CPU heavy stages (decoding large responses, building large point lists) on a separate pool, so that one
+    # big response does not hold up the small requests served by the same worker. A thread pool bounds how many
+    # threads of the worker do heavy work at once; a process pool takes that work off the worker's GIL entirely, at
+    # the cost of pickling arguments and results. Work below `threshold_bytes` always runs inline.
+    INSTANCE: Optional["Offloader"] = None
+
+    def __init__(self, mode: str, threshold_bytes: int, workers: int):
+        self.mode = mode
+        self.threshold_bytes = threshold_bytes
+        self._lock = Lock()
+        self.inline = 0
+        self.offloaded = 0
+        self._executor: Optional[Executor] = None
+        if mode == MODE_THREAD:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="offload")
+        elif mode == MODE_PROCESS:
+            # spawn, forking a process with running threads is not safe
+            self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        elif mode != MODE_INLINE:
+            raise ValueError(f"Unknown offload mode {mode}")
+
+    @staticmethod
+    def get_instance() -> "Offloader":
+        if Offloader.INSTANCE is None:
+            with lock:
+                if Offloader.INSTANCE is None:
+                    settings = Settings()
+                    Offloader.INSTANCE = Offloader(
+                        settings.OFFLOAD_MODE, settings.OFFLOAD_THRESHOLD_BYTES, settings.OFFLOAD_WORKERS
+                    )
+        return Offloader.INSTANCE
+
+    def run(self, size_bytes: int, function: Callable[..., T], *args: Any) -> T:
+        if self._executor is None or size_bytes < self.threshold_bytes:
+            with self._lock:
+                self.inline += 1
+            return function(*args)
+        with self._lock:
+            self.offloaded += 1
+        if self.mode == MODE_THREAD:
+            function = profiler.propagating(function)
+        return self._executor.submit(function, *args).result()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"mode": self.mode, "inline": self.inline, "offloaded": self.offloaded}
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
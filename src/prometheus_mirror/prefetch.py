@@ -0,0 +1,143 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from cachetools import LRUCache
+
+from prometheus_mirror.admission import Bulkhead
+from prometheus_mirror.model import ConnectionDetails, PrefetchDetails, RateLimitDetails
+from prometheus_mirror.throttling import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+# few threads: prefetches wait for each other rather than take threads from requests
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+
+# start, end and window of a request, in seconds
+Window = Tuple[int, int, int]
+Fetch = Callable[[int, int, int], Any]
+
+LOAD = "load"
+IN_FLIGHT = "in_flight"
+BUDGET = "budget"
+
+
+class Prefetcher:
+    # Learns how StackState moves through time for each query of a datasource and fetches the window it is likely to
+    # ask for next into the query cache and block store: the next page when the timeline is scrubbed, the parent
+    # range when it is zoomed out. A prediction continues the last move: the shift and zoom between the previous two
+    # windows of the query are applied once more to the latest one. Prefetches start after the request that
+    # triggered them has been answered, only while the datasource's bulkhead is lightly loaded, and within a budget
+    # per minute, so that speculative calls do not compete with the calls of requests.
+    INSTANCES: Dict[str, "Prefetcher"] = {}
+
+    def __init__(self, name: str, config: PrefetchDetails):
+        self.name = name
+        self.config = config
+        self._lock = Lock()
+        # latest window by query, and the prefetched windows not requested yet
+        self._history: LRUCache = LRUCache(maxsize=4096)
+        self._prefetched: LRUCache = LRUCache(maxsize=4096)
+        self._slots = BoundedSemaphore(config.max_in_flight)
+        self._budget = TokenBucket(
+            RateLimitDetails(requests_per_second=config.budget_per_minute / 60, burst=config.burst)
+        )
+        self.prefetches = 0
+        self.hits = 0
+        self.failures = 0
+        self.skipped = {LOAD: 0, IN_FLIGHT: 0, BUDGET: 0}
+
+    @staticmethod
+    def get_instance(config: ConnectionDetails) -> Optional["Prefetcher"]:
+        if config.prefetch is None:
+            Prefetcher.INSTANCES.pop(config.url, None)
+            return None
+        prefetcher = Prefetcher.INSTANCES.get(config.url, None)
+        if prefetcher is None or prefetcher.config != config.prefetch:
+            with lock:
+                prefetcher = Prefetcher.INSTANCES.get(config.url, None)
+                if prefetcher is None or prefetcher.config != config.prefetch:
+                    prefetcher = Prefetcher(config.url, config.prefetch.copy())
+                    Prefetcher.INSTANCES[config.url] = prefetcher
+        return prefetcher
+
+    @staticmethod
+    def stats() -> Dict[str, Dict[str, Any]]:
+        return {name: prefetcher.snapshot() for name, prefetcher in list(Prefetcher.INSTANCES.items())}
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "prefetches": self.prefetches,
+                "hits": self.hits,
+                "failures": self.failures,
+                "skipped": dict(self.skipped),
+            }
+
+    def observe(self, query: str, window: Window, bulkhead: Bulkhead, fetch: Fetch):
+        # called once a request for `window` of `query` has been answered
+        with self._lock:
+            previous = self._history.get(query)
+            self._history[query] = window
+            if self._prefetched.pop((query, window), None) is not None:
+                self.hits += 1
+            predicted = predict(previous, window, self.config.max_zoom_ratio, time.time())
+            if predicted is None or (query, predicted) in self._prefetched:
+                return
+            if not self._idle(bulkhead):
+                self.skipped[LOAD] += 1
+                return
+            if not self._slots.acquire(blocking=False):
+                self.skipped[IN_FLIGHT] += 1
+                return
+            if not self._budget.try_acquire():
+                self._slots.release()
+                self.skipped[BUDGET] += 1
+                return
+            self._prefetched[(query, predicted)] = True
+            self.prefetches += 1
+        logger.debug(f"Prefetching {predicted} of {query} from {self.name}")
+        executor.submit(self._prefetch, fetch, predicted)
+
+    def _idle(self, bulkhead: Bulkhead) -> bool:
+        load = bulkhead.snapshot()
+        return load["queued"] == 0 and load["active"] <= self.config.max_load * bulkhead.config.max_concurrent_requests
+
+    def _prefetch(self, fetch: Fetch, window: Window):
+        try:
+            fetch(*window)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.debug(f"Prefetch of {window} from {self.name} failed: {e}")
+            with self._lock:
+                self.failures += 1
+        finally:
+            self._slots.release()
+
+
+def predict(previous: Optional[Window], current: Window, max_zoom_ratio: float, now: float) -> Optional[Window]:
+    if previous is None:
+        return None
+    (previous_start, previous_end, previous_step), (start, end, step) = previous, current
+    previous_width, width = previous_end - previous_start, end - start
+    if previous_width <= 0 or width <= 0:
+        return None
+    ratio = width / previous_width
+    # twice the shift of the centre, kept in integers
+    shift2 = start + end - previous_start - previous_end
+    if ratio < 1 or ratio > max_zoom_ratio or abs(shift2) > 4 * width:
+        # zooming in, or a jump to a time unrelated to the last one
+        return None
+    if shift2 == 0 and ratio == 1:
+        # the same window again, polled rather than moved
+        return None
+    next_width = round(width * ratio)
+    next_start = round((start + end + shift2 * ratio - next_width) / 2)
+    next_end = next_start + next_width
+    if next_end > now:
+        return None
+    # aggregation windows grow with the range like they did before
+    return next_start, next_end, round(step * step / previous_step) if previous_step else step
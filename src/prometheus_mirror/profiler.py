@@ -0,0 +1,135 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock
+from types import CodeType, FrameType
+from typing import Any, Callable, Dict, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+# leaf frames of threads waiting for work or I/O, by file name and function
+IDLE_FRAMES = {("threading.py", "wait"), ("selectors.py", "select"), ("queue.py", "get"), ("thread.py", "_worker")}
+
+
+class ProfilerBusyException(Exception):
+    pass
+
+
+class SamplingProfiler:
+    # Samples the Python stacks of the worker's threads with sys._current_frames while a profile runs, nothing is
+    # traced or hooked otherwise. Threads handling a request are tagged with its route and datasource, work handed
+    # to the fan-out, hedging and offload pools keeps the tags of the request, so a profile can be limited to the
+    # requests of a route or datasource. Profiles are returned as collapsed stacks, one `frame;frame;frame count`
+    # line per distinct stack, as read by flamegraph.pl and speedscope.
+    def __init__(self):
+        self._lock = Lock()
+        self._tags: Dict[int, Dict[str, str]] = {}
+        self._labels: Dict[CodeType, str] = {}
+        self._running = False
+        self.profiles = 0
+        self.samples = 0
+
+    @contextmanager
+    def tagged(self, **tags: Optional[str]) -> Iterator[None]:
+        # tags the current thread until the block ends, nested blocks add to the tags of the enclosing ones
+        ident = threading.get_ident()
+        previous = self._tags.get(ident)
+        self._tags[ident] = {**(previous or {}), **{name: value for name, value in tags.items() if value is not None}}
+        try:
+            yield
+        finally:
+            if previous is None:
+                self._tags.pop(ident, None)
+            else:
+                self._tags[ident] = previous
+
+    def propagating(self, function: Callable[..., T]) -> Callable[..., T]:
+        # wraps work handed to another thread so it runs with the tags of the current one
+        tags = self._tags.get(threading.get_ident())
+        if tags is None:
+            return function
+
+        def run(*args: Any, **kwargs: Any) -> T:
+            with self.tagged(**tags):
+                return function(*args, **kwargs)
+
+        return run
+
+    def profile(
+        self,
+        seconds: float,
+        interval_seconds: float,
+        route: Optional[str] = None,
+        datasource: Optional[str] = None,
+        idle: bool = False,
+    ) -> Counter:
+        with self._lock:
+            if self._running:
+                raise ProfilerBusyException("A profile is already running.")
+            self._running = True
+            self.profiles += 1
+        wanted = {name: value for name, value in (("route", route), ("datasource", datasource)) if value is not None}
+        stacks: Counter = Counter()
+        samples = 0
+        own = threading.get_ident()
+        try:
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == own:
+                        continue
+                    if wanted:
+                        tags = self._tags.get(ident)
+                        if tags is None or any(tags.get(name) != value for name, value in wanted.items()):
+                            continue
+                    if not idle and self._idle(frame):
+                        continue
+                    stacks[self._collapse(frame)] += 1
+                    samples += 1
+                time.sleep(interval_seconds)
+        finally:
+            with self._lock:
+                self._running = False
+                self.samples += samples
+        return stacks
+
+    @staticmethod
+    def _idle(frame: FrameType) -> bool:
+        return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+    def _collapse(self, frame: Optional[FrameType]) -> str:
+        labels: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+                self._labels[code] = label
+            labels.append(label)
+            frame = frame.f_back
+        return ";".join(reversed(labels))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "running": self._running,
+                "profiles": self.profiles,
+                "samples": self.samples,
+                "tagged_threads": len(self._tags),
+            }
+
+
+def _short_path(path: str) -> str:
+    # relative to the longest sys.path entry it is in, like a module path
+    prefixes = [entry for entry in sys.path if entry and path.startswith(entry.rstrip(os.sep) + os.sep)]
+    return path[len(max(prefixes, key=len).rstrip(os.sep)) + 1 :] if prefixes else path
+
+
+def format_collapsed(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+profiler = SamplingProfiler()
@@ -1,22 +1,77 @@
+import hashlib
+import json
 import logging
+import time
 from collections import defaultdict
+from functools import partial
 from threading import Lock
-from typing import Any, Dict, List, Optional, Sequence, Tuple
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 
-import boto3
 import requests
-from botocore.auth import SigV4Auth
-from botocore.awsrequest import AWSRequest
-from botocore.config import Config
-from botocore.credentials import Credentials
 from cachetools import TTLCache
-
+from requests.adapters import BaseAdapter
+
+from prometheus_mirror.admission import Bulkhead
+from prometheus_mirror.aggregation import (
+    LOOKBACK_MILLIS,
+    METHODS,
+    RawSeries,
+    evaluate,
+    single_flight,
+)
+from prometheus_mirror.block_store import get_block_store
+from prometheus_mirror.fan_out import FanOut, merge_label_values, merge_series
+from prometheus_mirror.hedging import AbortableHTTPAdapter, Hedger
+from prometheus_mirror.http2 import Http2Adapter
 from prometheus_mirror.model import (
     AwsConnectionDetails,
     Condition,
     ConditionValue,
     ConnectionDetails,
+    Http2Details,
+    LocalAggregationDetails,
 )
+from prometheus_mirror.negative_cache import (
+    NOT_FOUND,
+    TOO_MANY_METRICS,
+    negative_cache,
+)
+from prometheus_mirror.offload import Offloader
+from prometheus_mirror.prefetch import Prefetcher
+from prometheus_mirror.promql import canonicalize
+from prometheus_mirror.recording_rules import RecordingRules, load_rules_file
+from prometheus_mirror.remote_read import (
+    MATCH_EQUAL,
+    MATCH_REGEXP,
+    REQUEST_HEADERS,
+    Matcher,
+    codecs_available,
+    decode_chunked_response,
+    decode_read_response,
+    encode_read_request,
+    snappy_compress,
+)
+from prometheus_mirror.response_limits import ResponseLimits
+from prometheus_mirror.samples import SampleBlock
+from prometheus_mirror.scheduler import StandingQueryScheduler
+from prometheus_mirror.shared_cache import get_cache
+from prometheus_mirror.sigv4 import SigV4Signer
+from prometheus_mirror.throttling import Throttle
+
+if TYPE_CHECKING:
+    # boto3 and botocore are imported on first use, workers without AWS datasources never load them
+    from botocore.credentials import Credentials
 
 logger = logging.getLogger(__name__)
 
@@ -25,11 +80,10 @@ NAN_AS_NONE = "NONE"
 
 DEFAULT_BOTO3_RETRIES_COUNT = 50
 
-DEFAULT_BOTO3_CONFIG = Config(
-    retries=dict(
-        max_attempts=DEFAULT_BOTO3_RETRIES_COUNT,
-    )
-)
+# connections kept per datasource on top of its admission limit, for hedged requests
+SPARE_CONNECTIONS = 2
+
+T = TypeVar("T")
 
 
 class TooManyMetricsException(Exception):
@@ -60,28 +114,78 @@ lock = Lock()
 
 class PrometheusClient:
     INSTANCES: Dict[str, TTLCache] = {}
+    SESSIONS: Dict[str, Tuple[Tuple[int, Optional[Http2Details]], requests.Session]] = {}
 
-    def __init__(self, config: ConnectionDetails):
+    def __init__(self, config: ConnectionDetails, refresh_credentials: bool = False):
         self.connection_details = config
         self.service_name = "aps"
         self.url = config.url if not config.url.endswith("/") else config.url[:-1]
+        self.cache_scope = PrometheusClient._cache_scope(config)
         self.credentials = None
         self.region = None
+        self.signer: Optional[SigV4Signer] = None
         if config.aws:
-            self.credentials = self._init_credentials(config.aws)
+            self.credentials = self._shared_credentials(config.aws, refresh_credentials)
             self.region = config.aws.region_name
+            self.signer = SigV4Signer(self.credentials, self.region, self.service_name)
         self.nan_interpretation = config.nan_interpretation
+        self.bulkhead = Bulkhead.get_instance(config)
+        self.throttle = Throttle.get_instance(config)
+        self.hedger = Hedger.get_instance(config)
+        self.recording_rules = RecordingRules.get_instance(config)
+        self.fan_out = FanOut.get_instance(config)
+        self.response_limits = ResponseLimits.get_instance(config)
+        self.prefetcher = Prefetcher.get_instance(config)
+        self._endpoints: Optional[List[PrometheusClient]] = None
+        self.session = PrometheusClient._pooled_session(config)
+
+    @staticmethod
+    def _pooled_session(config: ConnectionDetails) -> requests.Session:
+        # one keep-alive pool per datasource, shared by the short lived client instances
+        pool_key = (config.admission.max_concurrent_requests + SPARE_CONNECTIONS, config.http2)
+        pooled = PrometheusClient.SESSIONS.get(config.url, None)
+        if pooled is None or pooled[0] != pool_key:
+            with lock:
+                pooled = PrometheusClient.SESSIONS.get(config.url, None)
+                if pooled is None or pooled[0] != pool_key:
+                    # first call or user changed the admission limit or the transport
+                    session = requests.Session()
+                    # Prometheus gzips its responses when asked, they are decompressed while being read
+                    session.headers["Accept-Encoding"] = "gzip"
+                    adapter: BaseAdapter
+                    if config.http2:
+                        adapter = Http2Adapter(config.http2)
+                    else:
+                        adapter = AbortableHTTPAdapter(pool_connections=1, pool_maxsize=pool_key[0])
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    # the replaced session is dropped rather than closed: other threads can still be sending through
+                    # it, its connections are closed once the last of them lets go of it
+                    pooled = (pool_key, session)
+                    PrometheusClient.SESSIONS[config.url] = pooled
+        return pooled[1]
+
+    @staticmethod
+    def _cache_scope(config: ConnectionDetails) -> str:
+        # Cached results and clients are kept apart per AWS identity, two roles on one workspace can be allowed to
+        # see different series. The digest leaves secrets out of cache keys.
+        url = config.url if not config.url.endswith("/") else config.url[:-1]
+        if not config.aws:
+            return url
+        identity = config.aws.json(include={"role_arn", "external_id", "aws_access_key_id"}, sort_keys=True)
+        return f"{url}#{hashlib.sha256(identity.encode()).hexdigest()[:16]}"
 
     @staticmethod
     def get_instance(config: ConnectionDetails, check_connection: bool = False):
+        scope = PrometheusClient._cache_scope(config)
         if not config.aws or check_connection:
-            instance_cache = PrometheusClient.INSTANCES.get(config.url, None)
+            instance_cache = PrometheusClient.INSTANCES.get(scope, None)
             if instance_cache is not None:
                 with lock:
                     instance_cache.clear()
-            return PrometheusClient(config)
+            return PrometheusClient(config, refresh_credentials=check_connection)
 
-        instance_cache = PrometheusClient.INSTANCES.get(config.url, None)
+        instance_cache = PrometheusClient.INSTANCES.get(scope, None)
         ttl_seconds = config.aws.token_expiry_seconds - 10
         ttl_seconds = 5 if ttl_seconds < 0 else ttl_seconds
         if instance_cache is None:
@@ -89,7 +193,7 @@ class PrometheusClient:
             cache = TTLCache(maxsize=1, ttl=ttl_seconds)
             cache["instance"] = instance
             with lock:
-                PrometheusClient.INSTANCES[config.url] = cache
+                PrometheusClient.INSTANCES[scope] = cache
             instance_cache = cache
         try:
             return instance_cache["instance"]
@@ -99,7 +203,7 @@ class PrometheusClient:
                 if instance_cache.ttl != ttl_seconds:
                     # user changed time to live value
                     instance_cache = TTLCache(maxsize=1, ttl=ttl_seconds)
-                    PrometheusClient.INSTANCES[config.url] = instance_cache
+                    PrometheusClient.INSTANCES[scope] = instance_cache
                 instance_cache["instance"] = instance
             return instance
 
@@ -110,16 +214,22 @@ class PrometheusClient:
 
     def list_labels(self, limit: int) -> Tuple[bool, List[str]]:
         labels_uri = "api/v1/labels"
-        response = self._handle_failed_call(self._do_get(labels_uri))
-        result = response.json()["data"]
+        result = self._cached(
+            f"labels:{self.cache_scope}",
+            self.connection_details.cache.label_ttl_seconds if self.connection_details.cache else 0,
+            lambda: self._label_data(labels_uri),
+        )
         is_partial = limit < len(result)
         end = limit if limit < len(result) else len(result)
         return is_partial, result[0:end]
 
     def list_label_values(self, label: str, prefix: str, offset: int, max_result: int) -> Tuple[bool, List[str]]:
         values_uri = f"api/v1/label/{label}/values"
-        response = self._handle_failed_call(self._do_get(values_uri))
-        data = response.json()["data"]
+        data = self._cached(
+            f"label_values:{self.cache_scope}:{label}",
+            self.connection_details.cache.label_ttl_seconds if self.connection_details.cache else 0,
+            lambda: self._label_data(values_uri),
+        )
         if prefix is not None:
             result = [value for value in data if value.startswith(prefix)]
         else:
@@ -130,6 +240,21 @@ class PrometheusClient:
         end = start + max_result if start + max_result < len(result) else len(result)
         return is_partial, result[start:end]
 
+    def _label_data(self, uri: str) -> List[str]:
+        if self.fan_out:
+            calls = [partial(client._label_data, uri) for client in self._endpoint_clients()]
+            return self.fan_out.run(calls, merge_label_values)
+        return self._handle_failed_call(self._do_get(uri)).json()["data"]
+
+    def _endpoint_clients(self) -> List["PrometheusClient"]:
+        # a client per endpoint of a fan-out datasource, each with the bulkhead, throttle and pool of its url
+        if self._endpoints is None:
+            assert self.fan_out is not None
+            self._endpoints = [
+                PrometheusClient(config) for config in self.fan_out.endpoint_configs(self.connection_details)
+            ]
+        return self._endpoints
+
     def get_series_values_in_range(
         self,
         conditions: Sequence[Condition],
@@ -139,31 +264,382 @@ class PrometheusClient:
         window: Optional[int] = None,
         limit: Optional[int] = None,
     ):
-        query = PrometheusQuery(conditions, aggregation_method, window)
+        query = PrometheusQuery(conditions, aggregation_method, window, self._refreshed_recording_rules())
         query_str = query.to_prometheus()
+        values = self._checked_series_values_in_range(query, query_str, start, end, window, limit)
+        if self.prefetcher:
+            self._prefetch_next_window(conditions, query, start, end, window)
+        return values
+
+    def _checked_series_values_in_range(
+        self,
+        query: "PrometheusQuery",
+        query_str: str,
+        start: int,
+        end: int,
+        window: Optional[int],
+        limit: Optional[int],
+    ):
+        query_key = canonicalize(query_str)
+        negative_config = self.connection_details.negative_cache
+        if not negative_config:
+            return self._series_values_in_range(query, query_str, query_key, start, end, window, limit)
+
+        ttl_seconds = negative_config.ttl_seconds
+        # Empty results are remembered for the window they were read in, widened to multiples of the ttl so that
+        # consecutive polls share the entry. Only selectors the series index does not know are not found in every
+        # window.
+        bounds = (start - start % ttl_seconds, end - end % ttl_seconds)
+        cached = negative_cache.get(self.cache_scope, query_key, bounds)
+        if cached is not None:
+            kind, detail = cached
+            if kind == NOT_FOUND:
+                raise MetricNotFoundException(detail)
+            raise TooManyMetricsException(detail)
+        try:
+            return self._series_values_in_range(query, query_str, query_key, start, end, window, limit)
+        except MetricNotFoundException as e:
+            negative_cache.remember(
+                self.cache_scope,
+                query_key,
+                NOT_FOUND,
+                e.query,
+                ttl_seconds,
+                None if self._unknown_series(query) else bounds,
+            )
+            raise
+        except TooManyMetricsException as e:
+            negative_cache.remember(self.cache_scope, query_key, TOO_MANY_METRICS, e.fields, ttl_seconds)
+            raise
+
+    def _unknown_series(self, query: "PrometheusQuery") -> bool:
+        # whether the series index matches no series of the selector at all, across the retention of the TSDB
+        request_type, selector = query.to_selector()
+        if request_type == "~" or self.fan_out:
+            # PromQL expressions are no selectors, and another endpoint of a fan-out may know the series
+            return False
+        try:
+            return not self._series_index(selector)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.debug(f"Series index lookup of {selector} failed: {e}")
+            return False
+
+    def _prefetch_next_window(
+        self, conditions: Sequence[Condition], query: "PrometheusQuery", start: int, end: int, window: Optional[int]
+    ):
+        # prefetched results only help when they are kept
+        cache_config = self.connection_details.cache
+        if not (cache_config and cache_config.query_ttl_seconds > 0) and not self.connection_details.block_store:
+            return
+        assert self.prefetcher is not None
+        request_type, selector = query.to_selector()
+        connection_details = self.connection_details
+        aggregation_method = query.aggregation_method
+
+        def fetch(prefetch_start: int, prefetch_end: int, prefetch_window: int):
+            # resolve the client when the prefetch runs so expired AWS credentials get renewed
+            client = PrometheusClient.get_instance(connection_details)
+            prefetched = PrometheusQuery(
+                conditions, aggregation_method, prefetch_window, client._refreshed_recording_rules()
+            )
+            prefetched_str = prefetched.to_prometheus()
+            # past the negative cache, speculative windows neither read its entries nor store their own
+            client._series_values_in_range(
+                prefetched,
+                prefetched_str,
+                canonicalize(prefetched_str),
+                prefetch_start,
+                prefetch_end,
+                prefetch_window,
+                None,
+            )
+
+        family = f"{aggregation_method}:{request_type}:{canonicalize(selector)}"
+        self.prefetcher.observe(family, (start, end, window or 30), self.bulkhead, fetch)
+
+    def iter_series_values_in_range(
+        self,
+        conditions: Sequence[Condition],
+        start: int,
+        end: int,
+        window: Optional[int],
+        limit: Optional[int],
+        chunk_seconds: int,
+    ) -> Iterator[List[Any]]:
+        # The values of a long raw range, one sub-range of `chunk_seconds` at a time, so that only one chunk is held
+        # in memory. Sub-ranges start on the step grid of the whole range and yield the same samples as one query.
+        # Empty sub-ranges are gaps in the series; only when the whole range is empty the metric is not found.
+        query = PrometheusQuery(conditions, None, window)
+        query_str = query.to_prometheus()
+        step = int(window) if window else 30
+        preflight_config = self.connection_details.series_preflight
+        if preflight_config and query.requires_single_series():
+            self._preflight_series(query, start, end, preflight_config.ttl_seconds)
+
+        chunk_points = max(chunk_seconds // step, 1)
+        remaining = limit
+        found = False
+        first_labels: Optional[Dict[str, str]] = None
+        chunk_start = start
+        while chunk_start <= end and (remaining is None or remaining > 0):
+            chunk_end = min(chunk_start + (chunk_points - 1) * step, end)
+            result = self._query_range(query_str, chunk_start, chunk_end, step)
+            if len(result) > 1:
+                raise TooManyMetricsException(self._compute_differentiating_fields(result))
+            if result:
+                # each chunk matching one series is not enough, the whole range must be one series as well
+                labels = result[0].get("metric", {})
+                if first_labels is None:
+                    first_labels = labels
+                elif labels != first_labels:
+                    raise TooManyMetricsException(
+                        self._compute_differentiating_fields([{"metric": first_labels}, {"metric": labels}])
+                    )
+            values = result[0]["values"] if result else []
+            if remaining is not None:
+                values = values[:remaining]
+                remaining -= len(values)
+            if values:
+                found = True
+                yield values
+            chunk_start = chunk_end + step
+        if not found:
+            raise MetricNotFoundException(query_str)
+
+    def _series_values_in_range(
+        self,
+        query: "PrometheusQuery",
+        query_str: str,
+        query_key: str,
+        start: int,
+        end: int,
+        window: Optional[int],
+        limit: Optional[int],
+    ):
+        # query_str is sent to Prometheus, its canonical form query_key identifies the query in caches
+        aggregation_method = query.aggregation_method
+        # raw samples straight from the TSDB when the selector can be expressed as remote read label matchers
+        # fan-out datasources merge query_range results, remote read would only ask the primary
+        # without the native codecs decoding takes longer than reading the same samples as JSON
+        use_remote_read = self.connection_details.remote_read and not self.fan_out and codecs_available()
+        matchers = query.to_remote_read_matchers() if use_remote_read else None
 
-        query_uri = "api/v1/query_range"
         if window is None:
             window = 30  # default bucket size is 30 seconds
+        step = int(window)
+
+        preflight_config = self.connection_details.series_preflight
+        if preflight_config and query.requires_single_series():
+            self._preflight_series(query, start, end, preflight_config.ttl_seconds)
+
+        local_config = self.connection_details.local_aggregation
+        if local_config and aggregation_method in METHODS:
+            aggregated = self._aggregate_locally(query, query_str, start, end, step, local_config)
+            if aggregated is not None:
+                return aggregated[:limit] if limit is not None else aggregated
+
+        standing_config = self.connection_details.standing_queries
+        standing_key = (self.cache_scope, query_key, step) if standing_config and matchers is None else None
+        if standing_key is not None:
+            standing = StandingQueryScheduler.get_instance().lookup(standing_key, start, end)
+            if standing is not None:
+                return standing[:limit] if limit is not None else standing
+
+        def fetch_values():
+            block_config = self.connection_details.block_store
+            block_store = get_block_store() if block_config else None
+            if matchers is not None:
+                data = {"data": {"result": self._remote_read(matchers, start, end)}}
+            elif block_store and block_config:
+                result = block_store.query_range(
+                    self.cache_scope,
+                    query_key,
+                    start,
+                    end,
+                    step,
+                    block_config.block_points,
+                    int(time.time()) - block_config.immutable_after_seconds,
+                    lambda block_start, block_end: self._query_range(query_str, block_start, block_end, step),
+                )
+                data = {"data": {"result": result}}
+            else:
+                data = {"data": {"result": self._query_range(query_str, start, end, step)}}
+            self._validate_metric_data(query_str, data)
+            return data["data"]["result"][0]["values"]
 
-        response = self._handle_failed_call(
-            self._do_get(query_uri, params={"query": query_str, "start": start, "end": end, "step": int(window)})
+        query_ttl_seconds = self.connection_details.cache.query_ttl_seconds if self.connection_details.cache else 0
+        if query_ttl_seconds > 0:
+            # cached results are held as compressed sample blocks, turned into points without decoding them into
+            # lists first; the keys name the block layout, so entries of another layout are never read
+            values: List[List[Any]] | SampleBlock = SampleBlock.from_json(
+                self._cached(
+                    f"samples:{self.cache_scope}:{query_key}:{start}:{end}:{step}",
+                    query_ttl_seconds,
+                    lambda: SampleBlock.encode(fetch_values()).to_json(),
+                )
+            )
+        else:
+            values = fetch_values()
+        if standing_config and standing_key is not None:
+            # only polls that found the metric count towards keeping the query warm
+            connection_details = self.connection_details
+            StandingQueryScheduler.get_instance().observe(
+                standing_key,
+                standing_config,
+                # resolve the client on every refresh so expired AWS credentials get renewed
+                lambda s, e: PrometheusClient.get_instance(connection_details)._query_range(query_str, s, e, step),
+            )
+        if limit is None:
+            return values
+        return values.head(limit) if isinstance(values, SampleBlock) else values[:limit]
+
+    def _refreshed_recording_rules(self) -> Optional[RecordingRules]:
+        if self.recording_rules is not None:
+            self.recording_rules.refresh(self._load_recording_rules)
+        return self.recording_rules
+
+    def _load_recording_rules(self) -> Dict[str, Any]:
+        config = self.connection_details.recording_rules
+        assert config is not None
+        if config.path:
+            return load_rules_file(config.path)
+        # workers share one read of the rules API
+        return self._cached(
+            f"rules:{self.cache_scope}",
+            config.refresh_seconds,
+            lambda: self._decode_json(
+                self._handle_failed_call(self._do_get("api/v1/rules", params={"type": "record"})).content
+            )["data"],
         )
-        data = response.json()
-        self._validate_metric_data(query_str, data)
 
-        if limit is not None:
-            return data["data"]["result"][0]["values"][:limit]
+    def _query_range(self, query: str, start: int, end: int, step: int) -> List[Dict[str, Any]]:
+        if self.fan_out:
+            calls = [partial(client._query_range, query, start, end, step) for client in self._endpoint_clients()]
+            return self.fan_out.run(calls, merge_series)
+        query_uri = "api/v1/query_range"
+        params = {"query": query, "start": start, "end": end, "step": step}
+        content = self._do_read(
+            "GET", query_uri, self._read_body, params=params, hedge=True, stream=self.response_limits is not None
+        )
+        data = self._decode_json(content)
+        self._validate_response_data(data)
+        return data["data"]["result"]
+
+    def _preflight_series(self, query: "PrometheusQuery", start: int, end: int, ttl_seconds: int):
+        # Asks the series index how many series the selector matches before any samples are read. Bounds are
+        # widened to multiples of the ttl so that consecutive polls of a stream share one cached lookup.
+        _, selector = query.to_selector()
+        index_start = start - start % ttl_seconds
+        index_end = end - end % ttl_seconds + ttl_seconds
+        series = self._cached(
+            f"series:{self.cache_scope}:{canonicalize(selector)}:{index_start}:{index_end}",
+            ttl_seconds,
+            lambda: self._series_index(selector, index_start, index_end),
+        )
+        if len(series) > 1:
+            # the widened bounds can include series that ended before or started after the requested range, only
+            # the index at the exact bounds rejects the selector
+            series = self._series_index(selector, start, end)
+        if len(series) > 1:
+            raise TooManyMetricsException(self._compute_differentiating_fields([{"metric": s} for s in series]))
+
+    def _series_index(
+        self, selector: str, start: Optional[int] = None, end: Optional[int] = None
+    ) -> List[Dict[str, str]]:
+        # without bounds Prometheus looks through all of its blocks
+        params: Dict[str, Any] = {"match[]": selector}
+        if start is not None and end is not None:
+            params.update(start=start, end=end)
+        return self._handle_failed_call(self._do_get("api/v1/series", params=params)).json()["data"]
+
+    def _aggregate_locally(
+        self, query: "PrometheusQuery", query_str: str, start: int, end: int, step: int, config: LocalAggregationDetails
+    ) -> Optional[List[List[Any]]]:
+        request_type, selector = query.to_selector()
+        if request_type not in ("__gauge__", "__counter__") or query.aggregation_method is None:
+            return None
+        # one range selector covering every sample the PromQL expression would look at
+        if request_type == "__counter__":
+            lookback = 2 * step
         else:
-            return data["data"]["result"][0]["values"]
+            lookback = max(LOOKBACK_MILLIS // 1000, step)
+        range_seconds = end - start + lookback
+        if range_seconds > config.max_range_seconds:
+            return None
+        raw_query = f"{selector}[{range_seconds}s]"
+        key = f"raw-samples:{self.cache_scope}:{canonicalize(raw_query)}:{end}"
+
+        def fetch():
+            return [
+                {"metric": serie["metric"], "block": SampleBlock.encode(serie["values"]).to_json()}
+                for serie in self._query_instant(raw_query, end)
+            ]
+
+        # mean, percentiles, max, ... of the same stream arrive together, they share one upstream read
+        raw = single_flight.do(key, lambda: self._cached(key, config.raw_ttl_seconds, fetch))
+        if request_type == "__counter__" or query.aggregation_method == "event_count":
+            # only the gauge aggregations combine several series into one
+            self._validate_metric_data(query_str, {"data": {"result": raw}})
+        series = [RawSeries(serie["metric"], list(SampleBlock.from_json(serie["block"]).samples())) for serie in raw]
+        values = evaluate(series, request_type, query.aggregation_method, start, end, step, step)
+        if not values:
+            raise MetricNotFoundException(query_str)
+        return values
+
+    def _query_instant(self, query: str, time: int) -> List[Dict[str, Any]]:
+        if self.fan_out:
+            # only range selectors are queried instantly, their results are series of samples like query_range's
+            calls = [partial(client._query_instant, query, time) for client in self._endpoint_clients()]
+            return self.fan_out.run(calls, merge_series)
+        params = {"query": query, "time": time}
+        content = self._do_read(
+            "GET", "api/v1/query", self._read_body, params=params, stream=self.response_limits is not None
+        )
+        data = self._decode_json(content)
+        self._validate_response_data(data)
+        return data["data"]["result"]
+
+    def _remote_read(self, matchers: Sequence[Matcher], start: int, end: int) -> List[Dict[str, Any]]:
+        assert self.connection_details.remote_read
+        streamed = self.connection_details.remote_read.streamed
+        body = snappy_compress(encode_read_request(start * 1000, end * 1000, matchers, streamed))
+
+        def read(response: requests.Response) -> List[Dict[str, Any]]:
+            with self._handle_failed_call(response):
+                chunks = response.iter_content(chunk_size=64 * 1024)
+                if self.response_limits:
+                    chunks = self.response_limits.read_chunks(chunks)
+                if response.headers.get("Content-Type", "").startswith("application/x-streamed-protobuf"):
+                    # frames are decoded as they arrive instead of buffering the whole response
+                    return decode_chunked_response(chunks, start * 1000, end * 1000)
+                return decode_read_response(b"".join(chunks))
+
+        path = self.connection_details.remote_read.path
+        series = self._do_read("POST", path, read, data=body, headers=REQUEST_HEADERS, stream=True)
+        if self.response_limits:
+            self.response_limits.check_series(series)
+        return series
+
+    def _read_body(self, response: requests.Response) -> bytes:
+        response = self._handle_failed_call(response)
+        return self.response_limits.read(response) if self.response_limits else response.content
 
-    def _validate_metric_data(self, query, data: Dict[str, Any]):
+    @staticmethod
+    def _decode_json(content: bytes) -> Dict[str, Any]:
+        # large sample responses are decoded off the request thread
+        return Offloader.get_instance().run(len(content), json.loads, content)
+
+    @staticmethod
+    def _validate_response_data(data: Dict[str, Any]):
         if "status" in data and data["status"] == "error":
             raise PrometheusException(str(data))
 
         if "data" not in data or "result" not in data["data"]:
             raise InvalidPrometheusDataException(str(data))
 
+    def _validate_metric_data(self, query, data: Dict[str, Any]):
+        self._validate_response_data(data)
+
         if len(data["data"]["result"]) > 1:
             fields = self._compute_differentiating_fields(data["data"]["result"])
             raise TooManyMetricsException(fields)
@@ -185,20 +661,92 @@ class PrometheusClient:
 
         return res
 
-    def _do_get(self, resource_uri: str, params: Optional[Dict[str, Any]] = None) -> requests.Response:
+    def _do_get(
+        self, resource_uri: str, params: Optional[Dict[str, Any]] = None, hedge: bool = False
+    ) -> requests.Response:
+        return self._do_read("GET", resource_uri, lambda response: response, params=params, hedge=hedge)
+
+    def _do_read(
+        self,
+        method: str,
+        resource_uri: str,
+        read: Callable[[requests.Response], T],
+        params: Optional[Dict[str, Any]] = None,
+        data: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+        hedge: bool = False,
+        stream: bool = False,
+    ) -> T:
+        # `read` turns the response into the result while the call still holds its bulkhead slot, so that the slot
+        # covers the download of streamed bodies too
         if params is None:
             params = {}
         uri = f"{self.url}/{resource_uri}"
+
+        def send() -> requests.Response:
+            return self._send(method, uri, params, data, headers, stream)
+
+        with self.bulkhead.admit():
+            self.throttle.budget.deposit()
+            attempt = 0
+            while True:
+                self.throttle.before_request()
+                if hedge and self.hedger:
+                    response = self.hedger.call(send, self.throttle.try_before_request, self.bulkhead)
+                else:
+                    response = send()
+                delay = self.throttle.retry_delay(attempt, response.status_code, response.headers.get("Retry-After"))
+                if delay is None:
+                    return read(response)
+                logger.warning(f"Retrying [{uri}] in {delay:.2f}s after status code {response.status_code}.")
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+
+    def _send(
+        self,
+        method: str,
+        uri: str,
+        params: Dict[str, Any],
+        data: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+        stream: bool = False,
+    ) -> requests.Response:
         if self.credentials:
-            response = self._signed_request(uri, method="GET", params=params)
+            return self._signed_request(uri, method=method, data=data, params=params, headers=headers, stream=stream)
+        return self.session.request(method=method, url=uri, params=params, data=data, headers=headers, stream=stream)
+
+    @staticmethod
+    def _cached(key: str, ttl_seconds: int, compute: Callable[[], Any]) -> Any:
+        if ttl_seconds <= 0:
+            return compute()
+        return get_cache().get_or_compute(key, ttl_seconds, compute)
+
+    @staticmethod
+    def _shared_credentials(aws: AwsConnectionDetails, refresh: bool = False) -> Optional["Credentials"]:
+        from botocore.credentials import Credentials
+
+        # assume_role once per node, all workers share the resulting session credentials
+        def assume_role():
+            frozen = PrometheusClient._init_credentials(aws)
+            return {"access_key": frozen.access_key, "secret_key": frozen.secret_key, "token": frozen.token}
+
+        key = "credentials:" + hashlib.sha256(aws.json(sort_keys=True).encode()).hexdigest()
+        ttl_seconds = max(aws.token_expiry_seconds - 10, 5)
+        if refresh:
+            shared = assume_role()
+            get_cache().set(key, shared, ttl_seconds)
         else:
-            response = requests.get(url=uri, params=params)
-        return response
+            shared = get_cache().get_or_compute(key, ttl_seconds, assume_role)
+        return Credentials(shared["access_key"], shared["secret_key"], shared["token"]).get_frozen_credentials()
 
     @staticmethod
-    def _init_credentials(aws: AwsConnectionDetails) -> Optional[Credentials]:
+    def _init_credentials(aws: AwsConnectionDetails) -> Optional["Credentials"]:
         if aws is None:
             return None
+        import boto3
+        from botocore.config import Config
+
         if aws.aws_secret_access_key and aws.aws_access_key_id and aws.aws_session_token:
             session = boto3.Session(
                 aws_access_key_id=aws.aws_access_key_id,
@@ -209,7 +757,7 @@ class PrometheusClient:
         if aws.aws_secret_access_key and aws.aws_access_key_id:
             sts_client = boto3.client(
                 "sts",
-                config=DEFAULT_BOTO3_CONFIG,
+                config=Config(retries=dict(max_attempts=DEFAULT_BOTO3_RETRIES_COUNT)),
                 aws_access_key_id=aws.aws_access_key_id,
                 aws_secret_access_key=aws.aws_secret_access_key,
             )
@@ -232,14 +780,18 @@ class PrometheusClient:
         self,
         url: str,
         method: str = "POST",
-        data: Optional[str] = None,
+        data: Optional[str | bytes] = None,
         params: Optional[Dict[str, Any]] = None,
         headers: Optional[Dict[str, str]] = None,
+        stream: bool = False,
     ) -> requests.Response:
-        request = AWSRequest(method=method, url=url, data=data, params=params, headers=headers)
-        SigV4Auth(self.credentials, self.service_name, self.region).add_auth(request)
+        if not self.signer:  # done because of mypy and the optional type
+            raise Exception("AWS credentials required")
+        signed_headers = self.signer.sign(method, url, params=params, data=data, headers=headers)
         try:
-            return requests.request(method=method, url=url, headers=dict(request.headers), data=data, params=params)
+            return self.session.request(
+                method=method, url=url, headers=signed_headers, data=data, params=params, stream=stream
+            )
         except Exception as e:
             raise e
 
@@ -257,13 +809,25 @@ class PrometheusClient:
 
 
 class PrometheusQuery:
-    def __init__(self, conditions: Sequence[Condition], aggregation_method: Optional[str], window: Optional[int]):
+    def __init__(
+        self,
+        conditions: Sequence[Condition],
+        aggregation_method: Optional[str],
+        window: Optional[int],
+        recording_rules: Optional[RecordingRules] = None,
+    ):
         self.conditions = conditions
         self.aggregation_method = aggregation_method
         self.window = window
+        self.recording_rules = recording_rules
         self.default_discretion_interval_seconds = "60"
 
     def to_prometheus(self) -> str:
+        query = self._compile()
+        # sub-expressions that recording rules already compute read the recorded series instead
+        return self.recording_rules.rewrite(query) if self.recording_rules else query
+
+    def _compile(self) -> str:
         request_type, name, conditions = self.extract_parameters_from_conditions(self.conditions)
         if request_type == "__gauge__":
             query = name + self.conditions_list_to_query(conditions)
@@ -298,6 +862,38 @@ class PrometheusQuery:
             raise RequiredFieldException(f"One of {reserved_types} is required")
         return query_element[0][0], query_element[0][1], conditions
 
+    def requires_single_series(self) -> bool:
+        # gauge aggregations other than event_count combine all matching series into one, the rest reject several
+        request_type, _, _ = self.extract_parameters_from_conditions(self.conditions)
+        if request_type == "__counter__":
+            return True
+        return request_type == "__gauge__" and self.aggregation_method in (None, "event_count")
+
+    def to_selector(self) -> Tuple[str, str]:
+        request_type, name, conditions = self.extract_parameters_from_conditions(self.conditions)
+        return request_type, name + self.conditions_list_to_query(conditions)
+
+    def to_remote_read_matchers(self) -> Optional[List[Matcher]]:
+        # only plain gauge selectors map onto label matchers, everything else needs PromQL evaluation
+        request_type, name, conditions = self.extract_parameters_from_conditions(self.conditions)
+        if request_type != "__gauge__" or self.aggregation_method is not None:
+            return None
+        matchers: List[Matcher] = [(MATCH_EQUAL, "__name__", name)]
+        for condition in conditions:
+            value = condition.value
+            if value.type_descriptor == "InSetValue":
+                # same alternation as _value_to_prometheus, without the PromQL string escaping
+                or_regexp = "|".join(
+                    "(" + self.escape_regexp_token(str(item)).replace("\\\\", "\\") + ")"
+                    for item in sorted(value.value)
+                )
+                matchers.append((MATCH_REGEXP, condition.key, or_regexp))
+            elif value.type_descriptor == "BooleanValue":
+                matchers.append((MATCH_EQUAL, condition.key, str(value.value).lower()))
+            else:
+                matchers.append((MATCH_EQUAL, condition.key, str(value.value)))
+        return matchers
+
     def counter_aggregation(self, sts_aggregation: str, window: Optional[int]) -> Optional[Tuple[str, str]]:
         window_str = "" if window is None else str(int(window))
         # TO DO step greater then window
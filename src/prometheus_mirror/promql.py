@@ -0,0 +1,502 @@
+import math
+import re
+from threading import Lock
+from typing import List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from cachetools import LRUCache
+
+# PromQL parser producing a canonical text form of an expression, used as the key of the caches and single-flight
+# groups in front of Prometheus. The expression itself is still sent upstream as written. Only rewrites that keep the
+# meaning are applied: whitespace, comments and redundant parentheses are dropped, keywords and aggregation operators
+# are lowercased, strings are double quoted, label matchers and grouping labels are sorted and de-duplicated,
+# `by`/`without` clauses are put in front of the arguments, durations and numbers are written in one way and no-op
+# modifiers (`by ()`, `ignoring ()`, `offset 0s`) are removed. Operands are never reordered, `a + b` and `b + a`
+# label their results differently.
+
+lock = Lock()
+
+# canonical form by expression, StackState polls the same few hundred expressions over and over
+canonical_forms: LRUCache = LRUCache(maxsize=4096)
+
+AGGREGATORS = {"sum", "avg", "count", "min", "max", "group", "stddev", "stdvar", "topk", "bottomk", "count_values"}
+AGGREGATORS |= {"quantile", "limitk", "limit_ratio"}
+PARAMETER_AGGREGATORS = {"topk", "bottomk", "count_values", "quantile", "limitk", "limit_ratio"}
+KEYWORDS = {"and", "or", "unless", "atan2", "by", "without", "on", "ignoring", "group_left", "group_right", "bool"}
+KEYWORDS |= {"offset", "start", "end"}
+
+# binary operators by precedence, `^` is the only right associative one; unary operators bind like `*`
+PRECEDENCE = {"or": 1, "and": 2, "unless": 2, "==": 3, "!=": 3, "<=": 3, "<": 3, ">=": 3, ">": 3, "+": 4, "-": 4}
+PRECEDENCE |= {"*": 5, "/": 5, "%": 5, "atan2": 5, "^": 6}
+COMPARISONS = {"==", "!=", "<=", "<", ">=", ">"}
+UNARY = 5
+POW = 6
+ATOM = 7
+
+DURATION_UNITS = [("y", 365 * 86_400_000), ("w", 7 * 86_400_000), ("d", 86_400_000), ("h", 3_600_000)]
+DURATION_UNITS += [("m", 60_000), ("s", 1000), ("ms", 1)]
+UNIT_MILLIS = dict(DURATION_UNITS)
+
+TOKEN = re.compile(
+    r"""(?P<space>\s+|\#[^\n]*)
+    |(?P<duration>(?:\d+(?:ms|[smhdwy]))+)(?!\w)
+    |(?P<number>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    |(?P<identifier>[a-zA-Z_][a-zA-Z0-9_:]*)
+    |(?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|`[^`]*`)
+    |(?P<operator>=~|!~|==|!=|<=|>=|[-+*/%^<>=(){}\[\],:@])""",
+    re.VERBOSE,
+)
+DURATION_PART = re.compile(r"(\d+)(ms|[smhdwy])")
+METRIC_NAME = re.compile(r"[a-zA-Z_:][a-zA-Z0-9_:]*")
+ESCAPE = re.compile(r"\\(?:([abfnrtv\\'\"])|x([0-9a-fA-F]{2})|([0-7]{3})|u([0-9a-fA-F]{4})|U([0-9a-fA-F]{8}))")
+ESCAPED_CHARACTERS = {"a": "\a", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+
+Matcher = Tuple[str, str, str]
+
+
+class PromQLSyntaxError(Exception):
+    pass
+
+
+class Number(NamedTuple):
+    value: float
+
+
+class String(NamedTuple):
+    value: str
+
+
+class Selector(NamedTuple):
+    name: Optional[str]
+    matchers: Tuple[Matcher, ...]
+    range_millis: Optional[int] = None
+    offset_millis: Optional[int] = None
+    at: Optional[str] = None
+
+
+class Call(NamedTuple):
+    function: str
+    args: Tuple["Node", ...]
+
+
+class Aggregation(NamedTuple):
+    operator: str
+    parameter: Optional["Node"]
+    expression: "Node"
+    without: bool
+    labels: Tuple[str, ...]
+
+
+class Unary(NamedTuple):
+    operator: str
+    expression: "Node"
+
+
+class Binary(NamedTuple):
+    operator: str
+    left: "Node"
+    right: "Node"
+    return_bool: bool = False
+    matching: Optional[Tuple[str, Tuple[str, ...]]] = None
+    group: Optional[Tuple[str, Tuple[str, ...]]] = None
+
+
+class Subquery(NamedTuple):
+    expression: "Node"
+    range_millis: int
+    step_millis: Optional[int]
+    offset_millis: Optional[int] = None
+    at: Optional[str] = None
+
+
+Node = Union[Number, String, Selector, Call, Aggregation, Unary, Binary, Subquery]
+
+
+def canonicalize(expression: str) -> str:
+    # Canonical form of the expression, or the expression itself when it is not valid PromQL to this parser.
+    with lock:
+        canonical = canonical_forms.get(expression)
+    if canonical is None:
+        try:
+            canonical = format_node(parse(expression))
+        except PromQLSyntaxError:
+            canonical = expression
+        with lock:
+            canonical_forms[expression] = canonical
+    return canonical
+
+
+def parse(expression: str) -> Node:
+    return _Parser(expression).parse()
+
+
+def make_selector(name: Optional[str], matchers: Sequence[Matcher]) -> Selector:
+    # the selector in canonical form: matchers sorted and unique, a single __name__ equality written as the name
+    unique = sorted(set(matchers) | ({("__name__", "=", name)} if name is not None else set()))
+    names = [matcher for matcher in unique if matcher[0] == "__name__"]
+    if len(names) == 1 and names[0][1] == "=" and _bare_metric_name(names[0][2]):
+        unique.remove(names[0])
+        return Selector(names[0][2], tuple(unique))
+    return Selector(None, tuple(unique))
+
+
+def parse_duration(text: str) -> int:
+    return sum(int(amount) * UNIT_MILLIS[unit] for amount, unit in DURATION_PART.findall(text))
+
+
+def format_duration(millis: int) -> str:
+    if millis == 0:
+        return "0s"
+    parts = []
+    for unit, unit_millis in DURATION_UNITS:
+        if millis >= unit_millis:
+            parts.append(f"{millis // unit_millis}{unit}")
+            millis %= unit_millis
+    return "".join(parts)
+
+
+def format_number(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "Inf" if value > 0 else "-Inf"
+    if value == 0:
+        return "-0" if math.copysign(1, value) < 0 else "0"
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def format_string(value: str) -> str:
+    escaped = []
+    for character in value:
+        if character in ('"', "\\"):
+            escaped.append("\\" + character)
+        elif character == "\n":
+            escaped.append("\\n")
+        elif character == "\t":
+            escaped.append("\\t")
+        elif character == "\r":
+            escaped.append("\\r")
+        elif ord(character) < 0x20 or ord(character) == 0x7F:
+            escaped.append(f"\\u{ord(character):04x}")
+        else:
+            escaped.append(character)
+    return '"' + "".join(escaped) + '"'
+
+
+def format_node(node: Node) -> str:
+    if isinstance(node, Number):
+        return format_number(node.value)
+    if isinstance(node, String):
+        return format_string(node.value)
+    if isinstance(node, Selector):
+        text = node.name or ""
+        if node.matchers or not node.name:
+            text += "{" + ", ".join(f"{label}{op}{format_string(value)}" for label, op, value in node.matchers) + "}"
+        if node.range_millis is not None:
+            text += f"[{format_duration(node.range_millis)}]"
+        return text + _format_modifiers(node.offset_millis, node.at)
+    if isinstance(node, Call):
+        return node.function + "(" + ", ".join(format_node(arg) for arg in node.args) + ")"
+    if isinstance(node, Aggregation):
+        text = node.operator
+        if node.without or node.labels:
+            text += f" {'without' if node.without else 'by'} ({', '.join(node.labels)}) "
+        args = [node.expression] if node.parameter is None else [node.parameter, node.expression]
+        return text + "(" + ", ".join(format_node(arg) for arg in args) + ")"
+    if isinstance(node, Unary):
+        return node.operator + _format_operand(node.expression, _precedence(node.expression) < POW)
+    if isinstance(node, Binary):
+        precedence = PRECEDENCE[node.operator]
+        left, right = _precedence(node.left), _precedence(node.right)
+        right_associative = node.operator == "^"
+        text = _format_operand(node.left, left < precedence or (right_associative and left == precedence))
+        text += " " + node.operator
+        if node.return_bool:
+            text += " bool"
+        if node.matching:
+            text += f" {node.matching[0]}({', '.join(node.matching[1])})"
+        if node.group:
+            text += f" {node.group[0]}({', '.join(node.group[1])})"
+        return (
+            text
+            + " "
+            + _format_operand(node.right, right < precedence or (not right_associative and right == precedence))
+        )
+    step = format_duration(node.step_millis) if node.step_millis is not None else ""
+    text = _format_operand(node.expression, _precedence(node.expression) < ATOM)
+    return text + f"[{format_duration(node.range_millis)}:{step}]" + _format_modifiers(node.offset_millis, node.at)
+
+
+def _format_operand(node: Node, parenthesize: bool) -> str:
+    return f"({format_node(node)})" if parenthesize else format_node(node)
+
+
+def _format_modifiers(offset_millis: Optional[int], at: Optional[str]) -> str:
+    text = ""
+    if offset_millis:
+        text += " offset " + (
+            "-" + format_duration(-offset_millis) if offset_millis < 0 else format_duration(offset_millis)
+        )
+    if at is not None:
+        text += " @ " + at
+    return text
+
+
+def _precedence(node: Node) -> int:
+    if isinstance(node, Binary):
+        return PRECEDENCE[node.operator]
+    if isinstance(node, Unary):
+        return UNARY
+    if isinstance(node, Number) and not math.isnan(node.value) and math.copysign(1, node.value) < 0:
+        # written with a sign, like a unary minus: -1, -Inf
+        return UNARY
+    return ATOM
+
+
+class _Parser:
+    def __init__(self, expression: str):
+        self.tokens: List[Tuple[str, str]] = []
+        position = 0
+        while position < len(expression):
+            match = TOKEN.match(expression, position)
+            if not match:
+                raise PromQLSyntaxError(f"unexpected character {expression[position]!r} at {position}")
+            position = match.end()
+            kind = match.lastgroup or ""
+            if kind != "space":
+                self.tokens.append((kind, match.group()))
+        self.position = 0
+
+    def parse(self) -> Node:
+        node = self.expression(0)
+        if self.position != len(self.tokens):
+            raise PromQLSyntaxError(f"unexpected {self.peek()[1]!r}")
+        return node
+
+    # tokens
+
+    def peek(self, ahead: int = 0) -> Tuple[str, str]:
+        if self.position + ahead < len(self.tokens):
+            return self.tokens[self.position + ahead]
+        return ("end", "")
+
+    def next(self) -> Tuple[str, str]:
+        token = self.peek()
+        if token[0] == "end":
+            raise PromQLSyntaxError("unexpected end of expression")
+        self.position += 1
+        return token
+
+    def accept(self, text: str) -> bool:
+        if self.peek()[1] == text and self.peek()[0] == "operator":
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, text: str):
+        if not self.accept(text):
+            raise PromQLSyntaxError(f"expected {text!r}, got {self.peek()[1]!r}")
+
+    def keyword(self, ahead: int = 0) -> Optional[str]:
+        kind, text = self.peek(ahead)
+        return text.lower() if kind == "identifier" else None
+
+    # expressions
+
+    def expression(self, minimum_precedence: int) -> Node:
+        left = self.unary()
+        while True:
+            kind, text = self.peek()
+            operator = text.lower() if kind == "identifier" else text
+            precedence = PRECEDENCE.get(operator) if kind in ("identifier", "operator") else None
+            if precedence is None or precedence < minimum_precedence:
+                return left
+            self.position += 1
+            return_bool = False
+            if operator in COMPARISONS and self.keyword() == "bool":
+                self.position += 1
+                return_bool = True
+            matching = group = None
+            if self.keyword() in ("on", "ignoring"):
+                matching = (self.next()[1].lower(), self.label_list())
+                if self.keyword() in ("group_left", "group_right"):
+                    group_kind = self.next()[1].lower()
+                    group = (group_kind, self.label_list() if self.peek()[1] == "(" else ())
+            if matching == ("ignoring", ()) and group is None:
+                matching = None  # the default matching of vector operands
+            right = self.expression(precedence if operator == "^" else precedence + 1)
+            left = Binary(operator, left, right, return_bool, matching, group)
+
+    def unary(self) -> Node:
+        if self.peek() in (("operator", "-"), ("operator", "+")):
+            operator = self.next()[1]
+            operand = self.expression(POW)
+            if isinstance(operand, Number):
+                return Number(-operand.value) if operator == "-" else operand
+            return Unary(operator, operand)
+        return self.postfix(self.atom())
+
+    def postfix(self, node: Node) -> Node:
+        while True:
+            if self.accept("["):
+                range_millis = self.duration()
+                if self.accept(":"):
+                    step_millis = self.duration() if self.peek()[0] == "duration" else None
+                    self.expect("]")
+                    node = Subquery(node, range_millis, step_millis)
+                    continue
+                self.expect("]")
+                if not isinstance(node, Selector) or node.range_millis is not None or node.offset_millis is not None:
+                    raise PromQLSyntaxError("ranges are only allowed on instant vector selectors")
+                if node.at is not None:
+                    raise PromQLSyntaxError("ranges are only allowed on instant vector selectors")
+                node = node._replace(range_millis=range_millis)
+            elif self.keyword() == "offset":
+                self.position += 1
+                if not isinstance(node, (Selector, Subquery)) or node.offset_millis is not None:
+                    raise PromQLSyntaxError("offset needs a selector or subquery")
+                sign = -1 if self.accept("-") else 1
+                node = node._replace(offset_millis=sign * self.duration() or None)
+            elif self.accept("@"):
+                if not isinstance(node, (Selector, Subquery)) or node.at is not None:
+                    raise PromQLSyntaxError("@ needs a selector or subquery")
+                node = node._replace(at=self.at())
+            else:
+                return node
+
+    def at(self) -> str:
+        if self.keyword() in ("start", "end") and self.peek(1)[1] == "(":
+            function = self.next()[1].lower()
+            self.expect("(")
+            self.expect(")")
+            return function + "()"
+        sign = -1 if self.accept("-") else 1
+        if sign == 1:
+            self.accept("+")
+        kind, text = self.next()
+        if kind != "number":
+            raise PromQLSyntaxError(f"expected a timestamp after @, got {text!r}")
+        # Prometheus evaluates at millisecond precision
+        return format_number(round(sign * self.number(text) * 1000) / 1000)
+
+    def duration(self) -> int:
+        kind, text = self.next()
+        if kind != "duration":
+            raise PromQLSyntaxError(f"expected a duration, got {text!r}")
+        return parse_duration(text)
+
+    def atom(self) -> Node:
+        kind, text = self.next()
+        if kind == "number":
+            return Number(self.number(text))
+        if kind == "string":
+            return String(self.string(text))
+        if kind == "operator" and text == "(":
+            node = self.expression(0)
+            self.expect(")")
+            return node
+        if kind == "operator" and text == "{":
+            return self.selector(None)
+        if kind != "identifier":
+            raise PromQLSyntaxError(f"unexpected {text!r}")
+        lowered = text.lower()
+        if lowered in ("inf", "nan"):
+            return Number(float(lowered))
+        if lowered in AGGREGATORS:
+            return self.aggregation(lowered)
+        if lowered in KEYWORDS:
+            raise PromQLSyntaxError(f"unexpected keyword {text!r}")
+        if self.accept("("):
+            args: List[Node] = []
+            if not self.accept(")"):
+                args.append(self.expression(0))
+                while self.accept(","):
+                    args.append(self.expression(0))
+                self.expect(")")
+            return Call(text, tuple(args))
+        return self.selector(text) if self.accept("{") else make_selector(text, [])
+
+    def aggregation(self, operator: str) -> Node:
+        grouping = self.grouping()
+        self.expect("(")
+        args = [self.expression(0)]
+        while self.accept(","):
+            args.append(self.expression(0))
+        self.expect(")")
+        if (operator in PARAMETER_AGGREGATORS) != (len(args) == 2) or len(args) > 2:
+            raise PromQLSyntaxError(f"wrong number of arguments for {operator}")
+        if grouping is None:
+            grouping = self.grouping()
+        without, labels = grouping or (False, ())
+        parameter = args[0] if len(args) == 2 else None
+        return Aggregation(operator, parameter, args[-1], without, labels)
+
+    def grouping(self) -> Optional[Tuple[bool, Tuple[str, ...]]]:
+        if self.keyword() not in ("by", "without"):
+            return None
+        without = self.next()[1].lower() == "without"
+        return without, self.label_list()
+
+    def label_list(self) -> Tuple[str, ...]:
+        self.expect("(")
+        labels = set()
+        while not self.accept(")"):
+            kind, label = self.next()
+            if kind != "identifier" or ":" in label:
+                raise PromQLSyntaxError(f"expected a label name, got {label!r}")
+            labels.add(label)
+            if not self.accept(","):
+                self.expect(")")
+                break
+        return tuple(sorted(labels))
+
+    def selector(self, name: Optional[str]) -> Node:
+        matchers: List[Matcher] = []
+        while not self.accept("}"):
+            kind, label = self.next()
+            if kind != "identifier" or ":" in label:
+                raise PromQLSyntaxError(f"expected a label name, got {label!r}")
+            op_kind, op = self.next()
+            if op_kind != "operator" or op not in ("=", "!=", "=~", "!~"):
+                raise PromQLSyntaxError(f"expected a label matcher, got {op!r}")
+            value_kind, value = self.next()
+            if value_kind != "string":
+                raise PromQLSyntaxError(f"expected a string, got {value!r}")
+            matchers.append((label, op, self.string(value)))
+            if not self.accept(","):
+                self.expect("}")
+                break
+        return make_selector(name, matchers)
+
+    @staticmethod
+    def number(text: str) -> float:
+        if text[:2].lower() == "0x":
+            return float(int(text, 16))
+        return float(text)
+
+    @staticmethod
+    def string(text: str) -> str:
+        if text[0] == "`":
+            return text[1:-1]
+
+        def unescape(match: "re.Match[str]") -> str:
+            simple, hexadecimal, octal, short, long = match.groups()
+            if simple:
+                return ESCAPED_CHARACTERS.get(simple, simple)
+            code = int(octal, 8) if octal else int(hexadecimal or short or long, 16)
+            if (hexadecimal or octal) and code > 0x7F:
+                raise PromQLSyntaxError("byte escapes outside ASCII are not supported")
+            return chr(code)
+
+        body = text[1:-1]
+        unescaped = ESCAPE.sub(unescape, body)
+        if "\\" in ESCAPE.sub("", body):
+            raise PromQLSyntaxError(f"invalid escape in {text}")
+        return unescaped
+
+
+def _bare_metric_name(name: str) -> bool:
+    # names that would read as a keyword or number are only expressible as a __name__ matcher
+    lowered = name.lower()
+    return bool(METRIC_NAME.fullmatch(name)) and lowered not in AGGREGATORS | KEYWORDS | {"inf", "nan"}
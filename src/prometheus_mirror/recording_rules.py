@@ -0,0 +1,286 @@
+import json
+import logging
+import time
+from collections import defaultdict
+from threading import Lock
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from cachetools import LRUCache
+
+from prometheus_mirror.model import ConnectionDetails, RecordingRulesDetails
+from prometheus_mirror.promql import (
+    COMPARISONS,
+    Aggregation,
+    Binary,
+    Call,
+    Matcher,
+    Node,
+    PromQLSyntaxError,
+    Selector,
+    String,
+    Subquery,
+    Unary,
+    format_node,
+    make_selector,
+    parse,
+)
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+SET_OPERATORS = {"and", "or", "unless"}
+# aggregations that return input series, with their metric name
+SELECTING_AGGREGATORS = {"topk", "bottomk", "limitk", "limit_ratio"}
+# functions that keep the metric name of their input
+KEEPS_NAME = {"label_replace", "label_join", "sort", "sort_desc", "sort_by_label", "sort_by_label_desc"}
+KEEPS_NAME |= {"last_over_time", "first_over_time"}
+# functions of one vector whose output series carry the labels of their input series
+KEEPS_LABELS = {"rate", "irate", "increase", "delta", "idelta", "deriv", "predict_linear", "resets", "changes"}
+KEEPS_LABELS |= {"abs", "ceil", "floor", "round", "sqrt", "exp", "ln", "log2", "log10", "sgn", "timestamp"}
+KEEPS_LABELS |= {"clamp", "clamp_min", "clamp_max"}
+KEEPS_LABELS |= {f"{name}_over_time" for name in ("avg", "min", "max", "sum", "count", "quantile", "stddev")}
+KEEPS_LABELS |= {f"{name}_over_time" for name in ("stdvar", "last", "present", "mad")}
+
+
+class RecordingRule(NamedTuple):
+    record: str
+    # the expression without the label matchers of its selectors, and those matchers selector by selector
+    skeleton: str
+    matchers: Tuple[Tuple[Matcher, ...], ...]
+    # labels of the recorded series that come unchanged from the selector's series, None for all of them
+    kept_labels: Optional[Set[str]]
+
+
+class RecordingRules:
+    # Catalogue of the recording rules of a datasource. Sub-expressions of a query that a rule records are replaced
+    # by the recorded series, so Prometheus reads pre-aggregated samples instead of evaluating the expression.
+    # A sub-expression with more label matchers than the rule is still replaced when the extra matchers are on labels
+    # the rule's result keeps: filtering the result on them is the same as filtering the input. Sub-expressions are
+    # only replaced where the metric name of the recorded series cannot show in the result of the query.
+    INSTANCES: Dict[str, "RecordingRules"] = {}
+
+    def __init__(self, name: str, config: RecordingRulesDetails):
+        self.name = name
+        self.config = config
+        self._lock = Lock()
+        self._rules: Dict[str, List[RecordingRule]] = {}
+        self._rule_count = 0
+        self._loaded_at: Optional[float] = None
+        self._loading = False
+        # rewritten expression and the records used by expression
+        self._rewrites: LRUCache = LRUCache(maxsize=1024)
+        self.rewrites: Dict[str, int] = defaultdict(int)
+        self.queries = 0
+        self.load_failures = 0
+
+    @staticmethod
+    def get_instance(config: ConnectionDetails) -> Optional["RecordingRules"]:
+        if config.recording_rules is None:
+            RecordingRules.INSTANCES.pop(config.url, None)
+            return None
+        rules = RecordingRules.INSTANCES.get(config.url, None)
+        if rules is None or rules.config != config.recording_rules:
+            with lock:
+                rules = RecordingRules.INSTANCES.get(config.url, None)
+                if rules is None or rules.config != config.recording_rules:
+                    rules = RecordingRules(config.url, config.recording_rules.copy())
+                    RecordingRules.INSTANCES[config.url] = rules
+        return rules
+
+    @staticmethod
+    def stats() -> Dict[str, Dict[str, Any]]:
+        return {name: rules.snapshot() for name, rules in list(RecordingRules.INSTANCES.items())}
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "rules": self._rule_count,
+                "queries": self.queries,
+                "rewrites": dict(self.rewrites),
+                "load_failures": self.load_failures,
+            }
+
+    def refresh(self, load: Callable[[], Dict[str, Any]]):
+        # reloads the catalogue every refresh_seconds; while one request reloads it the others use the old one
+        with self._lock:
+            due = self._loaded_at is None or time.monotonic() - self._loaded_at >= self.config.refresh_seconds
+            if not due or self._loading:
+                return
+            self._loading = True
+        rules = None
+        try:
+            rules = self.compile(load())
+        except Exception as e:
+            logger.warning(f"Could not load the recording rules of {self.name}: {e}")
+        with self._lock:
+            self._loading = False
+            self._loaded_at = time.monotonic()
+            if rules is None:
+                self.load_failures += 1
+            else:
+                self._rules, self._rule_count = rules
+                self._rewrites.clear()
+
+    @staticmethod
+    def compile(data: Dict[str, Any]) -> Tuple[Dict[str, List[RecordingRule]], int]:
+        # Accepts the data of the rules API (name, query) and rule files in JSON (record, expr).
+        parsed: Dict[str, List[Optional[Node]]] = defaultdict(list)
+        for group in data.get("groups", []):
+            for rule in group.get("rules", []):
+                record = rule.get("record") or (rule.get("name") if rule.get("type") == "recording" else None)
+                expression = rule.get("expr") or rule.get("query")
+                if not record or not expression:
+                    continue
+                if rule.get("labels"):
+                    # the recorded series carry labels the expression's series lack, which would change how they
+                    # match in the query
+                    parsed[record].append(None)
+                    continue
+                try:
+                    tree = parse(str(expression))
+                except PromQLSyntaxError as e:
+                    logger.warning(f"Skipping recording rule {record}: {e}")
+                    continue
+                parsed[record].append(tree)
+
+        catalogue: Dict[str, List[RecordingRule]] = defaultdict(list)
+        count = 0
+        for record, trees in parsed.items():
+            recorded = trees[0]
+            if len(trees) > 1 or recorded is None:
+                # series recorded under this name by several rules cannot be told apart
+                continue
+            skeleton, matchers = _strip_matchers(recorded)
+            if isinstance(skeleton, Selector):
+                continue
+            catalogue[format_node(skeleton)].append(
+                RecordingRule(record, format_node(skeleton), tuple(matchers), _kept_labels(recorded))
+            )
+            count += 1
+        return dict(catalogue), count
+
+    def rewrite(self, expression: str) -> str:
+        with self._lock:
+            self.queries += 1
+            cached = self._rewrites.get(expression)
+            rules = self._rules
+        if cached is None:
+            cached = self._rewrite(expression, rules)
+            with self._lock:
+                self._rewrites[expression] = cached
+        rewritten, records = cached
+        if records:
+            logger.debug(f"Recording rules {', '.join(records)} used for {expression}")
+            with self._lock:
+                for record in records:
+                    self.rewrites[record] += 1
+        return rewritten
+
+    @staticmethod
+    def _rewrite(expression: str, rules: Dict[str, List[RecordingRule]]) -> Tuple[str, Tuple[str, ...]]:
+        if not rules:
+            return expression, ()
+        try:
+            tree = parse(expression)
+        except PromQLSyntaxError:
+            return expression, ()
+        records: List[str] = []
+        rewritten = _substitute(tree, False, rules, records)
+        if not records:
+            # sent as written
+            return expression, ()
+        return format_node(rewritten), tuple(records)
+
+
+def _substitute(node: Node, name_shows: bool, rules: Dict[str, List[RecordingRule]], records: List[str]) -> Node:
+    # `name_shows` tells whether the metric name of this node's series can end up in the query result or decide
+    # how series are matched; the recorded series have a name where the expression they replace has none
+    if not name_shows and isinstance(node, (Call, Aggregation, Binary, Subquery, Unary)):
+        replacement = _match(node, rules)
+        if replacement is not None:
+            records.append(replacement.name or "")
+            return replacement
+    if isinstance(node, Aggregation):
+        shows = name_shows if node.operator in SELECTING_AGGREGATORS else not node.without and "__name__" in node.labels
+        return node._replace(expression=_substitute(node.expression, shows, rules, records))
+    if isinstance(node, Call):
+        shows = name_shows and node.function in KEEPS_NAME
+        if node.function in ("label_replace", "label_join"):
+            # the name can be copied into another label
+            shows = shows or any(isinstance(arg, String) and arg.value == "__name__" for arg in node.args)
+        return node._replace(args=tuple(_substitute(arg, shows, rules, records) for arg in node.args))
+    if isinstance(node, Unary):
+        return node._replace(
+            expression=_substitute(node.expression, name_shows and node.operator == "+", rules, records)
+        )
+    if isinstance(node, Subquery):
+        return node._replace(expression=_substitute(node.expression, name_shows, rules, records))
+    if isinstance(node, Binary):
+        matched_on_name = any("__name__" in labels for _, labels in filter(None, (node.matching, node.group)))
+        filtering = node.operator in SET_OPERATORS or (node.operator in COMPARISONS and not node.return_bool)
+        if node.group is not None and filtering:
+            left = right = True  # which side's series are returned depends on the grouping, leave both alone
+        else:
+            left = matched_on_name or (filtering and name_shows)
+            right = matched_on_name or (node.operator == "or" and name_shows)
+        return node._replace(
+            left=_substitute(node.left, left, rules, records), right=_substitute(node.right, right, rules, records)
+        )
+    return node
+
+
+def _match(node: Node, rules: Dict[str, List[RecordingRule]]) -> Optional[Selector]:
+    skeleton, matchers = _strip_matchers(node)
+    for rule in rules.get(format_node(skeleton), []):
+        if tuple(matchers) == rule.matchers:
+            extra: Set[Matcher] = set()
+        elif len(matchers) == 1 and len(rule.matchers) == 1 and set(rule.matchers[0]) <= set(matchers[0]):
+            extra = set(matchers[0]) - set(rule.matchers[0])
+            if rule.kept_labels is not None and any(label not in rule.kept_labels for label, _, _ in extra):
+                continue
+        else:
+            continue
+        return make_selector(rule.record, list(extra))
+    return None
+
+
+def _strip_matchers(node: Node) -> Tuple[Node, List[Tuple[Matcher, ...]]]:
+    matchers: List[Tuple[Matcher, ...]] = []
+
+    def strip(node: Node) -> Node:
+        if isinstance(node, Selector):
+            matchers.append(tuple(matcher for matcher in node.matchers if matcher[0] != "__name__"))
+            return node._replace(matchers=tuple(matcher for matcher in node.matchers if matcher[0] == "__name__"))
+        if isinstance(node, Aggregation):
+            return node._replace(expression=strip(node.expression))
+        if isinstance(node, Call):
+            return node._replace(args=tuple(strip(arg) for arg in node.args))
+        if isinstance(node, (Unary, Subquery)):
+            return node._replace(expression=strip(node.expression))
+        if isinstance(node, Binary):
+            return node._replace(left=strip(node.left), right=strip(node.right))
+        return node
+
+    return strip(node), matchers
+
+
+def _kept_labels(node: Node) -> Optional[Set[str]]:
+    if isinstance(node, Selector):
+        return None
+    if isinstance(node, (Unary, Subquery)):
+        return _kept_labels(node.expression)
+    if isinstance(node, Call) and node.function in KEEPS_LABELS:
+        vectors = [arg for arg in node.args if isinstance(arg, (Selector, Call, Aggregation, Unary, Subquery, Binary))]
+        return _kept_labels(vectors[0]) if len(vectors) == 1 else set()
+    if isinstance(node, Aggregation) and not node.without:
+        kept = _kept_labels(node.expression)
+        return set(node.labels) if kept is None else set(node.labels) & kept
+    return set()
+
+
+def load_rules_file(path: str) -> Dict[str, Any]:
+    with open(path) as rules_file:
+        data = json.load(rules_file)
+    # the rules API wraps the groups in a data field
+    return data.get("data", data)
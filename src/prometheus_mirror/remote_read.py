@@ -0,0 +1,335 @@
+import logging
+import struct
+from array import array
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+# Prometheus remote read (prometheus/prompb) without a protobuf dependency: the handful of messages the mirror needs
+# are encoded and decoded by hand.
+
+MATCH_EQUAL = 0
+MATCH_NOT_EQUAL = 1
+MATCH_REGEXP = 2
+MATCH_NOT_REGEXP = 3
+
+RESPONSE_SAMPLES = 0
+RESPONSE_STREAMED_XOR_CHUNKS = 1
+
+CHUNK_ENCODING_XOR = 1
+
+STREAMED_CONTENT_TYPE = "application/x-streamed-protobuf; proto=prometheus.ChunkedReadResponse"
+REQUEST_HEADERS = {
+    "Content-Encoding": "snappy",
+    "Content-Type": "application/x-protobuf",
+    "X-Prometheus-Remote-Read-Version": "0.1.0",
+}
+
+MASKS = [(1 << size) - 1 for size in range(65)]
+MASK_64 = MASKS[64]
+# the most bits a sample of an XOR chunk takes: a 10 byte varint delta, or 4 + 64 bits of delta of delta, and then
+# 2 + 11 + 64 bits of value
+SAMPLE_BITS = 160
+# (prefix length, value bits) of a delta of delta by the next four bits: 0, 10, 110, 1110 or 1111
+DOD_PREFIXES = [(1, 0)] * 8 + [(2, 14)] * 4 + [(3, 17)] * 2 + [(4, 20), (4, 64)]
+WINDOW_BYTES = 24
+# the NaN Prometheus writes when a series disappears, see prometheus/model/value.StaleNaN
+STALE_NAN = 0x7FF0000000000002
+STALE_NAN_BYTES = struct.pack("<Q", STALE_NAN)
+DOUBLE = struct.Struct("<d")
+ZERO_BYTES = bytes(8)
+
+logger = logging.getLogger(__name__)
+
+Matcher = Tuple[int, str, str]
+# labels and values as in a query_range matrix, timestamps in (possibly fractional) seconds
+Series = Dict[str, Any]
+
+
+class RemoteReadException(Exception):
+    pass
+
+
+# protobuf wire format
+
+
+def encode_varint(value: int) -> bytes:
+    value &= (1 << 64) - 1
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decode_varint(data: bytes | bytearray, position: int) -> Tuple[int, int]:
+    if position < len(data) and data[position] < 0x80:
+        # field keys and most lengths fit in a byte
+        return data[position], position + 1
+    result = shift = 0
+    while True:
+        if position >= len(data):
+            raise RemoteReadException("truncated varint")
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+
+def encode_field(number: int, value: int | bytes | str | float, double: bool = False) -> bytes:
+    if double:
+        return encode_varint(number << 3 | 1) + struct.pack("<d", value)
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return encode_varint(number << 3 | 2) + encode_varint(len(value)) + value
+    return encode_varint(number << 3) + encode_varint(int(value))
+
+
+def iter_fields(data: bytes) -> Iterator[Tuple[int, int, Any]]:
+    position = 0
+    while position < len(data):
+        key, position = decode_varint(data, position)
+        number, wire_type = key >> 3, key & 0x7
+        value: Any
+        if wire_type == 0:
+            value, position = decode_varint(data, position)
+        elif wire_type == 1:
+            value, position = data[position : position + 8], position + 8
+        elif wire_type == 2:
+            length, position = decode_varint(data, position)
+            value, position = data[position : position + length], position + length
+        elif wire_type == 5:
+            value, position = data[position : position + 4], position + 4
+        else:
+            raise RemoteReadException(f"unsupported wire type {wire_type}")
+        yield number, wire_type, value
+
+
+def _int64(value: int) -> int:
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+# snappy block format and CRC-32C (Castagnoli), from the remote_read extra: both run over every byte of a response
+
+
+@lru_cache(maxsize=None)
+def codecs_available() -> bool:
+    try:
+        import cramjam  # noqa: F401 pylint: disable=unused-import
+        import google_crc32c  # noqa: F401 pylint: disable=unused-import
+    except ImportError:
+        logger.warning(
+            "remote read needs the remote_read extra, install aws-prometheus-mirror[remote_read]; "
+            "raw samples are read through query_range instead"
+        )
+        return False
+    return True
+
+
+def snappy_compress(data: bytes) -> bytes:
+    import cramjam
+
+    return bytes(cramjam.snappy.compress_raw(data))
+
+
+def snappy_decompress(data: bytes) -> bytes:
+    import cramjam
+
+    try:
+        return bytes(cramjam.snappy.decompress_raw(data))
+    except cramjam.DecompressionError as e:
+        raise RemoteReadException(f"corrupt snappy input: {e}")
+
+
+def crc32c(data: bytes) -> int:
+    import google_crc32c
+
+    return google_crc32c.value(data)
+
+
+# messages
+
+
+def encode_read_request(start_ms: int, end_ms: int, matchers: Sequence[Matcher], streamed: bool) -> bytes:
+    query = encode_field(1, start_ms) + encode_field(2, end_ms)
+    for match_type, name, value in matchers:
+        query += encode_field(3, encode_field(1, match_type) + encode_field(2, name) + encode_field(3, value))
+    request = encode_field(1, query)
+    if streamed:
+        request += encode_field(2, RESPONSE_STREAMED_XOR_CHUNKS)
+    request += encode_field(2, RESPONSE_SAMPLES)
+    return request
+
+
+def _decode_labels(data: bytes) -> Tuple[str, str]:
+    name = value = ""
+    for number, _, field in iter_fields(data):
+        if number == 1:
+            name = field.decode()
+        elif number == 2:
+            value = field.decode()
+    return name, value
+
+
+def decode_read_response(body: bytes) -> List[Series]:
+    series: List[Series] = []
+    for number, _, result in iter_fields(snappy_decompress(body)):
+        if number != 1:
+            continue
+        for result_number, _, timeseries in iter_fields(result):
+            if result_number != 1:
+                continue
+            labels: Dict[str, str] = {}
+            values: List[List[Any]] = []
+            for field_number, _, field in iter_fields(timeseries):
+                if field_number == 1:
+                    name, value = _decode_labels(field)
+                    labels[name] = value
+                elif field_number == 2:
+                    if field[:1] == b"\x09" and field[9:10] == b"\x10":
+                        # value then timestamp, both set: how Prometheus writes nearly every sample
+                        raw, timestamp = field[1:9], _int64(decode_varint(field, 10)[0])
+                    else:
+                        raw, timestamp = ZERO_BYTES, 0
+                        for sample_number, _, sample_field in iter_fields(field):
+                            if sample_number == 1:
+                                raw = sample_field
+                            elif sample_number == 2:
+                                timestamp = _int64(sample_field)
+                    if raw != STALE_NAN_BYTES:
+                        values.append(
+                            [timestamp // 1000 if timestamp % 1000 == 0 else timestamp / 1000.0, DOUBLE.unpack(raw)[0]]
+                        )
+            series.append({"metric": labels, "values": values})
+    return series
+
+
+def iter_frames(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        # frames are much smaller than the chunks read, drop the consumed ones once per chunk rather than per frame
+        position = 0
+        while True:
+            try:
+                length, start = decode_varint(buffer, position)
+            except RemoteReadException:
+                break  # length not complete yet
+            if len(buffer) < start + 4 + length:
+                break
+            checksum = struct.unpack_from(">I", buffer, start)[0]
+            frame = bytes(buffer[start + 4 : start + 4 + length])
+            if crc32c(frame) != checksum:
+                raise RemoteReadException("frame checksum mismatch")
+            position = start + 4 + length
+            yield frame
+        del buffer[:position]
+    if buffer:
+        raise RemoteReadException("truncated stream")
+
+
+def decode_chunked_response(chunks: Iterable[bytes], start_ms: int, end_ms: int) -> List[Series]:
+    merged: Dict[Tuple, Series] = {}
+    for frame in iter_frames(chunks):
+        for number, _, chunked_series in iter_fields(frame):
+            if number != 1:
+                continue
+            labels: Dict[str, str] = {}
+            values: List[List[Any]] = []
+            for field_number, _, field in iter_fields(chunked_series):
+                if field_number == 1:
+                    name, value = _decode_labels(field)
+                    labels[name] = value
+                elif field_number == 2:
+                    encoding, data = 0, b""
+                    for chunk_number, _, chunk_field in iter_fields(field):
+                        if chunk_number == 3:
+                            encoding = chunk_field
+                        elif chunk_number == 4:
+                            data = chunk_field
+                    if encoding != CHUNK_ENCODING_XOR:
+                        raise RemoteReadException(f"unsupported chunk encoding {encoding}")
+                    # chunks are sent whole, their first and last samples can be outside the requested range
+                    values.extend(
+                        [timestamp // 1000 if timestamp % 1000 == 0 else timestamp / 1000.0, value]
+                        for timestamp, value in decode_xor_chunk(data)
+                        if start_ms <= timestamp <= end_ms
+                    )
+            # a series spanning many chunks can be split over several frames
+            key = tuple(sorted(labels.items()))
+            merged.setdefault(key, {"metric": labels, "values": []})["values"].extend(values)
+    return list(merged.values())
+
+
+def decode_xor_chunk(data: bytes) -> List[Tuple[int, float]]:
+    # prometheus/tsdb/chunkenc XOR chunk: sample count, then a bit stream of timestamps and xor'ed values. The stream
+    # is read through a window of a few words, `left` counting its unread bits, and the values' bits are converted to
+    # floats all at once.
+    count = struct.unpack_from(">H", data, 0)[0]
+    if count == 0:
+        return []
+    stream = data[2:] + bytes(2 * WINDOW_BYTES)
+    window, left, offset = _refill(0, 0, stream, 0)
+    value, left = _read_uvarint(window, left)
+    timestamp = (value >> 1) ^ -(value & 1)
+    left -= 64
+    bits = (window >> left) & MASK_64
+    timestamps, words = [timestamp], [bits]
+    delta = leading = trailing = 0
+    for index in range(1, count):
+        if left < SAMPLE_BITS:
+            window, left, offset = _refill(window, left, stream, offset)
+        if index == 1:
+            delta, left = _read_uvarint(window, left)
+        else:
+            # delta of delta: '0', or up to four 1s closed by a 0, then as many bits as that prefix takes
+            prefix_bits, size = DOD_PREFIXES[(window >> (left - 4)) & 0xF]
+            left -= prefix_bits
+            if size:
+                left -= size
+                dod = (window >> left) & MASKS[size]
+                if size == 64:
+                    delta += _int64(dod)
+                else:
+                    delta += dod - (1 << size) if dod > (1 << (size - 1)) else dod
+        timestamp += delta
+        left -= 1
+        if (window >> left) & 1:
+            left -= 1
+            if (window >> left) & 1:
+                left -= 11
+                header = (window >> left) & 0x7FF
+                leading = header >> 6
+                trailing = 64 - leading - ((header & 0x3F) or 64)
+            size = 64 - leading - trailing
+            left -= size
+            bits ^= ((window >> left) & MASKS[size]) << trailing
+        timestamps.append(timestamp)
+        words.append(bits)
+    values = array("d", array("Q", words).tobytes())
+    if STALE_NAN in words:
+        # stale markers end a series in the TSDB, query_range leaves them out rather than returning NaN
+        return [(t, v) for t, v, word in zip(timestamps, values, words) if word != STALE_NAN]
+    return list(zip(timestamps, values))
+
+
+def _refill(window: int, left: int, stream: bytes, offset: int) -> Tuple[int, int, int]:
+    # keeps the unread bits and appends the next bytes of the stream, which is padded with zeros past its end
+    window = ((window & ((1 << left) - 1)) << (8 * WINDOW_BYTES)) | int.from_bytes(
+        stream[offset : offset + WINDOW_BYTES], "big"
+    )
+    return window, left + 8 * WINDOW_BYTES, offset + WINDOW_BYTES
+
+
+def _read_uvarint(window: int, left: int) -> Tuple[int, int]:
+    result = shift = 0
+    while True:
+        left -= 8
+        byte = (window >> left) & 0xFF
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, left
+        shift += 7
@@ -0,0 +1,123 @@
+import logging
+import re
+from threading import Lock
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import requests
+
+from prometheus_mirror.model import ConnectionDetails, ResponseLimitsDetails
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+CHUNK_BYTES = 64 * 1024
+
+BYTES = "bytes"
+SERIES = "series"
+SAMPLES = "samples"
+
+# Prometheus writes compact JSON. A quote inside a JSON string is escaped, so `"metric":` only occurs as the key of a
+# series, and `[<number>,"` starts a sample of `values` or `value`.
+SERIES_PATTERN = re.compile(rb'"metric":')
+SAMPLE_PATTERN = re.compile(rb'\[-?[0-9][0-9.eE+-]{0,30},"')
+# longer than any match, so matches cut by a chunk boundary are found in the next chunk
+OVERLAP_BYTES = 64
+
+
+class ResponseTooLargeException(Exception):
+    pass
+
+
+class ResponseLimits:
+    # Caps on the size of one upstream response of a datasource: bytes of the decoded body, series and samples.
+    # They are checked chunk by chunk while the body is read, so an ill-scoped query is aborted long before its
+    # response is held in memory, let alone decoded into Python objects.
+    INSTANCES: Dict[str, "ResponseLimits"] = {}
+
+    def __init__(self, name: str, config: ResponseLimitsDetails):
+        self.name = name
+        self.config = config
+        self._lock = Lock()
+        self.responses = 0
+        self.aborted = {BYTES: 0, SERIES: 0, SAMPLES: 0}
+
+    @staticmethod
+    def get_instance(config: ConnectionDetails) -> Optional["ResponseLimits"]:
+        if config.response_limits is None:
+            ResponseLimits.INSTANCES.pop(config.url, None)
+            return None
+        limits = ResponseLimits.INSTANCES.get(config.url, None)
+        if limits is None or limits.config != config.response_limits:
+            with lock:
+                limits = ResponseLimits.INSTANCES.get(config.url, None)
+                if limits is None or limits.config != config.response_limits:
+                    limits = ResponseLimits(config.url, config.response_limits.copy())
+                    ResponseLimits.INSTANCES[config.url] = limits
+        return limits
+
+    @staticmethod
+    def stats() -> Dict[str, Dict[str, Any]]:
+        return {name: limits.snapshot() for name, limits in list(ResponseLimits.INSTANCES.items())}
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"responses": self.responses, "aborted": dict(self.aborted)}
+
+    def read(self, response: requests.Response) -> bytes:
+        # the body of a query response, best requested with stream=True so it is only read as far as the limits allow
+        with self._lock:
+            self.responses += 1
+        counting = self.config.max_series is not None or self.config.max_samples is not None
+        scanner = Scanner() if counting else None
+        chunks: List[bytes] = []
+        size = 0
+        with response:
+            for chunk in response.iter_content(chunk_size=CHUNK_BYTES):
+                size += len(chunk)
+                self._check(BYTES, size, self.config.max_bytes)
+                if scanner is not None:
+                    scanner.feed(chunk)
+                    self._check(SERIES, scanner.series, self.config.max_series)
+                    self._check(SAMPLES, scanner.samples, self.config.max_samples)
+                chunks.append(chunk)
+        return b"".join(chunks)
+
+    def read_chunks(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        # byte limit of binary bodies (remote read), whose series and samples are counted once decoded
+        with self._lock:
+            self.responses += 1
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            self._check(BYTES, size, self.config.max_bytes)
+            yield chunk
+
+    def check_series(self, series: Sequence[Dict[str, Any]]):
+        self._check(SERIES, len(series), self.config.max_series)
+        self._check(SAMPLES, sum(len(serie["values"]) for serie in series), self.config.max_samples)
+
+    def _check(self, kind: str, count: int, limit: Optional[int]):
+        if limit is None or count <= limit:
+            return
+        with self._lock:
+            self.aborted[kind] += 1
+        message = f"Response of {self.name} exceeds the limit of {limit} {kind}, the query was aborted."
+        logger.warning(message)
+        raise ResponseTooLargeException(message)
+
+
+class Scanner:
+    # running count of the series and samples in a JSON body read in chunks
+    def __init__(self):
+        self.series = 0
+        self.samples = 0
+        self._tail = b""
+
+    def feed(self, chunk: bytes):
+        data = self._tail + chunk
+        # matches ending in the tail were counted with the previous chunk
+        boundary = len(self._tail)
+        self.series += sum(1 for match in SERIES_PATTERN.finditer(data) if match.end() > boundary)
+        self.samples += sum(1 for match in SAMPLE_PATTERN.finditer(data) if match.end() > boundary)
+        self._tail = data[-OVERLAP_BYTES:]
@@ -0,0 +1,185 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock, Thread
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from prometheus_mirror.model import StandingQueryDetails
+from prometheus_mirror.samples import SampleBlock
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+TICK_SECONDS = 1.0
+
+StreamKey = Tuple[str, str, int]
+Fetch = Callable[[int, int], List[Dict[str, Any]]]
+
+
+class StandingQuery:
+    def __init__(self, key: StreamKey, config: StandingQueryDetails, fetch: Fetch):
+        self.key = key
+        self.step = key[2]
+        self.config = config
+        self.fetch = fetch
+        self.block = SampleBlock.encode([])
+        self.covered_until: Optional[int] = None
+        self.last_access = time.time()
+        self.next_refresh = 0.0
+        self.lock = Lock()
+
+    def refresh(self, now: int):
+        with self.lock:
+            self._refresh(now)
+
+    def serve(self, start: int, end: int) -> Optional[List[List[Any]]]:
+        with self.lock:
+            self.last_access = time.time()
+            if self.covered_until is None or start < self.covered_until - self.config.window_seconds:
+                return None
+            # samples of the future are not there yet, covering them would skip them on the next refresh
+            until = min(end, int(time.time()))
+            if (until // self.step) * self.step > self.covered_until:
+                # a new evaluation is due since the last refresh, fetch just that tail
+                self._refresh(until)
+            values = [value for value in self.block.decode() if start <= value[0] <= end]
+            # a range without samples is answered upstream, where it ends in "metric not found"
+            return values or None
+
+    def _refresh(self, now: int):
+        values = self.block.decode()
+        if self.covered_until is None:
+            fetch_start = -(-(now - self.config.window_seconds) // self.step) * self.step
+        else:
+            fetch_start = (self.covered_until // self.step + 1) * self.step
+        if fetch_start <= now:
+            series = self.fetch(fetch_start, now)
+            if len(series) > 1:
+                raise ValueError(f"standing query {self.key[1]} matches {len(series)} series")
+            if not series and self.covered_until is None:
+                raise ValueError(f"standing query {self.key[1]} matches no series")
+            if series:
+                last = values[-1][0] if values else None
+                values.extend(
+                    value
+                    for value in series[0]["values"]
+                    if value[0] >= fetch_start and (last is None or value[0] > last)
+                )
+        horizon = now - self.config.window_seconds
+        self.block = SampleBlock.encode([value for value in values if value[0] >= horizon])
+        self.covered_until = now if self.covered_until is None else max(self.covered_until, now)
+        self.next_refresh = time.time() + self.config.refresh_seconds
+
+
+class StandingQueryScheduler:
+    # Notices queries StackState polls repeatedly and keeps a rolling window of their samples warm in memory. The
+    # background refresh only asks for the samples after the last one it has seen.
+    INSTANCE: Optional["StandingQueryScheduler"] = None
+
+    def __init__(self, background: bool = True):
+        self.background = background
+        self._streams: Dict[StreamKey, StandingQuery] = {}
+        self._candidates: Dict[StreamKey, Tuple[int, float, int]] = {}
+        self._refresh_slots: Dict[str, BoundedSemaphore] = {}
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="standing-query")
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+        self.served = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    @staticmethod
+    def get_instance() -> "StandingQueryScheduler":
+        if StandingQueryScheduler.INSTANCE is None:
+            with lock:
+                if StandingQueryScheduler.INSTANCE is None:
+                    StandingQueryScheduler.INSTANCE = StandingQueryScheduler()
+        return StandingQueryScheduler.INSTANCE
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "streams": len(self._streams),
+                "candidates": len(self._candidates),
+                "served": self.served,
+                "refreshes": self.refreshes,
+                "refresh_failures": self.refresh_failures,
+            }
+
+    def lookup(self, key: StreamKey, start: int, end: int) -> Optional[List[List[Any]]]:
+        stream = self._streams.get(key, None)
+        if stream is None:
+            return None
+        try:
+            values = stream.serve(start, end)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning(f"Dropping standing query {key[1]}: {e}")
+            self._drop(key)
+            return None
+        if values is not None:
+            with self._lock:
+                self.served += 1
+        return values
+
+    def tick(self, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        with self._lock:
+            for key, (_, last_seen, idle_seconds) in list(self._candidates.items()):
+                if now - last_seen > idle_seconds:
+                    del self._candidates[key]
+            streams = list(self._streams.items())
+        for key, stream in streams:
+            if now - stream.last_access > stream.config.idle_seconds:
+                logger.info(f"Standing query {key[1]} is idle, no longer refreshing it.")
+                self._drop(key)
+            elif stream.next_refresh <= now:
+                slots = self._refresh_slots[key[0]]
+                if slots.acquire(blocking=False):
+                    stream.next_refresh = now + stream.config.refresh_seconds
+                    self._executor.submit(self._refresh, stream, int(now), slots)
+
+    def observe(self, key: StreamKey, config: StandingQueryDetails, fetch: Fetch):
+        # a poll answered upstream with samples, enough of them turn the query into a standing query
+        now = time.time()
+        with self._lock:
+            if key in self._streams:
+                return
+            hits, last_seen, _ = self._candidates.get(key, (0, now, config.idle_seconds))
+            hits = hits + 1 if now - last_seen <= config.idle_seconds else 1
+            if hits < config.min_hits:
+                self._candidates[key] = (hits, now, config.idle_seconds)
+                return
+            self._candidates.pop(key, None)
+            self._streams[key] = StandingQuery(key, config, fetch)
+            if key[0] not in self._refresh_slots:
+                self._refresh_slots[key[0]] = BoundedSemaphore(config.max_concurrent_refreshes)
+            logger.info(f"Keeping standing query {key[1]} warm.")
+            if self.background and self._thread is None:
+                self._thread = Thread(target=self._run, name="standing-query-scheduler", daemon=True)
+                self._thread.start()
+
+    def _refresh(self, stream: StandingQuery, now: int, slots: BoundedSemaphore):
+        try:
+            stream.refresh(now)
+            with self._lock:
+                self.refreshes += 1
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning(f"Dropping standing query {stream.key[1]} after failed refresh: {e}")
+            with self._lock:
+                self.refresh_failures += 1
+            self._drop(stream.key)
+        finally:
+            slots.release()
+
+    def _drop(self, key: StreamKey):
+        with self._lock:
+            self._streams.pop(key, None)
+
+    def _run(self):
+        while True:
+            time.sleep(TICK_SECONDS)
+            try:
+                self.tick()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"Standing query scheduler failed: {e}")
@@ -0,0 +1,193 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from threading import Lock, local
+from typing import Any, Callable, Dict, Optional
+
+from cachetools import TLRUCache
+
+from prometheus_mirror.model import Settings
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+LEASE_POLL_SECONDS = 0.05
+
+# returned by lookups of absent keys, None is a value that can be cached like any other
+MISSING = object()
+
+
+class LocalCache:
+    # Per-process fallback used when no shared cache path is configured.
+    def __init__(self, max_entries: int):
+        self._entries = TLRUCache(maxsize=max_entries, ttu=lambda _key, value, now: now + value[0], timer=time.time)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.lookup(key)
+        return None if value is MISSING else value
+
+    def lookup(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            self.hits += 1
+            return json.loads(entry[1])
+
+    def set(self, key: str, value: Any, ttl_seconds: float):
+        with self._lock:
+            self._entries[key] = (ttl_seconds, json.dumps(value))
+
+    def get_or_compute(self, key: str, ttl_seconds: float, compute: Callable[[], Any]) -> Any:
+        value = self.lookup(key)
+        if value is MISSING:
+            value = compute()
+            self.set(key, value, ttl_seconds)
+        return value
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"backend": "local", "entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+class SqliteCache:
+    # Node-local cache shared by all uvicorn workers through a SQLite database in WAL mode. A lease row makes sure
+    # only one worker computes a missing value while the others wait for it to appear.
+    def __init__(self, path: str, max_entries: int, lease_seconds: float):
+        self.path = path
+        self.max_entries = max_entries
+        self.lease_seconds = lease_seconds
+        self._local = local()
+        self._lock = Lock()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lease_waits = 0
+        if not os.path.exists(path):
+            # the cache may hold session credentials, keep it private to the mirror's user
+            os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0o600))
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        connection.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self.lookup(key)
+        return None if value is MISSING else value
+
+    def lookup(self, key: str) -> Any:
+        row = (
+            self._connection()
+            .execute("SELECT value FROM entries WHERE key = ? AND expires_at > ?", (key, time.time()))
+            .fetchone()
+        )
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return MISSING
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl_seconds: float):
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl_seconds),
+        )
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % 100 == 0
+        if evict:
+            self._evict(connection)
+
+    def get_or_compute(self, key: str, ttl_seconds: float, compute: Callable[[], Any]) -> Any:
+        value = self.lookup(key)
+        if value is not MISSING:
+            return value
+        deadline = time.time() + self.lease_seconds
+        while not self._try_lease(key):
+            with self._lock:
+                self.lease_waits += 1
+            time.sleep(LEASE_POLL_SECONDS)
+            value = self.lookup(key)
+            if value is not MISSING:
+                return value
+            if time.time() > deadline:
+                # the worker holding the lease is stuck or failed, compute it ourselves
+                break
+        try:
+            # the lease can be free because its holder has just stored the value
+            value = self.lookup(key)
+            if value is not MISSING:
+                return value
+            value = compute()
+            self.set(key, value, ttl_seconds)
+            return value
+        finally:
+            self._connection().execute("DELETE FROM leases WHERE key = ?", (key,))
+
+    def snapshot(self) -> Dict[str, Any]:
+        entries = self._connection().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        with self._lock:
+            return {
+                "backend": "sqlite",
+                "path": self.path,
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "lease_waits": self.lease_waits,
+            }
+
+    def _try_lease(self, key: str) -> bool:
+        now = time.time()
+        connection = self._connection()
+        connection.execute("DELETE FROM leases WHERE key = ? AND expires_at < ?", (key, now))
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO leases (key, expires_at) VALUES (?, ?)", (key, now + self.lease_seconds)
+        )
+        return cursor.rowcount == 1
+
+    def _evict(self, connection: sqlite3.Connection):
+        connection.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+        connection.execute(
+            "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+
+_instance: Optional[LocalCache | SqliteCache] = None
+
+
+def get_cache() -> LocalCache | SqliteCache:
+    global _instance
+    if _instance is None:
+        with lock:
+            if _instance is None:
+                settings = Settings()
+                if settings.SHARED_CACHE_PATH:
+                    logger.info(f"Using shared cache {settings.SHARED_CACHE_PATH}.")
+                    _instance = SqliteCache(
+                        settings.SHARED_CACHE_PATH,
+                        settings.SHARED_CACHE_MAX_ENTRIES,
+                        settings.SHARED_CACHE_LEASE_SECONDS,
+                    )
+                else:
+                    _instance = LocalCache(settings.SHARED_CACHE_MAX_ENTRIES)
+    return _instance
@@ -0,0 +1,157 @@
+import hashlib
+import hmac
+import time
+from threading import Lock
+from typing import Any, Dict, Mapping, Optional, Tuple
+from urllib.parse import quote, urlsplit
+
+from cachetools import LRUCache
+
+lock = Lock()
+
+ALGORITHM = "AWS4-HMAC-SHA256"
+TIMESTAMP_FORMAT = "%Y%m%dT%H%M%SZ"
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+# hop-by-hop and proxy headers that botocore leaves out of the signature
+UNSIGNED_HEADERS = {
+    "connection",
+    "expect",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "user-agent",
+    "x-amzn-trace-id",
+}
+# set by the signer, replaced when a caller passes them in again
+SIGNER_HEADERS = {"authorization", "x-amz-date", "x-amz-security-token"}
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Derived signing keys by (secret key, date, region, service), a key is valid for a whole UTC day.
+signing_keys: LRUCache = LRUCache(maxsize=64)
+
+# Host header, canonical URI and canonical query string of the url by url, the mirror calls a handful of urls.
+url_parts: LRUCache = LRUCache(maxsize=256)
+
+
+class SigV4Signer:
+    # AWS Signature Version 4 for AMP calls, producing the same signatures as botocore's SigV4Auth. Instead of
+    # building an AWSRequest and deriving the signing key through the HMAC chain on every call, the signing key is
+    # derived once per day and the parts of the canonical request that only depend on the url are reused. Returns
+    # the headers to send, so any HTTP client can carry the request.
+    def __init__(self, credentials: Any, region: str, service: str):
+        self.access_key = credentials.access_key
+        self.secret_key = credentials.secret_key
+        self.token = credentials.token
+        self.region = region
+        self.service = service
+
+    def sign(
+        self,
+        method: str,
+        url: str,
+        params: Optional[Mapping[str, Any]] = None,
+        data: Optional[str | bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+        now: Optional[float] = None,
+    ) -> Dict[str, str]:
+        timestamp = time.strftime(TIMESTAMP_FORMAT, time.gmtime(now))
+        date = timestamp[:8]
+        host, path, url_query = _url_parts(url)
+
+        signed_headers = {name: value for name, value in (headers or {}).items() if name.lower() not in SIGNER_HEADERS}
+        signed_headers["X-Amz-Date"] = timestamp
+        if self.token:
+            signed_headers["X-Amz-Security-Token"] = self.token
+        canonical: Dict[str, str] = {}
+        for name, value in signed_headers.items():
+            name = name.lower()
+            if name not in UNSIGNED_HEADERS:
+                value = " ".join(value.split())
+                canonical[name] = canonical[name] + "," + value if name in canonical else value
+        canonical.setdefault("host", host)
+        names = sorted(canonical)
+        header_list = ";".join(names)
+
+        canonical_request = "\n".join(
+            (
+                method.upper(),
+                path,
+                _query_string(params) if params else url_query,
+                "".join(f"{name}:{canonical[name]}\n" for name in names),
+                header_list,
+                _payload_hash(data),
+            )
+        )
+        scope = f"{date}/{self.region}/{self.service}/aws4_request"
+        string_to_sign = "\n".join(
+            (ALGORITHM, timestamp, scope, hashlib.sha256(canonical_request.encode("utf-8")).hexdigest())
+        )
+        signature = hmac.new(self._signing_key(date), string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+        signed_headers["Authorization"] = (
+            f"{ALGORITHM} Credential={self.access_key}/{scope}, SignedHeaders={header_list}, Signature={signature}"
+        )
+        return signed_headers
+
+    def _signing_key(self, date: str) -> bytes:
+        key = (self.secret_key, date, self.region, self.service)
+        with lock:
+            signing_key = signing_keys.get(key, None)
+        if signing_key is None:
+            signing_key = ("AWS4" + self.secret_key).encode("utf-8")
+            for part in (date, self.region, self.service, "aws4_request"):
+                signing_key = hmac.new(signing_key, part.encode("utf-8"), hashlib.sha256).digest()
+            with lock:
+                signing_keys[key] = signing_key
+        return signing_key
+
+
+def _url_parts(url: str) -> Tuple[str, str, str]:
+    with lock:
+        parts = url_parts.get(url, None)
+    if parts is None:
+        split = urlsplit(url)
+        host = split.hostname or ""
+        if ":" in host:
+            host = f"[{host}]"  # IPv6
+        if split.port is not None and split.port != DEFAULT_PORTS.get(split.scheme):
+            host = f"{host}:{split.port}"
+        pairs = sorted(pair.partition("=")[::2] for pair in split.query.split("&")) if split.query else []
+        parts = (host, quote(_normalize_path(split.path), safe="/~"), "&".join(f"{k}={v}" for k, v in pairs))
+        with lock:
+            url_parts[url] = parts
+    return parts
+
+
+def _normalize_path(path: str) -> str:
+    # RFC 3986 dot segment removal, also dropping empty segments as AWS expects
+    if not path:
+        return "/"
+    segments: list = []
+    for segment in path.split("/"):
+        if segment == "..":
+            if segments:
+                segments.pop()
+        elif segment and segment != ".":
+            segments.append(segment)
+    first = "/" if path[0] == "/" else ""
+    last = "/" if path[-1] == "/" and segments else ""
+    return first + "/".join(segments) + last
+
+
+def _query_string(params: Mapping[str, Any]) -> str:
+    pairs = sorted((quote(key, safe="-_.~"), quote(str(value), safe="-_.~")) for key, value in params.items())
+    return "&".join(f"{key}={value}" for key, value in pairs)
+
+
+def _payload_hash(data: Optional[str | bytes]) -> str:
+    if not data:
+        return EMPTY_SHA256
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
@@ -0,0 +1,66 @@
+import logging
+import sys
+import time
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+from prometheus_mirror import IMPORT_STARTED
+from prometheus_mirror.model import ConnectionDetails
+from prometheus_mirror.prometheus import PrometheusClient
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+
+class Startup:
+    # Boot timings of this worker. Pre-warming builds the clients, AWS credentials and connection pools of the
+    # configured datasources before the worker accepts traffic, so the first real request does not pay for them.
+    INSTANCE: Optional["Startup"] = None
+
+    def __init__(self):
+        self.import_seconds: Optional[float] = None
+        self.prewarm_seconds: Optional[float] = None
+        self.prewarmed: List[str] = []
+        self.prewarm_failed: List[str] = []
+
+    @staticmethod
+    def get_instance() -> "Startup":
+        if Startup.INSTANCE is None:
+            with lock:
+                if Startup.INSTANCE is None:
+                    Startup.INSTANCE = Startup()
+        return Startup.INSTANCE
+
+    def imported(self):
+        self.import_seconds = time.perf_counter() - IMPORT_STARTED
+        logger.info(f"Imported the mirror in {self.import_seconds:.3f}s.")
+
+    def prewarm(self, connections: List[ConnectionDetails]):
+        started = time.perf_counter()
+        for config in connections:
+            try:
+                # a connection check opens the first pooled connection and, for AWS, signs with fresh credentials
+                status_code, details = PrometheusClient.get_instance(config).test_connection()
+            except Exception as e:
+                status_code, details = None, str(e)
+            if status_code == 200:
+                self.prewarmed.append(config.url)
+            else:
+                logger.warning(f"Failed to pre-warm [{config.url}]: {details}")
+                self.prewarm_failed.append(config.url)
+        self.prewarm_seconds = time.perf_counter() - started
+        if connections:
+            logger.info(
+                f"Pre-warmed {len(self.prewarmed)} of {len(connections)} datasources in "
+                f"{self.prewarm_seconds:.3f}s."
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "import_seconds": self.import_seconds,
+            "prewarm_seconds": self.prewarm_seconds,
+            "prewarmed": list(self.prewarmed),
+            "prewarm_failed": list(self.prewarm_failed),
+            "aws_loaded": "boto3" in sys.modules,
+        }
@@ -0,0 +1,168 @@
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from prometheus_mirror.admission import AdmissionRejectedException
+from prometheus_mirror.model import ConnectionDetails, RateLimitDetails, RetryDetails
+
+logger = logging.getLogger(__name__)
+
+lock = Lock()
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    def __init__(self, config: RateLimitDetails):
+        self.config = config
+        self._tokens = float(config.burst)
+        self._last_refill = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self, name: str):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                float(self.config.burst), self._tokens + (now - self._last_refill) * self.config.requests_per_second
+            )
+            self._last_refill = now
+            # reserve the token now, callers queue up behind each other on the negative balance
+            self._tokens -= 1
+            wait_seconds = 0.0 if self._tokens >= 0 else -self._tokens / self.config.requests_per_second
+            if wait_seconds > self.config.max_wait_seconds:
+                self._tokens += 1
+                raise AdmissionRejectedException(
+                    name, f"rate limit of {self.config.requests_per_second} req/s exceeded"
+                )
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+        return wait_seconds
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                float(self.config.burst), self._tokens + (now - self._last_refill) * self.config.requests_per_second
+            )
+            self._last_refill = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryBudget:
+    # Every request deposits `budget_ratio` tokens and every retry withdraws one, so retries stay a bounded
+    # fraction of the traffic and cannot amplify an outage.
+    def __init__(self, config: RetryDetails):
+        self.config = config
+        self._tokens = float(config.budget_max_tokens)
+        self._lock = Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(float(self.config.budget_max_tokens), self._tokens + self.config.budget_ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class Throttle:
+    INSTANCES: Dict[str, "Throttle"] = {}
+
+    def __init__(self, name: str, rate_limit: Optional[RateLimitDetails], retry: RetryDetails):
+        self.name = name
+        self.rate_limit = rate_limit
+        self.retry = retry
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+        self.budget = RetryBudget(retry)
+        self._lock = Lock()
+        self.throttled = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.budget_exhausted = 0
+
+    @staticmethod
+    def get_instance(config: ConnectionDetails) -> "Throttle":
+        throttle = Throttle.INSTANCES.get(config.url, None)
+        if throttle is None or throttle.rate_limit != config.rate_limit or throttle.retry != config.retry:
+            with lock:
+                throttle = Throttle.INSTANCES.get(config.url, None)
+                if throttle is None or throttle.rate_limit != config.rate_limit or throttle.retry != config.retry:
+                    rate_limit = config.rate_limit.copy() if config.rate_limit else None
+                    throttle = Throttle(config.url, rate_limit, config.retry.copy())
+                    Throttle.INSTANCES[config.url] = throttle
+        return throttle
+
+    @staticmethod
+    def stats() -> Dict[str, Dict[str, int]]:
+        return {name: throttle.snapshot() for name, throttle in list(Throttle.INSTANCES.items())}
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "throttled": self.throttled,
+                "rate_limited": self.rate_limited,
+                "retries": self.retries,
+                "budget_exhausted": self.budget_exhausted,
+            }
+
+    def before_request(self):
+        if self.bucket is None:
+            return
+        try:
+            waited = self.bucket.acquire(self.name)
+        except AdmissionRejectedException:
+            with self._lock:
+                self.rate_limited += 1
+            raise
+        if waited > 0:
+            with self._lock:
+                self.throttled += 1
+
+    def try_before_request(self) -> bool:
+        return self.bucket is None or self.bucket.try_acquire()
+
+    def retry_delay(self, attempt: int, status_code: int, retry_after: Optional[str]) -> Optional[float]:
+        if status_code not in RETRYABLE_STATUS_CODES or attempt >= self.retry.max_retries:
+            return None
+        delay, honoured = self._backoff(attempt, retry_after)
+        if delay > self.retry.max_backoff_seconds:
+            if honoured:
+                logger.warning(f"Not retrying {self.name}: Retry-After of {delay:.1f}s exceeds the maximum backoff.")
+            return None
+        if not self.budget.withdraw():
+            with self._lock:
+                self.budget_exhausted += 1
+            logger.warning(f"Not retrying {self.name}: retry budget exhausted.")
+            return None
+        with self._lock:
+            self.retries += 1
+        return delay
+
+    def _backoff(self, attempt: int, retry_after: Optional[str]) -> Tuple[float, bool]:
+        retry_after_seconds = parse_retry_after(retry_after)
+        if retry_after_seconds is not None:
+            return retry_after_seconds, True
+        ceiling = min(self.retry.max_backoff_seconds, self.retry.base_backoff_seconds * (2**attempt))
+        return random.uniform(0, ceiling), False
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,119 @@
+import json
+from threading import Event, Thread
+
+import pytest
+import requests_mock
+from fastapi.testclient import TestClient
+
+from prometheus_mirror.admission import AdmissionRejectedException, Bulkhead
+from prometheus_mirror.mirror import app
+from prometheus_mirror.model import AdmissionControlDetails, ConnectionDetails
+
+
+def _hold_slot(bulkhead: Bulkhead, entered: Event, release: Event):
+    with bulkhead.admit():
+        entered.set()
+        release.wait(5)
+
+
+class TestBulkhead:
+    def test_rejects_when_queue_full(self):
+        bulkhead = Bulkhead("http://ds", AdmissionControlDetails(max_concurrent_requests=1, max_queued_requests=0))
+        entered, release = Event(), Event()
+        holder = Thread(target=_hold_slot, args=(bulkhead, entered, release))
+        holder.start()
+        entered.wait(5)
+        try:
+            with pytest.raises(AdmissionRejectedException):
+                with bulkhead.admit():
+                    pass
+        finally:
+            release.set()
+            holder.join()
+        assert bulkhead.snapshot() == {
+            "active": 0,
+            "queued": 0,
+            "admitted": 1,
+            "rejected_queue_full": 1,
+            "rejected_timeout": 0,
+        }
+
+    def test_rejects_after_queue_timeout(self):
+        config = AdmissionControlDetails(max_concurrent_requests=1, max_queued_requests=1, queue_timeout_seconds=0.05)
+        bulkhead = Bulkhead("http://ds", config)
+        entered, release = Event(), Event()
+        holder = Thread(target=_hold_slot, args=(bulkhead, entered, release))
+        holder.start()
+        entered.wait(5)
+        try:
+            with pytest.raises(AdmissionRejectedException):
+                with bulkhead.admit():
+                    pass
+        finally:
+            release.set()
+            holder.join()
+        assert bulkhead.snapshot()["rejected_timeout"] == 1
+
+    def test_queued_call_is_admitted_when_slot_frees(self):
+        config = AdmissionControlDetails(max_concurrent_requests=1, max_queued_requests=1, queue_timeout_seconds=5)
+        bulkhead = Bulkhead("http://ds", config)
+        entered, release = Event(), Event()
+        holder = Thread(target=_hold_slot, args=(bulkhead, entered, release))
+        holder.start()
+        entered.wait(5)
+        release.set()
+        with bulkhead.admit():
+            assert bulkhead.snapshot()["active"] == 1
+        holder.join()
+        assert bulkhead.snapshot()["admitted"] == 2
+
+    def test_instance_per_datasource(self):
+        first = Bulkhead.get_instance(ConnectionDetails(url="http://bulkhead-a"))
+        assert first is Bulkhead.get_instance(ConnectionDetails(url="http://bulkhead-a"))
+        assert first is not Bulkhead.get_instance(ConnectionDetails(url="http://bulkhead-b"))
+        changed = Bulkhead.get_instance(
+            ConnectionDetails(url="http://bulkhead-a", admission={"max_concurrent_requests": 2})
+        )
+        assert changed is not first
+        assert changed.config.max_concurrent_requests == 2
+
+
+class TestAdmissionEndpoint:
+    def test_metric_request_shed_when_overloaded(self):
+        client = TestClient(app)
+        request = {
+            "connectionDetails": {
+                "url": "http://bulkhead-shed:9000",
+                "admission": {"max_concurrent_requests": 1, "max_queued_requests": 0},
+            },
+            "query": {
+                "conditions": [
+                    {
+                        "key": "__gauge__",
+                        "value": {"value": "name", "_type": "StringValue"},
+                        "_type": "EqualityCondition",
+                    }
+                ],
+                "startTime": 1555408501000,
+                "endTime": 1555408711000,
+                "_type": "MetricsQuery",
+            },
+            "_type": "MetricsRequest",
+        }
+        bulkhead = Bulkhead.get_instance(ConnectionDetails(**request["connectionDetails"]))
+        entered, release = Event(), Event()
+        holder = Thread(target=_hold_slot, args=(bulkhead, entered, release))
+        holder.start()
+        entered.wait(5)
+        try:
+            with requests_mock.Mocker(real_http=False) as m:
+                adapter = m.register_uri(method="GET", url="http://bulkhead-shed:9000/api/v1/query_range", json={})
+                response = client.post("/api/metric", content=json.dumps(request))
+        finally:
+            release.set()
+            holder.join()
+        assert response.status_code == 503
+        assert response.json()["_type"] == "RemoteMirrorError"
+        assert response.json()["summary"] == "Too many requests."
+        assert adapter.call_count == 0
+        assert client.get("/stats").json()["admission"]["http://bulkhead-shed:9000"]["rejected_queue_full"] == 1
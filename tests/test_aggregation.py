@@ -0,0 +1,156 @@
+import time
+from threading import Thread
+
+import pytest
+import requests_mock
+
+from prometheus_mirror import shared_cache
+from prometheus_mirror.aggregation import RawSeries, SingleFlight, _quantile, evaluate
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails
+from prometheus_mirror.prometheus import (
+    MetricNotFoundException,
+    PrometheusClient,
+    TooManyMetricsException,
+)
+from prometheus_mirror.shared_cache import LocalCache
+
+# Expected values are what Prometheus 2.x returns for the expressions PrometheusQuery generates.
+
+
+def counter(start, end, interval, rate=1.0, offset=0):
+    return [(t * 1000, (t - start) / interval * rate) for t in range(start + offset, end + 1, interval)]
+
+
+class TestIncrease:
+    def test_extrapolates_to_window(self):
+        # 1 per 15 seconds, samples not aligned with the window: increase(x[5m]) == 20
+        series = RawSeries({}, counter(0, 3600, 15, offset=5))
+        assert series.increase(600_000, 900_000) == pytest.approx(20.0)
+        aligned = RawSeries({}, counter(0, 3600, 15))
+        assert aligned.increase(600_000, 900_000) == pytest.approx(20.0)
+
+    def test_counter_reset(self):
+        samples = [(0, 10.0), (15_000, 20.0), (30_000, 5.0), (45_000, 15.0)]
+        assert RawSeries({}, samples).increase(0, 45_000) == pytest.approx(25.0)
+
+    def test_does_not_extrapolate_below_zero(self):
+        samples = [(t * 1000, float(i + 1)) for i, t in enumerate(range(60, 301, 15))]
+        assert RawSeries({}, samples).increase(0, 300_000) == pytest.approx(17.0)
+
+    def test_needs_two_samples(self):
+        assert RawSeries({}, [(0, 1.0)]).increase(0, 300_000) is None
+
+
+class TestEvaluate:
+    def test_counter_over_time(self):
+        series = [RawSeries({}, counter(0, 7200, 15, offset=5))]
+        for method in ("mean", "max", "min", "percentile_95"):
+            values = evaluate(series, "__counter__", method, 3600, 7200, 300, 300)
+            assert [t for t, _ in values] == list(range(3600, 7201, 300))
+            assert all(value == pytest.approx(20.0) for _, value in values)
+        # closed [t - 5m, t] window holds six 60s-aligned subquery evaluations
+        counts = evaluate(series, "__counter__", "event_count", 3600, 7200, 300, 300)
+        assert {value for _, value in counts} == {6.0}
+        sums = evaluate(series, "__counter__", "sum", 3600, 7200, 300, 300)
+        assert {round(value, 6) for _, value in sums} == {120.0}
+
+    def test_gauge_instant_values_and_lookback(self):
+        series = [RawSeries({}, [(0, 1.0), (60_000, 2.0), (100_000, 3.0)])]
+        values = evaluate(series, "__gauge__", "mean", 0, 600, 60, 60)
+        # last sample at 100s stays visible for 5 minutes
+        assert values == [[0, 1.0], [60, 2.0], [120, 3.0], [180, 3.0], [240, 3.0], [300, 3.0], [360, 3.0]]
+
+    def test_gauge_aggregates_across_series(self):
+        series = [
+            RawSeries({"instance": "a"}, [(0, 1.0), (30_000, 3.0)]),
+            RawSeries({"instance": "b"}, [(0, 5.0), (30_000, 7.0)]),
+        ]
+        assert evaluate(series, "__gauge__", "mean", 0, 30, 30, 30) == [[0, 3.0], [30, 5.0]]
+        assert evaluate(series, "__gauge__", "sum", 0, 30, 30, 30) == [[0, 6.0], [30, 10.0]]
+        assert evaluate(series, "__gauge__", "max", 0, 30, 30, 30) == [[0, 5.0], [30, 7.0]]
+        assert evaluate(series, "__gauge__", "percentile_25", 0, 0, 30, 30) == [[0, 2.0]]
+
+    def test_gauge_event_count(self):
+        series = [RawSeries({}, [(t * 1000, 1.0) for t in range(0, 601, 15)])]
+        assert evaluate(series, "__gauge__", "event_count", 300, 600, 300, 300) == [[300, 21.0], [600, 21.0]]
+
+    def test_quantile(self):
+        assert _quantile(0.95, [5.0, 1.0, 3.0, 2.0, 4.0]) == pytest.approx(4.8)
+        assert _quantile(0.5, [1.0]) == 1.0
+
+
+class TestSingleFlight:
+    def test_concurrent_calls_coalesced(self):
+        flight = SingleFlight()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return "raw"
+
+        threads = [Thread(target=lambda: results.append(flight.do("key", compute))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert calls == [1]
+        assert results == ["raw"] * 5
+        assert flight.snapshot() == {"raw_fetches": 1, "coalesced": 4, "in_flight": 0}
+
+
+class TestLocalAggregationClient:
+    url = "http://aggregating:9090"
+
+    @staticmethod
+    def conditions(kind):
+        return [
+            Condition(key=kind, value=ConditionValue(value="requests", _type="StringValue")),
+            Condition(key="job", value=ConditionValue(value="api", _type="StringValue")),
+        ]
+
+    def test_one_raw_fetch_for_all_methods(self, monkeypatch):
+        monkeypatch.setattr(shared_cache, "_instance", LocalCache(100))
+        client = PrometheusClient(ConnectionDetails(url=self.url, local_aggregation={}))
+        values = [[t, str(v)] for t, v in ((ts // 1000, v) for ts, v in counter(0, 7200, 15, offset=5))]
+        body = {"data": {"resultType": "matrix", "result": [{"metric": {"job": "api"}, "values": values}]}}
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{self.url}/api/v1/query", json=body)
+            for method in ("mean", "percentile_95", "max"):
+                result = client.get_series_values_in_range(self.conditions("__counter__"), 3600, 7200, method, 300)
+                assert len(result) == 13
+                assert all(value == pytest.approx(20.0) for _, value in result)
+        assert adapter.call_count == 1
+        assert adapter.last_request.qs["query"] == ['requests{job="api"}[4200s]']
+        assert adapter.last_request.qs["time"] == ["7200"]
+
+    def test_counter_with_several_series(self):
+        client = PrometheusClient(ConnectionDetails(url=self.url, local_aggregation={"raw_ttl_seconds": 0}))
+        result = [
+            {"metric": {"job": "api", "instance": "a"}, "values": [[0, "1"], [15, "2"]]},
+            {"metric": {"job": "api", "instance": "b"}, "values": [[0, "1"], [15, "2"]]},
+        ]
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{self.url}/api/v1/query", json={"data": {"result": result}})
+            with pytest.raises(TooManyMetricsException) as e:
+                client.get_series_values_in_range(self.conditions("__counter__"), 0, 60, "mean", 60)
+            assert e.value.fields == ["instance"]
+            # gauge aggregations combine them, as avg(...) does
+            values = client.get_series_values_in_range(self.conditions("__gauge__"), 0, 30, "mean", 30)
+            assert values == [[0, 1.0], [30, 2.0]]
+
+    def test_no_samples(self):
+        client = PrometheusClient(ConnectionDetails(url=self.url, local_aggregation={"raw_ttl_seconds": 0}))
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{self.url}/api/v1/query", json={"data": {"result": []}})
+            with pytest.raises(MetricNotFoundException):
+                client.get_series_values_in_range(self.conditions("__gauge__"), 0, 60, "max", 30)
+
+    def test_long_ranges_use_promql(self):
+        client = PrometheusClient(ConnectionDetails(url=self.url, local_aggregation={"max_range_seconds": 3600}))
+        body = {"data": {"result": [{"metric": {}, "values": [[0, "1"]]}]}}
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{self.url}/api/v1/query_range", json=body)
+            client.get_series_values_in_range(self.conditions("__gauge__"), 0, 86400, "mean", 300)
+        assert adapter.call_count == 1
@@ -0,0 +1,101 @@
+import math
+import os
+
+import requests_mock
+
+from prometheus_mirror import block_store
+from prometheus_mirror.block_store import BlockStore
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails
+from prometheus_mirror.prometheus import PrometheusClient
+
+
+class RecordingFetch:
+    def __init__(self, step: int):
+        self.step = step
+        self.calls = []
+
+    def __call__(self, start: int, end: int):
+        self.calls.append((start, end))
+        return [{"metric": {"job": "a"}, "values": [[t, str(t / 10)] for t in range(start, end + 1, self.step)]}]
+
+
+class TestBlockStore:
+    def test_historical_blocks_served_from_disk(self, tmp_path):
+        store = BlockStore(str(tmp_path), 1024 * 1024)
+        fetch = RecordingFetch(10)
+        # blocks of 10 points: [0, 100), [100, 200), ... immutable before 300
+        first = store.query_range("http://ds", "up", 15, 350, 10, 10, 300, fetch)
+        # one query for the blocks not stored yet and the tail after them
+        assert fetch.calls == [(0, 350)]
+        assert first[0]["values"][0] == [20, 2.0]
+        assert first[0]["values"][-1] == [350, "35.0"]
+        assert [value[0] for value in first[0]["values"]] == list(range(20, 351, 10))
+
+        fetch.calls.clear()
+        second = store.query_range("http://ds", "up", 15, 350, 10, 10, 300, fetch)
+        assert fetch.calls == [(300, 350)]
+        assert [float(v[1]) for v in second[0]["values"]] == [float(v[1]) for v in first[0]["values"]]
+        assert store.snapshot()["hits"] == 3
+
+    def test_runs_of_missing_blocks_fetched_together(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(block_store, "MAX_POINTS_PER_QUERY", 30)
+        store = BlockStore(str(tmp_path), 1024 * 1024)
+        fetch = RecordingFetch(10)
+        store.query_range("http://ds", "up", 300, 399, 10, 10, 1000, fetch)
+        fetch.calls.clear()
+        # the stored block [300, 400) splits the missing ones, runs are at most 3 blocks
+        result = store.query_range("http://ds", "up", 0, 995, 10, 10, 1000, fetch)
+        assert fetch.calls == [(0, 290), (400, 690), (700, 990)]
+        assert [value[0] for value in result[0]["values"]] == list(range(0, 991, 10))
+        fetch.calls.clear()
+        store.query_range("http://ds", "up", 0, 995, 10, 10, 1000, fetch)
+        assert fetch.calls == []
+        assert store.snapshot()["misses"] == 10
+
+    def test_survives_restart(self, tmp_path):
+        fetch = RecordingFetch(10)
+        BlockStore(str(tmp_path), 1024 * 1024).query_range("http://ds", "up", 0, 99, 10, 10, 1000, fetch)
+        fetch.calls.clear()
+        restarted = BlockStore(str(tmp_path), 1024 * 1024)
+        result = restarted.query_range("http://ds", "up", 0, 99, 10, 10, 1000, fetch)
+        assert fetch.calls == []
+        assert result[0]["metric"] == {"job": "a"}
+        assert len(result[0]["values"]) == 10
+
+    def test_nan_and_empty_blocks(self, tmp_path):
+        store = BlockStore(str(tmp_path), 1024 * 1024)
+        store.query_range("http://ds", "nan", 0, 9, 1, 10, 100, lambda s, e: [{"metric": {}, "values": [[0, "NaN"]]}])
+        store.query_range("http://ds", "empty", 0, 9, 1, 10, 100, lambda s, e: [])
+        nan = store.query_range("http://ds", "nan", 0, 9, 1, 10, 100, lambda s, e: [])
+        assert math.isnan(nan[0]["values"][0][1])
+        assert store.query_range("http://ds", "empty", 0, 9, 1, 10, 100, lambda s, e: 1 / 0) == []
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        store = BlockStore(str(tmp_path), 1)
+        fetch = RecordingFetch(1)
+        store.query_range("http://ds", "a", 0, 9, 1, 10, 100, fetch)
+        store.query_range("http://ds", "b", 0, 9, 1, 10, 100, fetch)
+        store._evict()
+        files = [name for _, _, names in os.walk(tmp_path) for name in names]
+        assert files == []
+        assert store.snapshot()["evictions"] == 2
+
+    def test_client_fetches_only_recent_tail(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(block_store, "_instance", BlockStore(str(tmp_path), 1024 * 1024))
+        url = "http://blocks:9090"
+        client = PrometheusClient(ConnectionDetails(url=url, block_store={"block_points": 120}))
+        conditions = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+
+        def respond(request, context):
+            start, end = int(request.qs["start"][0]), int(request.qs["end"][0])
+            values = [[t, "1"] for t in range(start, end + 1, 30) if t % 3600 == 0]
+            return {"data": {"result": [{"metric": {"__name__": "up"}, "values": values}]}}
+
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{url}/api/v1/query_range", json=respond)
+            expected = [[3600, 1.0], [7200, 1.0], [10800, 1.0]]
+            assert client.get_series_values_in_range(conditions, 3600, 3600 * 3) == expected
+            # the three hourly blocks in one query
+            assert adapter.call_count == 1
+            assert client.get_series_values_in_range(conditions, 3600, 3600 * 3) == expected
+            assert adapter.call_count == 1
@@ -0,0 +1,124 @@
+import gzip
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+import requests_mock
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+from prometheus_mirror.compression import GZIP, ZSTD, CompressionMiddleware, negotiate
+from prometheus_mirror.mirror import app
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails
+from prometheus_mirror.prometheus import PrometheusClient
+
+zstandard = pytest.importorskip("zstandard")
+
+URL = "http://compression:9090"
+VALUES = [[1_555_408_501 + i * 30, str(i * 0.25)] for i in range(2000)]
+BODY = {
+    "connectionDetails": {"url": URL},
+    "query": {
+        "conditions": [{"key": "__gauge__", "value": {"value": "up", "_type": "StringValue"}}],
+        "startTime": 1_555_408_501_000,
+        "endTime": 1_555_468_501_000,
+    },
+}
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    [
+        ("gzip, deflate", GZIP),
+        ("gzip, zstd", ZSTD),
+        ("zstd;q=0.5, gzip", GZIP),
+        ("br", None),
+        ("*", ZSTD),
+        ("*, zstd;q=0", GZIP),
+        ("gzip;q=0", None),
+        ("", None),
+    ],
+)
+def test_negotiate(accept_encoding, expected):
+    assert negotiate(accept_encoding, [ZSTD, GZIP]) == expected
+
+
+def fetch(accept_encoding):
+    with requests_mock.Mocker(real_http=False) as m:
+        m.register_uri("GET", f"{URL}/api/v1/query_range", json={"data": {"result": [{"values": VALUES}]}})
+        return TestClient(app).post("/api/metric", json=BODY, headers={"Accept-Encoding": accept_encoding})
+
+
+def test_metric_responses_compressed():
+    plain = fetch("identity")
+    assert "content-encoding" not in plain.headers
+    assert plain.json()["telemetry"]["points"]
+
+    gzipped = fetch("gzip")
+    assert gzipped.headers["content-encoding"] == "gzip"
+    assert gzipped.headers["vary"] == "Accept-Encoding"
+    assert gzipped.headers["x-mirror-api-key"]
+    assert gzipped.json() == plain.json()
+    assert gzipped.num_bytes_downloaded < len(plain.content) / 4
+
+    zstd = fetch("zstd, gzip")
+    assert zstd.headers["content-encoding"] == "zstd"
+    assert json.loads(zstandard.ZstdDecompressor().decompressobj().decompress(zstd.content)) == plain.json()
+
+    stats = TestClient(app).get("/stats").json()["compression"]
+    assert stats["gzip"]["bytes_out"] < stats["gzip"]["bytes_in"]
+    assert stats["zstd"]["responses"] >= 1
+
+
+def test_small_responses_left_alone():
+    response = TestClient(app).get("/healthcheck", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+
+
+def test_streaming_response():
+    async def chunks(request):
+        async def generate():
+            for i in range(100):
+                yield json.dumps(VALUES[i * 20 : (i + 1) * 20]).encode()
+
+        return StreamingResponse(generate(), media_type="application/json")
+
+    streaming = Starlette(routes=[Route("/", chunks)])
+    streaming.add_middleware(CompressionMiddleware, encodings=[GZIP], minimum_size=1024)
+    response = TestClient(streaming).get("/", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert response.content == b"".join(json.dumps(VALUES[i * 20 : (i + 1) * 20]).encode() for i in range(100))
+
+
+class GzipPrometheus(BaseHTTPRequestHandler):
+    accept_encoding = None
+
+    def do_GET(self):
+        GzipPrometheus.accept_encoding = self.headers["Accept-Encoding"]
+        body = gzip.compress(json.dumps({"data": {"result": [{"values": VALUES}]}}).encode())
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_upstream_responses_requested_compressed():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GzipPrometheus)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = PrometheusClient(ConnectionDetails(url=f"http://127.0.0.1:{server.server_address[1]}"))
+        conditions = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+        assert client.get_series_values_in_range(conditions, 0, 60) == VALUES
+        assert GzipPrometheus.accept_encoding == "gzip"
+    finally:
+        server.shutdown()
+        server.server_close()
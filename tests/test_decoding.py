@@ -0,0 +1,115 @@
+import copy
+
+import pytest
+from fastapi import FastAPI
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+from pydantic import BaseModel
+
+from prometheus_mirror import decoding
+from prometheus_mirror.decoding import _construct, decode_mirror_request
+from prometheus_mirror.mirror import app
+from prometheus_mirror.model import MirrorRequest
+
+REQUEST = {
+    "connectionDetails": {"url": "http://localhost:9000", "request_timeout_seconds": 15000},
+    "requestTimeout": 15000,
+    "query": {
+        "conditions": [
+            {"key": "__gauge__", "value": {"value": "up", "_type": "StringValue"}, "_type": "EqualityCondition"},
+            {"key": "job", "value": {"value": ["a", "b"], "_type": "InSetValue"}, "_type": "EqualityCondition"},
+        ],
+        "aggregation": {"method": "MEAN", "bucketSizeMillis": 60000, "_type": "Aggregation"},
+        "field": {"fieldName": "job", "_type": "FieldDescriptor"},
+        "startTime": 1555408501000,
+        "endTime": 1555408711000,
+        "metricField": "double",
+        "_type": "MetricsQuery",
+    },
+    "_type": "MetricsRequest",
+}
+
+
+def assert_same(actual: BaseModel, expected: BaseModel):
+    assert type(actual) is type(expected)
+    assert actual.__fields_set__ == expected.__fields_set__
+    for name in expected.__fields__:
+        actual_value, expected_value = getattr(actual, name), getattr(expected, name)
+        if isinstance(expected_value, BaseModel):
+            assert_same(actual_value, expected_value)
+        elif isinstance(expected_value, list) and expected_value and isinstance(expected_value[0], BaseModel):
+            assert len(actual_value) == len(expected_value)
+            for actual_item, expected_item in zip(actual_value, expected_value):
+                assert_same(actual_item, expected_item)
+        else:
+            assert actual_value == expected_value
+            assert type(actual_value) is type(expected_value)
+
+
+reference = FastAPI()
+
+
+@reference.post("/")
+def reference_endpoint(request: MirrorRequest):
+    return "ok"
+
+
+@reference.exception_handler(RequestValidationError)
+async def reference_handler(request, exc):
+    return JSONResponse(status_code=500, content=jsonable_encoder({"detail": exc.errors(), "body": exc.body}))
+
+
+class TestDecodeMirrorRequest:
+    def test_fast_path_matches_validation(self):
+        assert_same(_construct(MirrorRequest, copy.deepcopy(REQUEST)), MirrorRequest.parse_obj(REQUEST))
+        minimal = {"connectionDetails": {"url": "http://x"}, "query": {}}
+        assert_same(_construct(MirrorRequest, minimal), MirrorRequest.parse_obj(minimal))
+
+    def test_coerced_values_fall_back_to_validation(self):
+        request = copy.deepcopy(REQUEST)
+        request["query"]["startTime"] = "1555408501000"
+        request["query"]["aggregation"]["bucketSizeMillis"] = 60000.0
+        decoded = decode_mirror_request(request)
+        assert decoded.query.start_time == 1555408501000
+        assert_same(decoded, MirrorRequest.parse_obj(request))
+
+    def test_connection_details_reused(self):
+        first = decode_mirror_request(copy.deepcopy(REQUEST))
+        first.connection_details.url = "http://changed"
+        second = decode_mirror_request(copy.deepcopy(REQUEST))
+        assert second.connection_details.url == "http://localhost:9000"
+        assert second.connection_details is not decode_mirror_request(copy.deepcopy(REQUEST)).connection_details
+
+    def test_connection_details_cache_keys_hold_no_secrets(self):
+        request = copy.deepcopy(REQUEST)
+        request["connectionDetails"]["aws"] = {"aws_access_key_id": "key", "aws_secret_access_key": "s3cr3t"}
+        decoded = decode_mirror_request(request)
+        assert decoded.connection_details.aws.aws_secret_access_key == "s3cr3t"
+        assert not any(b"s3cr3t" in key for key in decoding.connection_details_cache.keys())
+
+    @pytest.mark.parametrize(
+        "mutate",
+        [
+            lambda r: r.pop("query"),
+            lambda r: r["query"].update(startTime="soon"),
+            lambda r: r["query"]["conditions"][0]["value"].pop("_type"),
+            lambda r: r["query"]["conditions"].append({"value": {"value": 1, "_type": "DoubleValue"}}),
+            lambda r: r["connectionDetails"].update(admission={"max_concurrent_requests": 0}),
+            lambda r: r.update(connectionDetails=[]),
+        ],
+    )
+    def test_same_validation_errors(self, mutate):
+        request = copy.deepcopy(REQUEST)
+        mutate(request)
+        expected = TestClient(reference).post("/", json=request)
+        actual = TestClient(app).post("/api/metric", json=request)
+        assert actual.status_code == expected.status_code == 500
+        assert actual.json()["details"] == expected.json()
+        assert actual.json()["summary"] == "Request validation errors."
+
+    def test_non_object_body(self):
+        expected = TestClient(reference).post("/", json=[1])
+        actual = TestClient(app).post("/api/metric", json=[1])
+        assert actual.json()["details"] == expected.json()
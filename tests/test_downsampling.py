@@ -0,0 +1,76 @@
+import math
+
+from prometheus_mirror.downsampling import lttb
+from prometheus_mirror.metric_request import MetricRequest
+from prometheus_mirror.samples import SampleBlock
+
+
+def series(count):
+    return [[math.sin(i / 50.0) + (5.0 if i == 4321 else 0.0), 1_000_000 + i * 30_000] for i in range(count)]
+
+
+class TestLttb:
+    def test_short_series_untouched(self):
+        points = series(10)
+        assert lttb(points, 10) is points
+        assert lttb(points, 100) is points
+        assert lttb(points, 2) is points
+
+    def test_reduces_to_target_keeping_shape(self):
+        points = series(10_000)
+        sampled = lttb(points, 500)
+        assert len(sampled) == 500
+        assert sampled[0] == points[0]
+        assert sampled[-1] == points[-1]
+        timestamps = [point[1] for point in sampled]
+        assert timestamps == sorted(set(timestamps))
+        # the spike is the most significant point of its bucket
+        assert points[4321] in sampled
+        assert max(point[0] for point in sampled) == max(point[0] for point in points)
+        assert min(point[0] for point in sampled) < -0.999
+
+    def test_infinite_values(self):
+        points = series(1000)
+        points[10][0], points[500][0] = math.inf, -math.inf
+        sampled = lttb(points, 50)
+        assert len(sampled) == 50
+        timestamps = [point[1] for point in sampled]
+        assert timestamps == sorted(set(timestamps))
+
+
+class TestDownsampledResponse:
+    def test_nan_handling_before_downsampling(self):
+        values = [[1_555_408_501 + i * 30, "NaN" if i % 10 == 0 else str(i)] for i in range(1000)]
+        end = 1_555_408_501_000 + 1000 * 30_000
+
+        dropped = MetricRequest._make_raw_metric_response(end, "NONE", values, 100).telemetry.points
+        assert len(dropped) == 100
+        assert all(point[0] % 10 != 0 for point in dropped)
+
+        zeroed = MetricRequest._make_raw_metric_response(end, "ZERO", values, 100).telemetry.points
+        assert len(zeroed) == 100
+        assert [0.0, 1_555_408_501_000] == zeroed[0]
+
+    def test_same_points_as_downsampling_converted_values(self):
+        values = [[1_555_408_501 + i * 30, str(math.cos(i / 7.0))] for i in range(1000)]
+        end = 1_555_408_501_000 + 1000 * 30_000
+        points = MetricRequest._make_raw_metric_response(end, "ZERO", values, 50).telemetry.points
+        assert points == lttb(MetricRequest._raw_points(end, "ZERO", values), 50)
+
+    def test_sample_block_matches_list(self):
+        values = [[1_555_408_501 + i * 30, "NaN" if i % 97 == 0 else str(math.cos(i / 7.0))] for i in range(1000)]
+        block = SampleBlock.encode(values)
+        end = 1_555_408_501_000 + 900 * 30_000
+        for nan_interpretation in ["ZERO", "NONE"]:
+            expected = MetricRequest._make_raw_metric_response(end, nan_interpretation, values[:950], 50)
+            assert MetricRequest._make_raw_metric_response(end, nan_interpretation, block, 50) == expected
+        finite = SampleBlock.encode(values[1:])
+        expected = MetricRequest._make_raw_metric_response(end, "ZERO", values[1:], 50)
+        actual = MetricRequest._make_raw_metric_response(end, "ZERO", finite, 50)
+        assert actual == expected
+        assert len(actual.telemetry.points) == 50
+
+    def test_disabled_by_default(self):
+        values = [[1_555_408_501 + i * 30, "1"] for i in range(2000)]
+        response = MetricRequest._make_raw_metric_response(1_655_408_501_000, "ZERO", values)
+        assert len(response.telemetry.points) == 2000
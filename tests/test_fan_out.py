@@ -0,0 +1,142 @@
+import time
+
+import pytest
+import requests_mock
+
+from prometheus_mirror import shared_cache
+from prometheus_mirror.fan_out import FanOut, merge_series
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails, FanOutDetails
+from prometheus_mirror.prometheus import PrometheusClient
+from prometheus_mirror.shared_cache import LocalCache
+
+PRIMARY = "http://primary:9090"
+SECONDARY = "http://secondary:9090"
+CONDITIONS = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+
+
+def result(values, metric=None):
+    return {"status": "success", "data": {"result": [{"metric": metric or {}, "values": values}]}}
+
+
+def slow(seconds, response):
+    def respond(request, context):
+        time.sleep(seconds)
+        return response
+
+    return respond
+
+
+def client(mode, **fan_out):
+    return PrometheusClient(ConnectionDetails(url=PRIMARY, fan_out={"urls": [SECONDARY], "mode": mode, **fan_out}))
+
+
+@pytest.fixture(autouse=True)
+def reset(monkeypatch):
+    monkeypatch.setattr(shared_cache, "_instance", LocalCache(100))
+    monkeypatch.setattr(FanOut, "INSTANCES", {})
+
+
+def test_merge_series():
+    merged = merge_series(
+        [
+            [{"metric": {"pod": "a"}, "values": [[0, "1"], [30, "2"]]}],
+            [
+                {"metric": {"pod": "a"}, "values": [[30, "9"], [60, "3"]]},
+                {"metric": {"pod": "b"}, "values": [[0, "4"]]},
+            ],
+        ]
+    )
+    assert merged == [
+        {"metric": {"pod": "a"}, "values": [[0, "1"], [30, "2"], [60, "3"]]},
+        {"metric": {"pod": "b"}, "values": [[0, "4"]]},
+    ]
+
+
+def answer(value, seconds=0.0):
+    def call():
+        time.sleep(seconds)
+        return value
+
+    return call
+
+
+def fail(message):
+    def call():
+        raise ValueError(message)
+
+    return call
+
+
+def fan_out(mode, fallback_after_seconds=None):
+    config = FanOutDetails(urls=[SECONDARY], mode=mode, fallback_after_seconds=fallback_after_seconds)
+    return FanOut(PRIMARY, config)
+
+
+def test_first_success_takes_fastest():
+    started = time.perf_counter()
+    assert fan_out("first_success").run([answer("a", 1), answer("b")], sum) == "b"
+    assert time.perf_counter() - started < 0.5
+    assert fan_out("first_success").run([fail("down"), answer("b", 0.05)], sum) == "b"
+
+
+def test_prefer_primary_falls_back_when_slow():
+    assert fan_out("prefer_primary").run([answer("a", 0.05), answer("b")], sum) == "a"
+    started = time.perf_counter()
+    assert fan_out("prefer_primary", 0.05).run([answer("a", 1), answer("b")], sum) == "b"
+    assert time.perf_counter() - started < 0.5
+    # the primary still wins when it answers during the fallback
+    assert fan_out("prefer_primary", 0.05).run([answer("a", 0.1), answer("b", 1)], sum) == "a"
+
+
+class TestFanOut:
+    def test_merge_all_fills_gaps_of_ha_pair(self):
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{PRIMARY}/api/v1/query_range", json=result([[0, "1"], [30, "2"]]))
+            m.register_uri("GET", f"{SECONDARY}/api/v1/query_range", json=result([[30, "9"], [60, "3"]]))
+            values = client("merge_all").get_series_values_in_range(CONDITIONS, 0, 60)
+        assert values == [[0, "1"], [30, "2"], [60, "3"]]
+
+    def test_merge_all_over_workspaces(self):
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{PRIMARY}/api/v1/query_range", json={"data": {"result": []}})
+            m.register_uri("GET", f"{SECONDARY}/api/v1/query_range", json=result([[0, "1"]], {"tenant": "b"}))
+            assert client("merge_all").get_series_values_in_range(CONDITIONS, 0, 60) == [[0, "1"]]
+
+    def test_merge_all_fails_with_failed_endpoint(self):
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{PRIMARY}/api/v1/query_range", status_code=400, text="bad")
+            m.register_uri("GET", f"{SECONDARY}/api/v1/query_range", json=result([[0, "1"]]))
+            with pytest.raises(Exception, match="Status code 400"):
+                client("merge_all").get_series_values_in_range(CONDITIONS, 0, 60)
+        assert FanOut.stats()[PRIMARY] == {"calls": 1, "answers": {SECONDARY: 1}, "failures": {PRIMARY: 1}}
+
+    def test_merge_available_without_failed_endpoint(self):
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{PRIMARY}/api/v1/query_range", status_code=400, text="bad")
+            m.register_uri("GET", f"{SECONDARY}/api/v1/query_range", json=result([[0, "1"]]))
+            assert client("merge_available").get_series_values_in_range(CONDITIONS, 0, 60) == [[0, "1"]]
+        assert FanOut.stats()[PRIMARY] == {"calls": 1, "answers": {SECONDARY: 1}, "failures": {PRIMARY: 1}}
+
+    def test_all_failed(self):
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{PRIMARY}/api/v1/query_range", status_code=400, text="primary down")
+            m.register_uri("GET", f"{SECONDARY}/api/v1/query_range", status_code=400, text="secondary down")
+            for mode in ("merge_all", "merge_available", "first_success", "prefer_primary"):
+                with pytest.raises(Exception, match="Status code 400"):
+                    client(mode).get_series_values_in_range(CONDITIONS, 0, 60)
+
+    def test_prefer_primary(self):
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{PRIMARY}/api/v1/query_range", json=result([[0, "1"]]))
+            secondary = m.register_uri("GET", f"{SECONDARY}/api/v1/query_range", json=result([[0, "2"]]))
+            assert client("prefer_primary").get_series_values_in_range(CONDITIONS, 0, 60) == [[0, "1"]]
+            assert secondary.call_count == 0
+
+            m.register_uri("GET", f"{PRIMARY}/api/v1/query_range", status_code=400, text="down")
+            assert client("prefer_primary").get_series_values_in_range(CONDITIONS, 0, 60) == [[0, "2"]]
+
+    def test_label_values_merged(self):
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{PRIMARY}/api/v1/label/job/values", json={"data": ["a", "c"]})
+            m.register_uri("GET", f"{SECONDARY}/api/v1/label/job/values", json={"data": ["b", "c"]})
+            assert client("merge_all").list_label_values("job", None, 0, 10) == (False, ["a", "b", "c"])
@@ -0,0 +1,240 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+
+import pytest
+
+from prometheus_mirror.admission import Bulkhead
+from prometheus_mirror.hedging import Hedger, LatencyTracker, abortable
+from prometheus_mirror.model import (
+    AdmissionControlDetails,
+    Condition,
+    ConditionValue,
+    ConnectionDetails,
+    HedgingDetails,
+)
+from prometheus_mirror.prometheus import PrometheusClient
+
+
+class FakeResponse:
+    def __init__(self, name: str, status_code: int = 200):
+        self.name = name
+        self.status_code = status_code
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def _warm(hedger: Hedger, seconds: float, count: int = 20):
+    for _ in range(count):
+        hedger.latencies.record(seconds)
+
+
+class TestLatencyTracker:
+    def test_percentile(self):
+        tracker = LatencyTracker(100)
+        assert tracker.percentile(95, 1) is None
+        for i in range(1, 101):
+            tracker.record(i / 100.0)
+        assert tracker.percentile(50, 10) == 0.51
+        assert tracker.percentile(95, 10) == 0.96
+        assert tracker.percentile(100, 10) == 1.0
+
+
+class TestHedger:
+    def test_not_hedged_without_latency_history(self):
+        hedger = Hedger("ds", HedgingDetails())
+        assert hedger.call(lambda: FakeResponse("primary")).name == "primary"
+        assert hedger.snapshot()["hedged"] == 0
+        assert hedger.snapshot()["hedge_delay_seconds"] is None
+
+    def test_slow_request_is_hedged(self):
+        hedger = Hedger("ds", HedgingDetails(min_delay_seconds=0.01, max_hedge_fraction=1))
+        _warm(hedger, 0.01)
+        interrupted = Event()
+        threads = []
+
+        def send():
+            threads.append(threading.get_ident())
+            if len(threads) == 1:
+                # the first request waits until the hedge interrupts it, as a transport would
+                with abortable(interrupted.set):
+                    if interrupted.wait(5):
+                        raise ConnectionError("interrupted")
+                return FakeResponse("primary")
+            return FakeResponse("hedge")
+
+        start = time.monotonic()
+        assert hedger.call(send).name == "hedge"
+        assert time.monotonic() - start < 1
+        # the first request was sent from the caller's thread, only the hedge from the pool
+        assert threads[0] == threading.get_ident() != threads[1]
+        assert hedger.snapshot()["hedged"] == 1
+        assert hedger.snapshot()["hedge_wins"] == 1
+
+    def test_hedges_are_capped_by_fraction(self):
+        hedger = Hedger("ds", HedgingDetails(min_delay_seconds=0.01, max_hedge_fraction=0.0, max_tokens=1))
+        _warm(hedger, 0.01)
+        slow = lambda: time.sleep(0.05) or FakeResponse("slow")  # noqa: E731
+        assert hedger.call(slow).name == "slow"
+        assert hedger.call(slow).name == "slow"
+        assert hedger.snapshot()["hedged"] == 1
+
+    def test_hedge_skipped_when_rate_limited(self):
+        hedger = Hedger("ds", HedgingDetails(min_delay_seconds=0.01, max_hedge_fraction=1))
+        _warm(hedger, 0.01)
+        slow = lambda: time.sleep(0.05) or FakeResponse("slow")  # noqa: E731
+        assert hedger.call(slow, lambda: False).name == "slow"
+        assert hedger.snapshot()["hedged"] == 0
+
+    def test_failed_hedge_falls_back_on_primary(self):
+        hedger = Hedger("ds", HedgingDetails(min_delay_seconds=0.01, max_hedge_fraction=1))
+        _warm(hedger, 0.01)
+        attempts = []
+
+        def send():
+            attempts.append(1)
+            if len(attempts) == 1:
+                time.sleep(0.1)
+                return FakeResponse("primary")
+            raise ConnectionError("reset")
+
+        assert hedger.call(send).name == "primary"
+
+    def test_both_failing_raises(self):
+        hedger = Hedger("ds", HedgingDetails(min_delay_seconds=0.01, max_hedge_fraction=1))
+        _warm(hedger, 0.01)
+
+        def send():
+            time.sleep(0.03)
+            raise ConnectionError("reset")
+
+        with pytest.raises(ConnectionError):
+            hedger.call(send)
+
+    def test_server_error_loses_the_race(self):
+        hedger = Hedger("ds", HedgingDetails(min_delay_seconds=0.01, max_hedge_fraction=1))
+        _warm(hedger, 0.01)
+        attempts = []
+        responses = []
+
+        def send():
+            attempts.append(1)
+            if len(attempts) == 1:
+                time.sleep(0.03)
+                response = FakeResponse("primary", 503)
+            else:
+                time.sleep(0.1)
+                response = FakeResponse("hedge")
+            responses.append(response)
+            return response
+
+        assert hedger.call(send).name == "hedge"
+        assert responses[0].closed
+        assert hedger.snapshot()["hedge_wins"] == 1
+
+    def test_hedge_admitted_through_bulkhead(self):
+        hedger = Hedger("ds", HedgingDetails(min_delay_seconds=0.01, max_hedge_fraction=1))
+        _warm(hedger, 0.01)
+        bulkhead = Bulkhead("ds", AdmissionControlDetails(max_concurrent_requests=2))
+        active = []
+
+        def send():
+            active.append(bulkhead.snapshot()["active"])
+            time.sleep(0.05)
+            return FakeResponse("response")
+
+        with bulkhead.admit():
+            hedger.call(send, bulkhead=bulkhead)
+        # the hedge ran in a second slot, which it holds until its call completes
+        assert active == [1, 2]
+        assert hedger.snapshot()["hedged"] == 1
+        time.sleep(0.1)
+        assert bulkhead.snapshot()["active"] == 0
+
+    def test_hedge_skipped_when_bulkhead_full(self):
+        hedger = Hedger("ds", HedgingDetails(min_delay_seconds=0.01, max_hedge_fraction=1))
+        _warm(hedger, 0.01)
+        bulkhead = Bulkhead("ds", AdmissionControlDetails(max_concurrent_requests=1))
+        slow = lambda: time.sleep(0.05) or FakeResponse("slow")  # noqa: E731
+        with bulkhead.admit():
+            assert hedger.call(slow, bulkhead=bulkhead).name == "slow"
+        assert hedger.snapshot()["hedged"] == 0
+        assert bulkhead.snapshot() == {
+            "active": 0,
+            "queued": 0,
+            "admitted": 1,
+            "rejected_queue_full": 0,
+            "rejected_timeout": 0,
+        }
+
+    def test_instance_only_when_configured(self):
+        assert Hedger.get_instance(ConnectionDetails(url="http://hedge-none")) is None
+        hedger = Hedger.get_instance(ConnectionDetails(url="http://hedge-a", hedging={}))
+        assert hedger is Hedger.get_instance(ConnectionDetails(url="http://hedge-a", hedging={}))
+
+    def test_pool_per_datasource_sized_by_bulkhead(self):
+        a = Hedger.get_instance(
+            ConnectionDetails(url="http://hedge-b", hedging={}, admission={"max_concurrent_requests": 3})
+        )
+        b = Hedger.get_instance(ConnectionDetails(url="http://hedge-c", hedging={}))
+        assert a is not None and b is not None
+        assert a._executor is not b._executor
+        assert a._executor._max_workers == 3
+        resized = Hedger.get_instance(
+            ConnectionDetails(url="http://hedge-b", hedging={}, admission={"max_concurrent_requests": 4})
+        )
+        assert resized is not a and resized is not None and resized._executor._max_workers == 4
+
+
+class SlowFirstServer:
+    # query_range answering the first call after `delay` seconds and every later call right away
+    def __init__(self, delay: float):
+        self.calls = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.calls += 1
+                if server.calls == 1:
+                    time.sleep(delay)
+                payload = json.dumps({"data": {"result": [{"metric": {}, "values": [[0, str(server.calls)]]}]}})
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload.encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+def test_hedge_interrupts_first_request_over_http():
+    stub = SlowFirstServer(delay=3)
+    try:
+        config = ConnectionDetails(url=stub.url, hedging={"min_delay_seconds": 0.05, "max_hedge_fraction": 1})
+        client = PrometheusClient(config)
+        assert client.hedger is not None
+        _warm(client.hedger, 0.05)
+        conditions = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+        start = time.monotonic()
+        # the hedge's answer, without waiting for the first request
+        assert client.get_series_values_in_range(conditions, 0, 60) == [[0, "2"]]
+        assert time.monotonic() - start < 2
+        assert client.hedger.snapshot()["hedge_wins"] == 1
+        assert client.bulkhead.snapshot()["active"] == 0
+    finally:
+        stub.close()
@@ -0,0 +1,186 @@
+import json
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Thread, Timer
+
+import pytest
+import requests
+
+from prometheus_mirror.hedging import _abort
+from prometheus_mirror.http2 import Http2Adapter, Http2UnavailableException
+from prometheus_mirror.model import (
+    AwsConnectionDetails,
+    Condition,
+    ConditionValue,
+    ConnectionDetails,
+    Http2Details,
+)
+from prometheus_mirror.prometheus import PrometheusClient
+
+h2_connection = pytest.importorskip("h2.connection")
+h2_config = pytest.importorskip("h2.config")
+h2_events = pytest.importorskip("h2.events")
+h2_exceptions = pytest.importorskip("h2.exceptions")
+
+VALUES = [[1_555_408_501 + i * 30, str(i)] for i in range(20)]
+
+
+class H2Stub:
+    # cleartext HTTP/2 Prometheus stub answering every stream after `delay` seconds
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.url = f"http://127.0.0.1:{self.server.getsockname()[1]}"
+        self.connections = 0
+        self.requests = []
+        Thread(target=self._accept, daemon=True).start()
+
+    def close(self):
+        self.server.close()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            Thread(target=self._serve, args=(sock,), daemon=True).start()
+
+    def _serve(self, sock):
+        connection = h2_connection.H2Connection(h2_config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        send_lock = Lock()
+        connection.initiate_connection()
+        sock.sendall(connection.data_to_send())
+        headers = {}
+        while data := sock.recv(65535):
+            with send_lock:
+                for event in connection.receive_data(data):
+                    if isinstance(event, h2_events.RequestReceived):
+                        headers[event.stream_id] = dict(event.headers)
+                    elif isinstance(event, h2_events.DataReceived):
+                        connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2_events.StreamEnded):
+                        self.requests.append(headers[event.stream_id])
+                        args = (sock, connection, send_lock, event.stream_id, headers.pop(event.stream_id))
+                        Timer(self.delay, self._respond, args=args).start()
+                sock.sendall(connection.data_to_send())
+        sock.close()
+
+    def _respond(self, sock, connection, send_lock, stream_id, headers):
+        if headers[":path"].startswith("/api/v1/query_range"):
+            body = json.dumps({"status": "success", "data": {"result": [{"metric": {}, "values": VALUES}]}})
+        else:
+            body = json.dumps({"status": "success", "data": ["job"]})
+        with send_lock:
+            try:
+                connection.send_headers(
+                    stream_id,
+                    [(":status", "200"), ("content-type", "application/json"), ("content-length", str(len(body)))],
+                )
+                connection.send_data(stream_id, body.encode(), end_stream=True)
+                sock.sendall(connection.data_to_send())
+            except (OSError, h2_exceptions.StreamClosedError):
+                # the client gave up on the call, e.g. interrupted by a hedge
+                pass
+
+
+@pytest.fixture
+def stub():
+    server = H2Stub(delay=0.05)
+    yield server
+    server.close()
+
+
+def test_concurrent_calls_share_one_connection(stub):
+    config = ConnectionDetails(url=stub.url, http2=Http2Details(max_connections=1, prior_knowledge=True))
+    conditions = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+    results = []
+
+    def query():
+        results.append(PrometheusClient(config).get_series_values_in_range(conditions, 0, 600))
+
+    threads = [Thread(target=query) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [VALUES] * 8
+    assert stub.connections == 1
+    assert PrometheusClient(config).list_labels(10) == (False, ["job"])
+
+
+def test_signed_requests(stub):
+    aws = AwsConnectionDetails(aws_access_key_id="a", aws_secret_access_key="b", aws_session_token="c")
+    config = ConnectionDetails(url=stub.url, aws=aws, http2=Http2Details(prior_knowledge=True))
+    assert PrometheusClient(config).test_connection()[0] == 200
+    headers = stub.requests[-1]
+    assert headers[":path"] == "/api/v1/labels"
+    assert headers["authorization"].startswith("AWS4-HMAC-SHA256 Credential=a/")
+    assert headers["x-amz-security-token"] == "c"
+
+
+def test_missing_extra(monkeypatch):
+    monkeypatch.setitem(sys.modules, "h2", None)
+    with pytest.raises(Http2UnavailableException):
+        Http2Adapter(Http2Details())
+
+
+def test_close_waits_for_responses_in_flight(stub):
+    adapter = Http2Adapter(Http2Details(prior_knowledge=True))
+    session = requests.Session()
+    session.mount("http://", adapter)
+    response = session.get(f"{stub.url}/api/v1/query_range", stream=True)
+    session.close()
+    # the loop keeps running for the response being read
+    assert adapter._loop.is_running()
+    assert response.json()["data"]["result"][0]["values"] == VALUES
+    response.close()
+    for _ in range(100):
+        if not adapter._loop.is_running():
+            break
+        time.sleep(0.01)
+    assert not adapter._loop.is_running()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        session.get(f"{stub.url}/api/v1/labels")
+
+
+def test_reconfigured_session_keeps_serving_calls_in_flight(stub):
+    config = ConnectionDetails(url=stub.url, http2=Http2Details(prior_knowledge=True))
+    conditions = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+    client = PrometheusClient(config)
+    with ThreadPoolExecutor(1) as executor:
+        result = executor.submit(client.get_series_values_in_range, conditions, 0, 600)
+        time.sleep(0.01)
+        # a new transport replaces the pooled session while the call waits for its response
+        PrometheusClient(ConnectionDetails(url=stub.url, http2=Http2Details(prior_knowledge=True, max_connections=2)))
+        assert result.result(timeout=5) == VALUES
+
+
+def test_hedge_interrupts_wait_for_response():
+    slow = H2Stub(delay=3)
+    adapter = Http2Adapter(Http2Details(prior_knowledge=True))
+    session = requests.Session()
+    session.mount("http://", adapter)
+    try:
+        with ThreadPoolExecutor(1) as executor:
+            idents = []
+
+            def get():
+                idents.append(threading.get_ident())
+                return session.get(f"{slow.url}/api/v1/query_range")
+
+            result = executor.submit(get)
+            time.sleep(0.1)
+            start = time.monotonic()
+            _abort(idents[0])
+            with pytest.raises(requests.exceptions.ConnectionError, match="interrupted"):
+                result.result(timeout=5)
+            assert time.monotonic() - start < 1
+        assert adapter._active == 0
+    finally:
+        session.close()
+        slow.close()
@@ -0,0 +1,94 @@
+import pytest
+import requests_mock
+
+from prometheus_mirror import negative_cache, prometheus, shared_cache
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails
+from prometheus_mirror.negative_cache import NegativeCache
+from prometheus_mirror.prometheus import (
+    MetricNotFoundException,
+    PrometheusClient,
+    TooManyMetricsException,
+)
+from prometheus_mirror.shared_cache import LocalCache
+
+URL = "http://negative:9090"
+CONDITIONS = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(shared_cache, "_instance", LocalCache(100))
+    instance = NegativeCache()
+    monkeypatch.setattr(negative_cache, "negative_cache", instance)
+    monkeypatch.setattr(prometheus, "negative_cache", instance)
+    return instance
+
+
+class TestNegativeCache:
+    def test_not_found_remembered(self, cache):
+        client = PrometheusClient(ConnectionDetails(url=URL, negative_cache={}))
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{URL}/api/v1/query_range", json={"data": {"result": []}})
+            for _ in range(3):
+                with pytest.raises(MetricNotFoundException) as e:
+                    client.get_series_values_in_range(CONDITIONS, 0, 60)
+                assert e.value.query == "up{}"
+        assert adapter.call_count == 1
+        assert cache.snapshot() == {"hits": {"not_found": 2, "too_many_metrics": 0}, "stored": 1}
+
+    def test_too_many_metrics_remembered(self, cache):
+        client = PrometheusClient(ConnectionDetails(url=URL, negative_cache={}))
+        result = [{"metric": {"instance": "a"}, "values": []}, {"metric": {"instance": "b"}, "values": []}]
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{URL}/api/v1/query_range", json={"data": {"result": result}})
+            for _ in range(2):
+                with pytest.raises(TooManyMetricsException) as e:
+                    client.get_series_values_in_range(CONDITIONS, 0, 60)
+                assert e.value.fields == ["instance"]
+            # a different compiled query is not affected
+            with pytest.raises(TooManyMetricsException):
+                client.get_series_values_in_range(CONDITIONS, 0, 60, "max", 60)
+        assert adapter.call_count == 2
+        assert cache.snapshot()["hits"]["too_many_metrics"] == 1
+
+    def test_disabled_by_default(self, cache):
+        client = PrometheusClient(ConnectionDetails(url=URL))
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{URL}/api/v1/query_range", json={"data": {"result": []}})
+            for _ in range(2):
+                with pytest.raises(MetricNotFoundException):
+                    client.get_series_values_in_range(CONDITIONS, 0, 60)
+        assert adapter.call_count == 2
+        assert cache.snapshot()["stored"] == 0
+
+    def test_empty_window_remembered_for_that_window(self, cache):
+        client = PrometheusClient(ConnectionDetails(url=URL, negative_cache={"ttl_seconds": 60}))
+
+        def query_range(request, context):
+            # the metric only exists from an hour on
+            start, end = int(request.qs["start"][0]), int(request.qs["end"][0])
+            values = [[t, "1"] for t in range(max(start, 3600), end + 1, 30)]
+            return {"data": {"result": [{"metric": {}, "values": values}] if values else []}}
+
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{URL}/api/v1/query_range", json=query_range)
+            m.register_uri("GET", f"{URL}/api/v1/series", json={"data": [{"__name__": "up"}]})
+            for _ in range(2):
+                with pytest.raises(MetricNotFoundException):
+                    client.get_series_values_in_range(CONDITIONS, 0, 60)
+            assert len(client.get_series_values_in_range(CONDITIONS, 3600, 3660)) == 3
+        assert adapter.call_count == 2
+        assert cache.snapshot() == {"hits": {"not_found": 1, "too_many_metrics": 0}, "stored": 1}
+
+    def test_unknown_series_remembered_for_every_window(self, cache):
+        client = PrometheusClient(ConnectionDetails(url=URL, negative_cache={"ttl_seconds": 60}))
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{URL}/api/v1/query_range", json={"data": {"result": []}})
+            index = m.register_uri("GET", f"{URL}/api/v1/series", json={"data": []})
+            for start in (0, 3600, 7200):
+                with pytest.raises(MetricNotFoundException):
+                    client.get_series_values_in_range(CONDITIONS, start, start + 60)
+        assert (adapter.call_count, index.call_count) == (1, 1)
+        # the whole of the index was asked
+        assert "start" not in index.last_request.qs
+        assert cache.snapshot()["hits"]["not_found"] == 2
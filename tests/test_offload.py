@@ -0,0 +1,51 @@
+import json
+
+import pytest
+import requests_mock
+
+from prometheus_mirror.metric_request import MetricRequest
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails, Query
+from prometheus_mirror.offload import MODE_INLINE, MODE_PROCESS, MODE_THREAD, Offloader
+from prometheus_mirror.prometheus import PrometheusClient
+
+
+@pytest.fixture
+def offloader(request, monkeypatch):
+    instance = Offloader(request.param, 1000, 2)
+    monkeypatch.setattr(Offloader, "INSTANCE", instance)
+    yield instance
+    instance.shutdown()
+
+
+class TestOffloader:
+    @pytest.mark.parametrize("offloader", [MODE_THREAD], indirect=True)
+    def test_small_work_stays_inline(self, offloader):
+        assert offloader.run(10, json.loads, b"[1]") == [1]
+        assert offloader.run(1000, json.loads, b"[2]") == [2]
+        assert offloader.stats() == {"mode": MODE_THREAD, "inline": 1, "offloaded": 1}
+
+    @pytest.mark.parametrize("offloader", [MODE_INLINE], indirect=True)
+    def test_inline_mode(self, offloader):
+        assert offloader.run(10**9, json.loads, b"[1]") == [1]
+        assert offloader.stats()["offloaded"] == 0
+
+    def test_unknown_mode(self):
+        with pytest.raises(ValueError):
+            Offloader("fiber", 1, 1)
+
+    @pytest.mark.parametrize("offloader", [MODE_THREAD, MODE_PROCESS], indirect=True)
+    def test_large_response_offloaded(self, offloader):
+        url = "http://offload:9090"
+        values = [[1_555_408_501 + i * 30, str(i)] for i in range(500)]
+        client = PrometheusClient(ConnectionDetails(url=url))
+        conditions = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{url}/api/v1/query_range", json={"data": {"result": [{"values": values}]}})
+            result = client.get_series_values_in_range(conditions, 0, 60)
+        assert result == values
+        query = Query(conditions=conditions, endTime=1_655_408_501_000)
+        response = offloader.run(
+            len(result) * 32, MetricRequest._make_metric_response, query, 30000, query.end_time, result, "ZERO"
+        )
+        assert response == MetricRequest._make_metric_response(query, 30000, query.end_time, result, "ZERO")
+        assert offloader.stats()["offloaded"] == 2
@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests_mock
+
+from prometheus_mirror import prefetch, shared_cache
+from prometheus_mirror.admission import Bulkhead
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails
+from prometheus_mirror.negative_cache import negative_cache
+from prometheus_mirror.prefetch import Prefetcher, predict
+from prometheus_mirror.prometheus import PrometheusClient
+from prometheus_mirror.shared_cache import LocalCache
+
+URL = "http://prefetch:9090"
+HOUR = 3600
+NOW = 1_700_000_000
+CONDITIONS = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+
+
+@pytest.mark.parametrize(
+    "previous,current,expected",
+    [
+        # scrubbing forward and back by a page
+        ((0, HOUR, 30), (HOUR, 2 * HOUR, 30), (2 * HOUR, 3 * HOUR, 30)),
+        ((2 * HOUR, 3 * HOUR, 30), (HOUR, 2 * HOUR, 30), (0, HOUR, 30)),
+        # zooming out around the centre, with aggregation windows growing along
+        ((HOUR, 2 * HOUR, 60), (HOUR // 2, 5 * HOUR // 2, 120), (-HOUR // 2, 7 * HOUR // 2, 240)),
+        # zooming out while moving
+        ((0, HOUR, 30), (0, 2 * HOUR, 30), (0, 4 * HOUR, 30)),
+        # nothing to learn from
+        (None, (0, HOUR, 30), None),
+        # polling the same window
+        ((0, HOUR, 30), (0, HOUR, 30), None),
+        # zooming in
+        ((0, 2 * HOUR, 30), (0, HOUR, 30), None),
+        # a jump elsewhere
+        ((0, HOUR, 30), (10 * HOUR, 11 * HOUR, 30), None),
+        # the next page is in the future
+        ((NOW - 2 * HOUR, NOW - HOUR, 30), (NOW - HOUR, NOW, 30), None),
+    ],
+)
+def test_predict(previous, current, expected):
+    assert predict(previous, current, 4.0, NOW) == expected
+
+
+def values(request, context):
+    start, end, step = (int(request.qs[name][0]) for name in ("start", "end", "step"))
+    return {"status": "success", "data": {"result": [{"values": [[t, "1"] for t in range(start, end + 1, step)]}]}}
+
+
+def values_from(first):
+    # a metric that only has samples from `first` on
+    def respond(request, context):
+        start, end, step = (int(request.qs[name][0]) for name in ("start", "end", "step"))
+        samples = [[t, "1"] for t in range(start, end + 1, step) if t >= first]
+        return {"status": "success", "data": {"result": [{"values": samples}] if samples else []}}
+
+    return respond
+
+
+class TestPrefetcher:
+    @pytest.fixture(autouse=True)
+    def reset(self, monkeypatch):
+        monkeypatch.setattr(shared_cache, "_instance", LocalCache(100))
+        monkeypatch.setattr(Prefetcher, "INSTANCES", {})
+        monkeypatch.setattr(Bulkhead, "INSTANCES", {})
+        # one worker, so a no-op submitted after the prefetches waits for them
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        monkeypatch.setattr(prefetch, "executor", self.executor)
+
+    def scrub(self, config, windows, prometheus=values):
+        with requests_mock.Mocker(real_http=False) as m:
+            query_range = m.register_uri("GET", f"{URL}/api/v1/query_range", json=prometheus)
+            for start, end in windows:
+                PrometheusClient(config).get_series_values_in_range(CONDITIONS, start, end)
+                self.executor.submit(lambda: None).result()
+        return [(int(request.qs["start"][0]), int(request.qs["end"][0])) for request in query_range.request_history]
+
+    def test_next_page_prefetched(self):
+        config = ConnectionDetails(url=URL, cache={}, prefetch={})
+        calls = self.scrub(config, [(0, HOUR), (HOUR, 2 * HOUR), (2 * HOUR, 3 * HOUR), (3 * HOUR, 4 * HOUR)])
+        # the third and fourth page were fetched ahead of the requests for them
+        assert calls == [(0, HOUR), (HOUR, 2 * HOUR), (2 * HOUR, 3 * HOUR), (3 * HOUR, 4 * HOUR), (4 * HOUR, 5 * HOUR)]
+        assert Prefetcher.stats()[URL] == {
+            "prefetches": 3,
+            "hits": 2,
+            "failures": 0,
+            "skipped": {"load": 0, "in_flight": 0, "budget": 0},
+        }
+
+    def test_needs_a_store_for_results(self):
+        config = ConnectionDetails(url=URL, prefetch={})
+        calls = self.scrub(config, [(0, HOUR), (HOUR, 2 * HOUR)])
+        assert calls == [(0, HOUR), (HOUR, 2 * HOUR)]
+        assert Prefetcher.stats()[URL]["prefetches"] == 0
+
+    def test_budget(self):
+        config = ConnectionDetails(url=URL, cache={}, prefetch={"budget_per_minute": 0.01, "burst": 1})
+        self.scrub(config, [(0, HOUR), (HOUR, 2 * HOUR), (5 * HOUR, 6 * HOUR), (6 * HOUR, 7 * HOUR)])
+        stats = Prefetcher.stats()[URL]
+        assert (stats["prefetches"], stats["skipped"]["budget"]) == (1, 1)
+
+    def test_not_while_datasource_busy(self):
+        config = ConnectionDetails(url=URL, cache={}, prefetch={"max_load": 0.25})
+        bulkhead = Bulkhead.get_instance(config)
+        with bulkhead.admit(), bulkhead.admit(), bulkhead.admit():
+            calls = self.scrub(config, [(0, HOUR), (HOUR, 2 * HOUR)])
+        assert calls == [(0, HOUR), (HOUR, 2 * HOUR)]
+        assert Prefetcher.stats()[URL]["skipped"]["load"] == 1
+
+    def test_empty_prefetch_does_not_mark_query_not_found(self):
+        config = ConnectionDetails(url=URL, cache={}, negative_cache={}, prefetch={})
+        not_found = negative_cache.snapshot()["hits"]["not_found"]
+        # scrubbing back to where the metric starts prefetches the empty page before it
+        self.scrub(
+            config, [(2 * HOUR, 3 * HOUR), (HOUR, 2 * HOUR), (HOUR + 1800, 2 * HOUR + 1800)], values_from(HOUR + 30)
+        )
+        assert Prefetcher.stats()[URL]["failures"] == 1
+        assert negative_cache.snapshot()["hits"]["not_found"] == not_found
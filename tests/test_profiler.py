@@ -0,0 +1,122 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests_mock
+from fastapi.testclient import TestClient
+
+from prometheus_mirror import mirror
+from prometheus_mirror.mirror import app
+from prometheus_mirror.profiler import ProfilerBusyException, SamplingProfiler, format_collapsed
+
+URL = "http://profiled:9090"
+BODY = {
+    "connectionDetails": {"url": URL},
+    "query": {
+        "conditions": [{"key": "__gauge__", "value": {"value": "up", "_type": "StringValue"}}],
+        "startTime": 1_555_408_501_000,
+        "endTime": 1_555_468_501_000,
+    },
+}
+
+
+def spin(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_tags_nest_and_travel_with_work():
+    profiler = SamplingProfiler()
+    with profiler.tagged(route="/api/metric"):
+        with profiler.tagged(datasource=URL):
+            run = profiler.propagating(lambda: profiler._tags[threading.get_ident()])
+            assert profiler._tags[threading.get_ident()] == {"route": "/api/metric", "datasource": URL}
+        assert profiler._tags[threading.get_ident()] == {"route": "/api/metric"}
+    assert threading.get_ident() not in profiler._tags
+    with ThreadPoolExecutor(1) as executor:
+        assert executor.submit(run).result() == {"route": "/api/metric", "datasource": URL}
+
+
+def test_profile_of_tagged_threads():
+    profiler = SamplingProfiler()
+    stop = threading.Event()
+
+    def tagged_spin():
+        with profiler.tagged(route="/api/metric", datasource=URL):
+            spin(stop)
+
+    threads = [threading.Thread(target=tagged_spin), threading.Thread(target=spin, args=(stop,))]
+    for thread in threads:
+        thread.start()
+    try:
+        everything = profiler.profile(0.2, 0.005)
+        by_route = profiler.profile(0.2, 0.005, route="/api/metric")
+        by_datasource = profiler.profile(0.2, 0.005, datasource=URL)
+        other = profiler.profile(0.1, 0.005, route="/api/field/name")
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+    assert any("tagged_spin" in stack for stack in everything)
+    assert any("tagged_spin" not in stack and "spin (" in stack for stack in everything)
+    assert by_route and all("tagged_spin" in stack for stack in by_route)
+    assert by_datasource and all("tagged_spin" in stack for stack in by_datasource)
+    assert not other
+    line = format_collapsed(by_route).splitlines()[0]
+    frames, count = line.rsplit(" ", 1)
+    assert int(count) > 0
+    assert frames.split(";")[-1].startswith("spin (test_profiler.py:")
+    assert profiler.snapshot()["profiles"] == 4
+
+
+def test_one_profile_at_a_time():
+    profiler = SamplingProfiler()
+    with ThreadPoolExecutor(1) as executor:
+        running = executor.submit(profiler.profile, 0.3, 0.01)
+        time.sleep(0.05)
+        with pytest.raises(ProfilerBusyException):
+            profiler.profile(0.1, 0.01)
+        running.result()
+    assert profiler.profile(0.01, 0.01) is not None
+
+
+class TestProfileEndpoint:
+    client = TestClient(app)
+
+    def test_disabled_without_token(self, monkeypatch):
+        monkeypatch.setattr(mirror.settings, "ADMIN_TOKEN", None)
+        response = self.client.get("/admin/profile", params={"seconds": 0.01})
+        assert response.status_code == 401
+        assert response.json()["details"] == "Admin endpoints are disabled."
+
+    def test_wrong_token(self, monkeypatch):
+        monkeypatch.setattr(mirror.settings, "ADMIN_TOKEN", "secret")
+        response = self.client.get(
+            "/admin/profile", params={"seconds": 0.01}, headers={"X-MIRROR-ADMIN-TOKEN": "guess"}
+        )
+        assert response.status_code == 401
+
+    def test_profile_of_route(self, monkeypatch):
+        monkeypatch.setattr(mirror.settings, "ADMIN_TOKEN", "secret")
+
+        def slow_response(request, context):
+            time.sleep(0.5)
+            return {"data": {"result": [{"values": [[1_555_408_501, "1"]]}]}}
+
+        with requests_mock.Mocker(real_http=True) as m:
+            m.register_uri("GET", f"{URL}/api/v1/query_range", json=slow_response)
+            with ThreadPoolExecutor(1) as executor:
+                metric = executor.submit(self.client.post, "/api/metric", json=BODY)
+                time.sleep(0.1)
+                response = self.client.get(
+                    "/admin/profile",
+                    params={"seconds": 0.2, "interval_ms": 5, "route": "/api/metric"},
+                    headers={"X-MIRROR-ADMIN-TOKEN": "secret"},
+                )
+                assert metric.result().status_code == 200
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        stacks = response.text.splitlines()
+        assert stacks and all("fetch_metric (prometheus_mirror/mirror.py:" in stack for stack in stacks)
@@ -0,0 +1,376 @@
+import random
+
+import pytest
+import requests_mock
+
+from prometheus_mirror import shared_cache
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails
+from prometheus_mirror.prometheus import PrometheusClient
+from prometheus_mirror.promql import (
+    PRECEDENCE,
+    Aggregation,
+    Binary,
+    Call,
+    Number,
+    Selector,
+    String,
+    Subquery,
+    Unary,
+    canonicalize,
+    format_duration,
+    format_node,
+    parse,
+)
+from prometheus_mirror.shared_cache import LocalCache
+
+# Property-style checks over random expression trees: every spelling of a tree canonicalizes to the same text, that
+# text parses back to the very same tree, and changing anything that matters changes the canonical text.
+
+LABELS = ["job", "instance", "le", "name", "on", "by", "Inf"]
+METRICS = ["up", "http_requests_total", "job:rate5m:sum", "rate", "Up"]
+VALUES = ["", "a", "127.0.0.1:80", 'quo"te', "back\\slash", "new\nline", "ünï", ".*", "a|b"]
+FUNCTIONS = ["rate", "abs", "histogram_quantile", "label_replace", "vector", "time"]
+OPERATORS = list(PRECEDENCE)
+DURATIONS = [1000, 30_000, 60_000, 300_000, 3_600_000, 5_400_000, 86_400_000, 604_800_000, 1500]
+
+
+def random_labels(rng, minimum=0):
+    return tuple(sorted(set(rng.sample(LABELS, rng.randint(minimum, 3)))))
+
+
+def random_selector(rng):
+    matchers = {(rng.choice(LABELS), rng.choice(["=", "!=", "=~", "!~"]), rng.choice(VALUES)) for _ in range(3)}
+    matchers = tuple(sorted(rng.sample(sorted(matchers), rng.randint(0, len(matchers)))))
+    name = rng.choice(METRICS) if rng.random() < 0.8 or not matchers else None
+    if name is None and rng.random() < 0.3:
+        # a __name__ that cannot be written as a bare metric name stays a matcher
+        matchers = tuple(sorted(matchers + (("__name__", rng.choice(["=", "=~"]), rng.choice(["sum", "a.b"])),)))
+    return Selector(
+        name,
+        matchers,
+        rng.choice(DURATIONS) if rng.random() < 0.4 else None,
+        rng.choice(DURATIONS) * rng.choice([1, -1]) if rng.random() < 0.2 else None,
+        rng.choice(["start()", "end()", "1609746000", "1609746000.5"]) if rng.random() < 0.1 else None,
+    )
+
+
+def random_tree(rng, depth=0):
+    kind = rng.choice(["selector", "number", "call", "aggregation", "unary", "binary", "subquery"])
+    if depth > 3 or kind == "selector":
+        return random_selector(rng)
+    if kind == "number":
+        return Number(rng.choice([0.0, 1.0, 31.0, 0.5, 2.5e-05, 1e20, float("inf"), -3.0, float("-inf")]))
+    if kind == "call":
+        args = [random_tree(rng, depth + 1) for _ in range(rng.randint(0, 2))]
+        if rng.random() < 0.3:
+            args.append(String(rng.choice(VALUES)))
+        return Call(rng.choice(FUNCTIONS), tuple(args))
+    if kind == "aggregation":
+        operator = rng.choice(["sum", "avg", "max", "topk", "count_values", "quantile"])
+        parameter = None
+        if operator in ("topk", "quantile"):
+            parameter = Number(rng.choice([5.0, 0.95]))
+        elif operator == "count_values":
+            parameter = String(rng.choice(VALUES))
+        without = rng.random() < 0.3
+        return Aggregation(operator, parameter, random_tree(rng, depth + 1), without, random_labels(rng, 0))
+    if kind == "unary":
+        operand = random_tree(rng, depth + 1)
+        if isinstance(operand, Number):
+            operand = random_selector(rng)
+        return Unary(rng.choice(["-", "+"]), operand)
+    if kind == "subquery":
+        step = rng.choice(DURATIONS) if rng.random() < 0.5 else None
+        offset = rng.choice(DURATIONS) if rng.random() < 0.2 else None
+        return Subquery(random_tree(rng, depth + 1), rng.choice(DURATIONS), step, offset)
+    operator = rng.choice(OPERATORS)
+    matching = group = None
+    if rng.random() < 0.3:
+        matching = (rng.choice(["on", "ignoring"]), random_labels(rng, 1 if rng.random() < 0.5 else 0))
+        if rng.random() < 0.3 and operator not in ("and", "or", "unless"):
+            group = (rng.choice(["group_left", "group_right"]), random_labels(rng))
+        if matching == ("ignoring", ()) and group is None:
+            matching = None
+    return_bool = operator in ("==", "!=", "<", ">", "<=", ">=") and rng.random() < 0.5
+    return Binary(operator, random_tree(rng, depth + 1), random_tree(rng, depth + 1), return_bool, matching, group)
+
+
+class Scrambler:
+    # writes a tree as PromQL the way a person might: any spacing, comments, keyword case, quoting, matcher and label
+    # order, clause position, duration units, number notation and redundant parentheses or no-op modifiers
+    def __init__(self, rng):
+        self.rng = rng
+
+    def space(self):
+        return self.rng.choice(["", " ", "  ", "\n\t", " # note\n"])
+
+    def keyword(self, word):
+        return self.rng.choice([word, word.upper(), word.capitalize()])
+
+    def string(self, value):
+        if "`" not in value and self.rng.random() < 0.3:
+            return f"`{value}`"
+        quote = self.rng.choice(['"', "'"])
+        escaped = (
+            value.replace("\\", "\\\\")
+            .replace(quote, "\\" + quote)
+            .replace("\n", self.rng.choice(["\\n", "\\x0a", "\\012"]))
+        )
+        return quote + escaped + quote
+
+    def duration(self, millis):
+        if millis % 1000 == 0 and self.rng.random() < 0.5:
+            return f"{millis // 1000}s"
+        if millis >= 60_000 and self.rng.random() < 0.5:
+            return f"{millis // 60_000 - 1}m{60 + millis % 60_000 // 1000}s" if millis % 1000 == 0 else f"{millis}ms"
+        return format_duration(millis)
+
+    def number(self, value):
+        if value == float("inf"):
+            return self.rng.choice(["Inf", "inf", "INF"])
+        if value == float("-inf"):
+            return self.rng.choice(["-Inf", "-inf"])
+        if value == int(value) and 0 <= value < 1000 and self.rng.random() < 0.3:
+            return hex(int(value))
+        return self.rng.choice([repr(value), f"{value:e}", format_node(Number(value))])
+
+    def labels(self, labels, allow_empty_parens=True):
+        labels = list(labels) + self.rng.sample(list(labels), min(len(labels), self.rng.randint(0, 1)))
+        self.rng.shuffle(labels)
+        separator = "," + self.space()
+        trailing = "," if labels and self.rng.random() < 0.2 else ""
+        return "(" + self.space() + separator.join(labels) + trailing + self.space() + ")"
+
+    def modifiers(self, offset_millis, at):
+        text = ""
+        parts = []
+        if offset_millis is not None or self.rng.random() < 0.1:
+            offset = offset_millis or 0
+            sign = "-" if offset < 0 else ""
+            parts.append(" " + self.keyword("offset") + " " + sign + self.duration(abs(offset)))
+        if at is not None:
+            parts.append(" @ " + ("+" + at if at[0].isdigit() and self.rng.random() < 0.2 else at))
+        self.rng.shuffle(parts)
+        return text + "".join(parts)
+
+    def operand(self, node, parenthesize):
+        text = self.write(node)
+        if parenthesize or self.rng.random() < 0.15:
+            return "(" + self.space() + text + self.space() + ")"
+        return text
+
+    def write(self, node):
+        rng = self.rng
+        if isinstance(node, Number):
+            return self.number(node.value)
+        if isinstance(node, String):
+            return self.string(node.value)
+        if isinstance(node, Selector):
+            matchers = list(node.matchers)
+            if node.name is not None and (rng.random() < 0.3 or not matchers and rng.random() < 0.5):
+                matchers.append(("__name__", "=", node.name))
+                name = ""
+            else:
+                name = node.name or ""
+            matchers += rng.sample(matchers, min(len(matchers), rng.randint(0, 1)))
+            rng.shuffle(matchers)
+            text = name
+            if matchers or not name or rng.random() < 0.2:
+                written = [
+                    label + self.space() + op + self.space() + self.string(value) for label, op, value in matchers
+                ]
+                text += "{" + ("," + self.space()).join(written) + ("," if written and rng.random() < 0.2 else "") + "}"
+            if node.range_millis is not None:
+                text += "[" + self.duration(node.range_millis) + "]"
+            return text + self.modifiers(node.offset_millis, node.at)
+        if isinstance(node, Call):
+            return node.function + "(" + ("," + self.space()).join(self.write(arg) for arg in node.args) + ")"
+        if isinstance(node, Aggregation):
+            grouping = ""
+            if node.without or node.labels or rng.random() < 0.2:
+                grouping = self.keyword("without" if node.without else "by") + self.space() + self.labels(node.labels)
+            args = [node.expression] if node.parameter is None else [node.parameter, node.expression]
+            call = "(" + ("," + self.space()).join(self.write(arg) for arg in args) + ")"
+            operator = self.keyword(node.operator)
+            if rng.random() < 0.5:
+                return operator + " " + grouping + self.space() + call
+            return operator + call + " " + grouping
+        if isinstance(node, Unary):
+            operand = node.expression
+            parenthesize = isinstance(operand, (Binary, Unary)) and (
+                not isinstance(operand, Binary) or operand.operator != "^"
+            )
+            return node.operator + self.space() + self.operand(operand, parenthesize)
+        if isinstance(node, Binary):
+            precedence = PRECEDENCE[node.operator]
+            left = self.precedence(node.left)
+            right = self.precedence(node.right)
+            power = node.operator == "^"
+            text = self.operand(node.left, left < precedence or (power and left == precedence))
+            text += " " + (self.keyword(node.operator) if node.operator.isalpha() else node.operator)
+            if node.return_bool:
+                text += " " + self.keyword("bool")
+            matching = node.matching
+            if matching is None and node.group is None and rng.random() < 0.2:
+                matching = ("ignoring", ())
+            if matching:
+                text += " " + self.keyword(matching[0]) + self.space() + self.labels(matching[1])
+            right_text = self.operand(node.right, right < precedence or (not power and right == precedence))
+            if node.group:
+                text += " " + self.keyword(node.group[0])
+                # a parenthesized right operand would be read as the label list
+                if node.group[1] or right_text.startswith("(") or rng.random() < 0.5:
+                    text += self.labels(node.group[1])
+            return text + " " + self.space() + right_text
+        step = self.duration(node.step_millis) if node.step_millis is not None else ""
+        text = self.operand(node.expression, self.precedence(node.expression) < 7)
+        return (
+            text
+            + "["
+            + self.duration(node.range_millis)
+            + ":"
+            + step
+            + "]"
+            + self.modifiers(node.offset_millis, node.at)
+        )
+
+    @staticmethod
+    def precedence(node):
+        if isinstance(node, Binary):
+            return PRECEDENCE[node.operator]
+        if isinstance(node, Unary) or isinstance(node, Number) and node.value < 0:
+            return 5
+        return 7
+
+
+def mutations(node):
+    # trees that differ from `node` in one place that changes the result
+    if isinstance(node, Selector):
+        if node.name:
+            yield node._replace(name=node.name + "_x")
+        for i, (label, op, value) in enumerate(node.matchers):
+            other = "!=" if op == "=" else "="
+            yield node._replace(
+                matchers=tuple(sorted(node.matchers[:i] + ((label, other, value),) + node.matchers[i + 1 :]))
+            )
+            yield node._replace(
+                matchers=tuple(sorted(node.matchers[:i] + ((label, op, value + "x"),) + node.matchers[i + 1 :]))
+            )
+        yield node._replace(range_millis=(node.range_millis or 0) + 1000)
+        yield node._replace(offset_millis=(node.offset_millis or 0) + 1000 or None)
+    elif isinstance(node, Number):
+        yield Number(node.value + 1 if abs(node.value) < 1e15 else 0.0)
+    elif isinstance(node, Call):
+        yield node._replace(function=node.function + "_x")
+        for i, arg in enumerate(node.args):
+            for mutated in mutations(arg):
+                yield node._replace(args=node.args[:i] + (mutated,) + node.args[i + 1 :])
+    elif isinstance(node, Aggregation):
+        yield node._replace(without=not node.without)
+        yield node._replace(labels=tuple(sorted(set(node.labels) ^ {"zone"})))
+        yield node._replace(
+            operator="min" if node.operator != "min" and node.parameter is None else node.operator + "x"
+        )
+        for mutated in mutations(node.expression):
+            yield node._replace(expression=mutated)
+    elif isinstance(node, Unary):
+        for mutated in mutations(node.expression):
+            yield node._replace(expression=mutated)
+    elif isinstance(node, Binary):
+        yield node._replace(left=node.right, right=node.left) if node.left != node.right else node
+        yield node._replace(operator="atan2" if node.operator != "atan2" else "+")
+        if node.matching:
+            yield node._replace(matching=(node.matching[0], tuple(sorted(set(node.matching[1]) ^ {"zone"}))))
+        for mutated in mutations(node.left):
+            yield node._replace(left=mutated)
+    elif isinstance(node, Subquery):
+        yield node._replace(range_millis=node.range_millis + 1000)
+        yield node._replace(step_millis=None if node.step_millis else 60_000)
+        for mutated in mutations(node.expression):
+            yield node._replace(expression=mutated)
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_spellings_of_one_tree_share_their_canonical_form(seed):
+    rng = random.Random(seed)
+    tree = random_tree(rng)
+    canonical = format_node(tree)
+    assert parse(canonical) == tree
+    assert canonicalize(canonical) == canonical
+    scrambler = Scrambler(rng)
+    for _ in range(5):
+        spelling = scrambler.write(tree)
+        assert parse(spelling) == tree, spelling
+        assert canonicalize(spelling) == canonical, spelling
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_different_trees_get_different_canonical_forms(seed):
+    rng = random.Random(seed)
+    tree = random_tree(rng)
+    canonical = format_node(tree)
+    for mutated in mutations(tree):
+        if mutated != tree:
+            assert canonicalize(Scrambler(rng).write(mutated)) != canonical, mutated
+
+
+@pytest.mark.parametrize(
+    "left,right",
+    [
+        ("sum(rate(x[1m])) by (job)", "SUM BY(job) (rate(x [60s]))"),
+        ("2 ^ 3 ^ 4", "2 ^ (3 ^ 4)"),
+        ("-1 ^ 2", "-(1 ^ 2)"),
+        ("-a * b", "(-a) * b"),
+        ("a - b - c", "(a - b) - c"),
+        ("a or b and c", "a or (b and c)"),
+        ("x offset 5m @ 100", "x @ 100.0 offset 300s"),
+        ('{__name__="up", job="a"}', "up{job='a',}"),
+        ("a + ignoring() b", "a + b"),
+        ("sum by () (x)", "sum(x)"),
+        ("x offset 0s", "x"),
+    ],
+)
+def test_equivalent(left, right):
+    assert canonicalize(left) == canonicalize(right)
+
+
+@pytest.mark.parametrize(
+    "left,right",
+    [
+        ("a + b", "b + a"),
+        ("a - (b - c)", "a - b - c"),
+        ("(2 ^ 3) ^ 4", "2 ^ 3 ^ 4"),
+        ("(-1) ^ 2", "-1 ^ 2"),
+        ("sum without () (x)", "sum(x)"),
+        ("a + on() b", "a + b"),
+        ("a > 1", "a > bool 1"),
+        ("rate(x[5m])", "Rate(x[5m])"),
+        ("Up", "up"),
+        ('{__name__="sum"}', "sum"),
+        ("x[5m:]", "x[5m:1m]"),
+    ],
+)
+def test_not_equivalent(left, right):
+    assert canonicalize(left) != canonicalize(right)
+
+
+@pytest.mark.parametrize("expression", ["sum(", "rate(x[5m]", "x offset", "a +", "{job=1}", "x[5x]", '"\\q"'])
+def test_invalid_expressions_are_their_own_key(expression):
+    assert canonicalize(expression) == expression
+
+
+def test_spellings_share_cached_results(monkeypatch):
+    monkeypatch.setattr(shared_cache, "_instance", LocalCache(100))
+    url = "http://promql:9090"
+    client = PrometheusClient(ConnectionDetails(url=url, cache={"query_ttl_seconds": 60}))
+    spellings = ["sum(rate(x[1m])) by (job, le)", "sum by (le,job)(rate(x[60s]))"]
+    with requests_mock.Mocker(real_http=False) as m:
+        adapter = m.register_uri(
+            "GET", f"{url}/api/v1/query_range", json={"data": {"result": [{"values": [[0, "1"]]}]}}
+        )
+        for spelling in spellings:
+            conditions = [Condition(key="~", value=ConditionValue(value=spelling, _type="StringValue"))]
+            assert client.get_series_values_in_range(conditions, 0, 60).decode() == [[0, 1.0]]
+    assert adapter.call_count == 1
+    # the expression is sent as written
+    assert adapter.last_request.qs["query"] == [spellings[0]]
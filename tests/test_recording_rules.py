@@ -0,0 +1,147 @@
+import json
+
+import pytest
+import requests_mock
+
+from prometheus_mirror import shared_cache
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails, RecordingRulesDetails
+from prometheus_mirror.prometheus import PrometheusClient
+from prometheus_mirror.recording_rules import RecordingRules
+from prometheus_mirror.shared_cache import LocalCache
+
+URL = "http://rules:9090"
+RULES = {
+    "groups": [
+        {
+            "name": "example",
+            "rules": [
+                {"record": "job:x:rate1m", "expr": "sum by (job) (rate(x[1m]))"},
+                {"record": "x:increase1m", "expr": "increase(x[60s])"},
+                {"record": "env:y:sum", "expr": 'sum by (env) (y{region="eu"})'},
+                {"record": "labelled", "expr": "sum(z)", "labels": {"team": "a"}},
+                {"record": "twice", "expr": "max(z)"},
+                {"record": "twice", "expr": "min(z)"},
+                {"alert": "Down", "expr": "up == 0"},
+            ],
+        }
+    ]
+}
+
+
+def rewrite(expression, data=RULES):
+    rules = RecordingRules(URL, RecordingRulesDetails())
+    rules.refresh(lambda: data)
+    return rules.rewrite(expression)
+
+
+@pytest.mark.parametrize(
+    "expression,expected",
+    [
+        ("sum(rate(x[1m])) by (job)", "job:x:rate1m"),
+        ("SUM BY (job) (rate(x[60s])) * 100", "job:x:rate1m * 100"),
+        ('sum(rate(x{job="a"}[1m])) by (job)', 'job:x:rate1m{job="a"}'),
+        (
+            'avg_over_time(increase(x{job="a"}[60s])[60s:60s])',
+            'avg_over_time(x:increase1m{job="a"}[1m:1m])',
+        ),
+        ('sum by (env) (y{env="prod", region="eu"})', 'env:y:sum{env="prod"}'),
+        ("histogram_quantile(0.9, sum(rate(x[1m])) by (job))", "histogram_quantile(0.9, job:x:rate1m)"),
+    ],
+)
+def test_rewrites(expression, expected):
+    assert rewrite(expression) == expected
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        # a matcher on a label the rule aggregates away filters the input, not the result
+        'sum(rate(x{instance="a"}[1m])) by (job)',
+        # the rule's own matchers are required
+        "sum by (env) (y)",
+        "sum by (job) (rate(x[5m]))",
+        # the recorded series would keep their name through these
+        'label_replace(sum(rate(x[1m])) by (job), "n", "$1", "__name__", "(.*)")',
+        "count by (__name__) (sum(rate(x[1m])) by (job) > 1 or vector(0))",
+        # rules with extra labels or sharing their record name are not used
+        "sum(z)",
+        "max(z)",
+        # not PromQL to the parser
+        "sum(rate(x[1m]) by (job)",
+    ],
+)
+def test_left_alone(expression):
+    assert rewrite(expression) == expression
+
+
+def test_rules_api_format():
+    data = {
+        "groups": [
+            {
+                "rules": [
+                    {"name": "job:x:rate1m", "query": "sum by (job) (rate(x[1m]))", "type": "recording"},
+                    {"name": "Down", "query": "up == 0", "type": "alerting"},
+                ]
+            }
+        ]
+    }
+    assert rewrite("sum(rate(x[1m])) by (job)", data) == "job:x:rate1m"
+    assert rewrite("up == 0", data) == "up == 0"
+
+
+class TestRecordingRulesClient:
+    @pytest.fixture(autouse=True)
+    def reset(self, monkeypatch):
+        monkeypatch.setattr(shared_cache, "_instance", LocalCache(100))
+        monkeypatch.setattr(RecordingRules, "INSTANCES", {})
+
+    def query(self, config, expression):
+        conditions = [Condition(key="~", value=ConditionValue(value=expression, _type="StringValue"))]
+        return PrometheusClient(config).get_series_values_in_range(conditions, 0, 60)
+
+    def test_rules_from_api(self):
+        config = ConnectionDetails(url=URL, recording_rules={})
+        with requests_mock.Mocker(real_http=False) as m:
+            rules_api = m.register_uri("GET", f"{URL}/api/v1/rules", json={"status": "success", "data": RULES})
+            query_range = m.register_uri(
+                "GET", f"{URL}/api/v1/query_range", json={"data": {"result": [{"values": []}]}}
+            )
+            self.query(config, 'sum(rate(x{job="a"}[1m])) by (job)')
+            self.query(config, 'sum(rate(x{job="b"}[1m])) by (job)')
+            self.query(config, "rate(x[1m])")
+        assert rules_api.call_count == 1
+        assert rules_api.last_request.qs["type"] == ["record"]
+        assert [request.qs["query"][0] for request in query_range.request_history] == [
+            'job:x:rate1m{job="a"}',
+            'job:x:rate1m{job="b"}',
+            "rate(x[1m])",
+        ]
+        assert RecordingRules.stats()[URL] == {
+            "rules": 3,
+            "queries": 3,
+            "rewrites": {"job:x:rate1m": 2},
+            "load_failures": 0,
+        }
+
+    def test_rules_from_file(self, tmp_path):
+        path = tmp_path / "rules.json"
+        path.write_text(json.dumps(RULES))
+        config = ConnectionDetails(url=URL, recording_rules={"path": str(path)})
+        conditions = [Condition(key="__counter__", value=ConditionValue(value="x", _type="StringValue"))]
+        with requests_mock.Mocker(real_http=False) as m:
+            query_range = m.register_uri(
+                "GET", f"{URL}/api/v1/query_range", json={"data": {"result": [{"values": []}]}}
+            )
+            PrometheusClient(config).get_series_values_in_range(conditions, 0, 60, "max", 60)
+        assert query_range.last_request.qs["query"] == ["max_over_time(x:increase1m[1m:1m])"]
+
+    def test_unavailable_rules_leave_queries_alone(self):
+        config = ConnectionDetails(url=URL, recording_rules={})
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{URL}/api/v1/rules", status_code=404, text="not found")
+            query_range = m.register_uri(
+                "GET", f"{URL}/api/v1/query_range", json={"data": {"result": [{"values": []}]}}
+            )
+            self.query(config, "sum(rate(x[1m])) by (job)")
+        assert query_range.last_request.qs["query"] == ["sum(rate(x[1m])) by (job)"]
+        assert RecordingRules.stats()[URL]["load_failures"] == 1
@@ -0,0 +1,348 @@
+import json
+import math
+import re
+import struct
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import pytest
+
+from prometheus_mirror import prometheus
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails
+from prometheus_mirror.prometheus import PrometheusClient, TooManyMetricsException
+from prometheus_mirror.remote_read import (
+    MATCH_EQUAL,
+    MATCH_REGEXP,
+    RESPONSE_STREAMED_XOR_CHUNKS,
+    STREAMED_CONTENT_TYPE,
+    RemoteReadException,
+    crc32c,
+    decode_chunked_response,
+    decode_varint,
+    decode_xor_chunk,
+    encode_field,
+    encode_varint,
+    iter_fields,
+    snappy_compress,
+    snappy_decompress,
+)
+
+pytest.importorskip("cramjam")
+pytest.importorskip("google_crc32c")
+
+DOUBLE = struct.Struct(">d")
+UINT64 = struct.Struct(">Q")
+STALE_NAN = DOUBLE.unpack(UINT64.pack(0x7FF0000000000002))[0]
+
+
+class BitWriter:
+    def __init__(self):
+        self.buffer = bytearray()
+        self._acc = 0
+        self._bits = 0
+
+    def write(self, value, bits):
+        self._acc = (self._acc << bits) | (value & ((1 << bits) - 1))
+        self._bits += bits
+        while self._bits >= 8:
+            self._bits -= 8
+            self.buffer.append((self._acc >> self._bits) & 0xFF)
+        self._acc &= (1 << self._bits) - 1
+
+    def getvalue(self):
+        if self._bits:
+            return bytes(self.buffer) + bytes([(self._acc << (8 - self._bits)) & 0xFF])
+        return bytes(self.buffer)
+
+
+def encode_xor_chunk(samples):
+    # mirror of prometheus/tsdb/chunkenc xorAppender
+    writer = BitWriter()
+    previous_timestamp = previous_delta = previous_bits = 0
+    leading, trailing = 0xFF, 0
+    for index, (timestamp, value) in enumerate(samples):
+        bits = UINT64.unpack(DOUBLE.pack(value))[0]
+        if index == 0:
+            for byte in encode_varint((timestamp << 1) ^ (timestamp >> 63)):
+                writer.write(byte, 8)
+            writer.write(bits, 64)
+        else:
+            delta = timestamp - previous_timestamp
+            if index == 1:
+                for byte in encode_varint(delta):
+                    writer.write(byte, 8)
+            else:
+                dod = delta - previous_delta
+                for prefix, prefix_bits, size in ((0b10, 2, 14), (0b110, 3, 17), (0b1110, 4, 20)):
+                    if dod != 0 and -((1 << (size - 1)) - 1) <= dod <= 1 << (size - 1):
+                        writer.write(prefix, prefix_bits)
+                        writer.write(dod, size)
+                        break
+                else:
+                    if dod == 0:
+                        writer.write(0, 1)
+                    else:
+                        writer.write(0b1111, 4)
+                        writer.write(dod, 64)
+            previous_delta = delta
+            xor = bits ^ previous_bits
+            if xor == 0:
+                writer.write(0, 1)
+            else:
+                writer.write(1, 1)
+                new_leading = min(64 - xor.bit_length(), 31)
+                new_trailing = (xor & -xor).bit_length() - 1
+                if leading != 0xFF and new_leading >= leading and new_trailing >= trailing:
+                    writer.write(0, 1)
+                    writer.write(xor >> trailing, 64 - leading - trailing)
+                else:
+                    leading, trailing = new_leading, new_trailing
+                    significant = 64 - leading - trailing
+                    writer.write(1, 1)
+                    writer.write(leading, 5)
+                    writer.write(significant, 6)
+                    writer.write(xor >> trailing, significant)
+        previous_timestamp = timestamp
+        previous_bits = bits
+    return struct.pack(">H", len(samples)) + writer.getvalue()
+
+
+def encode_labels(labels):
+    return b"".join(encode_field(1, encode_field(1, k) + encode_field(2, v)) for k, v in sorted(labels.items()))
+
+
+def encode_frame(message):
+    return encode_varint(len(message)) + struct.pack(">I", crc32c(message)) + message
+
+
+class RemoteReadStub:
+    # Minimal Prometheus speaking remote read (samples and streamed XOR chunks) plus query_range
+    def __init__(self, series):
+        self.series = series
+        self.requests = []
+        self.query_range_calls = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                stub.requests.append(dict(self.headers))
+                payload, content_type = stub.read(snappy_decompress(body))
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                stub.query_range_calls += 1
+                payload = json.dumps({"data": {"result": [{"metric": {}, "values": [[0, "1"]]}]}}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def read(self, request):
+        query, accepted = b"", []
+        for number, _, value in iter_fields(request):
+            if number == 1:
+                query = value
+            elif number == 2:
+                accepted.append(value)
+        start = end = 0
+        matchers = []
+        for number, _, value in iter_fields(query):
+            if number == 1:
+                start = value
+            elif number == 2:
+                end = value
+            elif number == 3:
+                matcher = {n: v for n, _, v in iter_fields(value)}
+                matchers.append((matcher.get(1, 0), matcher[2].decode(), matcher[3].decode()))
+        selected = []
+        for labels, samples in self.series:
+            if all(self._matches(labels.get(name, ""), kind, value) for kind, name, value in matchers):
+                selected.append((labels, samples))
+        if RESPONSE_STREAMED_XOR_CHUNKS in accepted:
+            frames = b""
+            for labels, samples in selected:
+                for offset in range(0, len(samples), 120):
+                    part = samples[offset : offset + 120]
+                    # like Prometheus, whole chunks overlapping the range are sent untrimmed
+                    if part[-1][0] < start or part[0][0] > end:
+                        continue
+                    chunk = (
+                        encode_field(1, part[0][0])
+                        + encode_field(2, part[-1][0])
+                        + encode_field(3, 1)
+                        + encode_field(4, encode_xor_chunk(part))
+                    )
+                    # one chunk per frame, a series spans several frames
+                    frames += encode_frame(encode_field(1, encode_labels(labels) + encode_field(2, chunk)))
+            return frames, STREAMED_CONTENT_TYPE
+        result = b""
+        for labels, samples in selected:
+            timeseries = encode_labels(labels)
+            for timestamp, value in samples:
+                if not start <= timestamp <= end:
+                    continue
+                timeseries += encode_field(2, encode_field(1, value, double=True) + encode_field(2, timestamp))
+            result += encode_field(1, timeseries)
+        return snappy_compress(encode_field(1, result)), "application/x-protobuf"
+
+    @staticmethod
+    def _matches(actual, kind, value):
+        if kind == MATCH_EQUAL:
+            return actual == value
+        if kind == MATCH_REGEXP:
+            return re.fullmatch(value, actual) is not None
+        raise AssertionError(kind)
+
+
+def samples(count, start=0, interval=15_000):
+    return [(start + i * interval + (i % 3), float(i % 7) * 0.5 + i) for i in range(count)]
+
+
+@pytest.fixture
+def stub():
+    server = RemoteReadStub(
+        [
+            ({"__name__": "up", "job": "api", "instance": "a"}, samples(300)),
+            ({"__name__": "up", "job": "api", "instance": "b"}, samples(300)),
+            ({"__name__": "up", "job": "db", "instance": "(x)"}, samples(10)),
+            ({"__name__": "up", "job": "batch"}, samples(3) + [(45_000, STALE_NAN), (60_000, float("nan"))]),
+        ]
+    )
+    yield server
+    server.close()
+
+
+def gauge(name, **labels):
+    conditions = [Condition(key="__gauge__", value=ConditionValue(value=name, _type="StringValue"))]
+    for key, value in labels.items():
+        if isinstance(value, list):
+            conditions.append(Condition(key=key, value=ConditionValue(value=value, _type="InSetValue")))
+        else:
+            conditions.append(Condition(key=key, value=ConditionValue(value=value, _type="StringValue")))
+    return conditions
+
+
+class TestCodecs:
+    def test_varint(self):
+        for value in (0, 1, 127, 128, 300, 2**63 - 1):
+            assert decode_varint(encode_varint(value), 0) == (value, len(encode_varint(value)))
+        assert decode_varint(encode_varint(-1), 0)[0] == 2**64 - 1
+
+    def test_snappy_known_vectors(self):
+        # literal "abcd" followed by a 2-byte offset copy and a 1-byte offset copy
+        assert snappy_decompress(b"\x0c\x0cabcd\x1e\x04\x00") == b"abcdabcdabcd"
+        assert snappy_decompress(b"\x0c\x0cabcd\x11\x04") == b"abcdabcdabcd"
+        with pytest.raises(RemoteReadException):
+            snappy_decompress(b"\x0c\x0cabcd\x11\x09")
+
+    def test_snappy_round_trip(self):
+        for data in (b"", b"a", b"abc" * 1000, bytes(range(256)) * 10, b"x" * 70 + b"y" * 3):
+            compressed = snappy_compress(data)
+            assert snappy_decompress(compressed) == data
+        assert len(snappy_compress(b"abc" * 1000)) < 200
+
+    def test_crc32c(self):
+        assert crc32c(b"123456789") == 0xE3069283
+
+    def test_xor_chunk(self):
+        values = [(1_600_000_000_000, 1.0), (1_600_000_015_000, 1.0), (1_600_000_030_001, 2.5)]
+        values += [(1_600_000_030_001 + i * 15_000 + i * i * 100, float(i) / 3) for i in range(1, 50)]
+        values += [(1_700_000_000_000, float("inf")), (1_700_000_000_001, -0.0)]
+        assert list(decode_xor_chunk(encode_xor_chunk(values))) == values
+
+    def test_xor_chunk_drops_stale_markers(self):
+        values = [(1000, 1.0), (2000, STALE_NAN), (3000, float("nan")), (4000, 4.0)]
+        decoded = decode_xor_chunk(encode_xor_chunk(values))
+        assert [timestamp for timestamp, _ in decoded] == [1000, 3000, 4000]
+        assert math.isnan(decoded[1][1])
+
+    def test_frames_split_across_reads(self):
+        chunk = encode_field(3, 1) + encode_field(4, encode_xor_chunk([(1000, 1.0), (2000, 2.0)]))
+        stream = encode_frame(encode_field(1, encode_labels({"a": "b"}) + encode_field(2, chunk)))
+        series = decode_chunked_response((stream[i : i + 3] for i in range(0, len(stream), 3)), 0, 2000)
+        assert series == [{"metric": {"a": "b"}, "values": [[1, 1.0], [2, 2.0]]}]
+        # samples of the chunk outside the requested range are dropped
+        assert decode_chunked_response([stream], 1500, 3000)[0]["values"] == [[2, 2.0]]
+        with pytest.raises(RemoteReadException):
+            decode_chunked_response([stream[:-1] + b"\x00"], 0, 2000)
+
+
+class TestRemoteReadClient:
+    def test_streamed_raw_samples(self, stub):
+        client = PrometheusClient(ConnectionDetails(url=stub.url, remote_read={}))
+        values = client.get_series_values_in_range(gauge("up", instance="a"), 0, 3000)
+        expected = [[t // 1000 if t % 1000 == 0 else t / 1000.0, v] for t, v in samples(300) if t <= 3_000_000]
+        assert values == expected
+        assert stub.requests[0]["Content-Encoding"] == "snappy"
+        assert stub.requests[0]["X-Prometheus-Remote-Read-Version"] == "0.1.0"
+        assert stub.query_range_calls == 0
+
+    def test_streamed_chunks_are_trimmed_to_range(self, stub):
+        client = PrometheusClient(ConnectionDetails(url=stub.url, remote_read={}))
+        values = client.get_series_values_in_range(gauge("up", instance="a"), 1000, 2000)
+        assert values[0][0] >= 1000 and values[-1][0] <= 2000
+        assert len(values) == len([t for t, _ in samples(300) if 1_000_000 <= t <= 2_000_000])
+
+    def test_sampled_response(self, stub):
+        client = PrometheusClient(ConnectionDetails(url=stub.url, remote_read={"streamed": False}))
+        values = client.get_series_values_in_range(gauge("up", job="db"), 0, 3000, limit=2)
+        assert values == [[0, 0.0], [15.001, 1.5]]
+
+    def test_regexp_matchers_are_unescaped(self, stub):
+        client = PrometheusClient(ConnectionDetails(url=stub.url, remote_read={}))
+        values = client.get_series_values_in_range(gauge("up", instance=["(x)", "c"]), 0, 3000)
+        assert len(values) == 10
+
+    def test_ambiguous_selector(self, stub):
+        client = PrometheusClient(ConnectionDetails(url=stub.url, remote_read={}))
+        with pytest.raises(TooManyMetricsException) as e:
+            client.get_series_values_in_range(gauge("up", job="api"), 0, 3000)
+        assert e.value.fields == ["instance"]
+
+    def test_falls_back_to_query_range(self, stub):
+        client = PrometheusClient(ConnectionDetails(url=stub.url, remote_read={}))
+        client.get_series_values_in_range(gauge("up", instance="a"), 0, 3000, aggregation_method="mean", window=60)
+        counter = [Condition(key="__counter__", value=ConditionValue(value="requests", _type="StringValue"))]
+        client.get_series_values_in_range(counter, 0, 3000)
+        assert stub.query_range_calls == 2
+        assert stub.requests == []
+
+    @pytest.mark.parametrize("streamed", [True, False])
+    def test_stale_markers_are_not_samples(self, stub, streamed):
+        client = PrometheusClient(ConnectionDetails(url=stub.url, remote_read={"streamed": streamed}))
+        values = client.get_series_values_in_range(gauge("up", job="batch"), 0, 3000)
+        # like query_range, which leaves stale markers out but returns NaN values
+        assert [timestamp for timestamp, _ in values] == [0, 15.001, 30.002, 60]
+        assert math.isnan(values[-1][1])
+
+    def test_falls_back_to_query_range_without_codecs(self, stub, monkeypatch):
+        monkeypatch.setattr(prometheus, "codecs_available", lambda: False)
+        client = PrometheusClient(ConnectionDetails(url=stub.url, remote_read={}))
+        assert client.get_series_values_in_range(gauge("up", instance="a"), 0, 3000) == [[0, "1"]]
+        assert stub.query_range_calls == 1
+        assert stub.requests == []
+
+    def test_not_used_without_remote_read_details(self, stub):
+        client = PrometheusClient(ConnectionDetails(url=stub.url))
+        client.get_series_values_in_range(gauge("up", instance="a"), 0, 3000)
+        assert stub.query_range_calls == 1
+        assert stub.requests == []
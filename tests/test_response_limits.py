@@ -0,0 +1,130 @@
+import io
+import json
+import random
+
+import pytest
+import requests_mock
+from fastapi.testclient import TestClient
+
+from prometheus_mirror.admission import Bulkhead
+from prometheus_mirror.mirror import app
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails
+from prometheus_mirror.prometheus import PrometheusClient
+from prometheus_mirror.response_limits import ResponseLimits, ResponseTooLargeException, Scanner
+
+URL = "http://limits:9090"
+CONDITIONS = [Condition(key="~", value=ConditionValue(value="up", _type="StringValue"))]
+
+
+def response(series, samples):
+    # label values that look like parts of a response must not be counted
+    tricky = ['"metric":', '[1,"', "]]},{", "\\"]
+    return {
+        "status": "success",
+        "data": {
+            "resultType": "matrix",
+            "result": [
+                {
+                    "metric": {"pod": str(i), "note": tricky[i % len(tricky)]},
+                    "values": [[1_555_408_501.5 + 30 * j, str(-j * 0.25)] for j in range(samples)],
+                }
+                for i in range(series)
+            ],
+        },
+    }
+
+
+class Body(io.BytesIO):
+    # counts how much of the body the client read
+    read_bytes = 0
+
+    def read(self, *args):
+        chunk = super().read(*args)
+        self.read_bytes += len(chunk)
+        return chunk
+
+
+def encode(data):
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_scanner_counts_across_chunks(seed):
+    rng = random.Random(seed)
+    series, samples = rng.randint(0, 12), rng.randint(0, 30)
+    content = encode(response(series, samples))
+    scanner = Scanner()
+    position = 0
+    while position < len(content):
+        size = rng.randint(1, 80)
+        scanner.feed(content[position : position + size])
+        position += size
+    assert (scanner.series, scanner.samples) == (series, series * samples)
+
+
+def test_scanner_counts_instant_vectors():
+    scanner = Scanner()
+    scanner.feed(encode({"data": {"result": [{"metric": {}, "value": [1_555_408_501, "1e-3"]}]}}))
+    assert (scanner.series, scanner.samples) == (1, 1)
+
+
+class TestResponseLimits:
+    @pytest.fixture(autouse=True)
+    def reset(self, monkeypatch):
+        monkeypatch.setattr(ResponseLimits, "INSTANCES", {})
+
+    def query(self, limits, content):
+        client = PrometheusClient(ConnectionDetails(url=URL, response_limits=limits))
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{URL}/api/v1/query_range", body=content)
+            return client.get_series_values_in_range(CONDITIONS, 0, 60)
+
+    def test_within_limits(self):
+        content = encode(response(1, 100))
+        limits = {"max_bytes": len(content), "max_series": 1, "max_samples": 100}
+        assert len(self.query(limits, io.BytesIO(content))) == 100
+        assert ResponseLimits.stats()[URL] == {"responses": 1, "aborted": {"bytes": 0, "series": 0, "samples": 0}}
+
+    @pytest.mark.parametrize(
+        "limits,kind",
+        [({"max_bytes": 200_000}, "bytes"), ({"max_series": 2}, "series"), ({"max_samples": 1000}, "samples")],
+    )
+    def test_aborted_while_reading(self, limits, kind):
+        content = Body(encode(response(200, 500)))
+        with pytest.raises(ResponseTooLargeException, match=f"exceeds the limit of [0-9]+ {kind}"):
+            self.query(limits, content)
+        # the rest of the body is never read
+        assert content.read_bytes < len(encode(response(200, 500))) / 4
+        assert ResponseLimits.stats()[URL]["aborted"][kind] == 1
+
+    def test_body_read_within_bulkhead_slot(self, monkeypatch):
+        monkeypatch.setattr(Bulkhead, "INSTANCES", {})
+        bulkhead = Bulkhead.get_instance(ConnectionDetails(url=URL))
+        active = []
+
+        class ObservedBody(Body):
+            def read(self, *args):
+                active.append(bulkhead.snapshot()["active"])
+                return super().read(*args)
+
+        self.query({"max_bytes": 10_000_000}, ObservedBody(encode(response(1, 100))))
+        assert active and all(count == 1 for count in active)
+        assert bulkhead.snapshot()["active"] == 0
+
+    def test_error_response(self):
+        body = {
+            "connectionDetails": {"url": URL, "response_limits": {"max_series": 1}},
+            "query": {
+                "conditions": [{"key": "~", "value": {"value": "up", "_type": "StringValue"}}],
+                "startTime": 1_555_408_501_000,
+                "endTime": 1_555_468_501_000,
+            },
+        }
+        with requests_mock.Mocker(real_http=True) as m:
+            m.register_uri("GET", f"{URL}/api/v1/query_range", content=encode(response(5, 10)))
+            result = TestClient(app).post("/api/metric", json=body)
+            stats = TestClient(app).get("/stats").json()
+        assert result.status_code == 500
+        assert result.json()["summary"] == "Prometheus response too large."
+        assert "limit of 1 series" in result.json()["details"]
+        assert stats["response_limits"][URL]["aborted"]["series"] == 1
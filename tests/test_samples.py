@@ -0,0 +1,56 @@
+import math
+import random
+
+from prometheus_mirror.metric_request import MetricRequest
+from prometheus_mirror.samples import SampleBlock
+
+
+class TestSampleBlock:
+    def test_round_trip(self):
+        rng = random.Random(42)
+        timestamp = 1555408501
+        values = []
+        for i in range(2000):
+            timestamp += rng.choice([30, 30, 30, 31, 29, 60, 3600, 1])
+            value = rng.choice([1.0, float(i), rng.random() * 1e9, -0.0, -1e-300, 1e300, float("inf"), float("nan")])
+            values.append([timestamp, str(value)])
+        decoded = SampleBlock.encode(values).decode()
+        assert len(decoded) == len(values)
+        for (timestamp, value), (decoded_timestamp, decoded_value) in zip(values, decoded):
+            assert decoded_timestamp == timestamp
+            if math.isnan(float(value)):
+                assert math.isnan(decoded_value)
+            else:
+                assert decoded_value == float(value)
+
+    def test_fractional_timestamps(self):
+        values = [[1555408501.5, "1"], [1555408531.25, "2"], [1555408561, "3"]]
+        assert SampleBlock.encode(values).decode() == [[1555408501.5, 1.0], [1555408531.25, 2.0], [1555408561, 3.0]]
+
+    def test_empty(self):
+        block = SampleBlock.encode([])
+        assert len(block) == 0
+        assert block.decode() == []
+
+    def test_compact(self):
+        values = [[1555408501 + 30 * i, str(float(i % 10))] for i in range(10000)]
+        assert SampleBlock.encode(values).nbytes < 3 * len(values)
+
+    def test_json_round_trip(self):
+        block = SampleBlock.encode([[1, "1"], [2, "2"]])
+        assert SampleBlock.from_json(block.to_json()).decode() == [[1, 1.0], [2, 2.0]]
+
+    def test_head(self):
+        block = SampleBlock.encode([[1, "1"], [2, "2"], [3, "3"]])
+        assert block.head(2).decode() == [[1, 1.0], [2, 2.0]]
+        assert block.head(5).decode() == block.decode()
+        assert SampleBlock.from_json(block.head(1).to_json()).decode() == [[1, 1.0]]
+
+    def test_points_match_metric_response(self):
+        values = [[1555408501, "1.0"], [1555408531, "NaN"], [1555408561, "3.5"], [1555408591, "+Inf"]]
+        block = SampleBlock.encode(values)
+        for end in [1555408561000, 1555408591000]:
+            for nan_interpretation in ["ZERO", "NONE"]:
+                expected = MetricRequest._make_raw_metric_response(end, nan_interpretation, values)
+                actual = MetricRequest._make_raw_metric_response(end, nan_interpretation, block)
+                assert actual == expected
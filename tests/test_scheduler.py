@@ -0,0 +1,179 @@
+import time
+from threading import Event
+
+import pytest
+import requests_mock
+
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails, StandingQueryDetails
+from prometheus_mirror.prometheus import MetricNotFoundException, PrometheusClient
+from prometheus_mirror.scheduler import StandingQueryScheduler
+
+STEP = 30
+
+
+class FakeUpstream:
+    def __init__(self):
+        self.calls = []
+        self.series = 1
+
+    def __call__(self, start: int, end: int):
+        self.calls.append((start, end))
+        values = [[t, str(t % 7)] for t in range(start - start % STEP, end + 1, STEP) if t >= start]
+        return [{"metric": {"job": str(i)}, "values": values} for i in range(self.series)]
+
+
+def _key(query="up"):
+    return ("http://standing", query, STEP)
+
+
+class TestStandingQueryScheduler:
+    def test_recurring_query_is_kept_warm(self):
+        scheduler = StandingQueryScheduler(background=False)
+        config = StandingQueryDetails(min_hits=2, window_seconds=3600)
+        upstream = FakeUpstream()
+        now = int(time.time()) // STEP * STEP
+        scheduler.observe(_key(), config, upstream)
+        assert scheduler.stats()["streams"] == 0
+        scheduler.observe(_key(), config, upstream)
+        assert scheduler.stats()["streams"] == 1
+
+        scheduler._streams[_key()].refresh(now)
+        assert upstream.calls == [(now - 3600, now)]
+        values = scheduler.lookup(_key(), now - 600, now)
+        assert [value[0] for value in values] == list(range(now - 600, now + 1, STEP))
+        assert values[0][1] == float((now - 600) % 7)
+        assert len(upstream.calls) == 1
+        assert scheduler.stats()["served"] == 1
+
+    def test_incremental_tail_refresh(self):
+        scheduler = StandingQueryScheduler(background=False)
+        config = StandingQueryDetails(min_hits=1, window_seconds=3600)
+        upstream = FakeUpstream()
+        now = int(time.time()) // STEP * STEP - 300
+        scheduler.observe(_key(), config, upstream)
+        scheduler._streams[_key()].refresh(now)
+
+        later = now + 95
+        values = scheduler.lookup(_key(), later - 600, later)
+        assert upstream.calls[-1] == (now + STEP, later)
+        assert values[-1][0] == now + 90
+        assert values[0][0] == now - 480
+
+        # nothing new since the last refresh, answered from memory
+        scheduler.lookup(_key(), later - 600, later + 4)
+        assert len(upstream.calls) == 2
+
+    def test_ranges_outside_window_go_upstream(self):
+        scheduler = StandingQueryScheduler(background=False)
+        config = StandingQueryDetails(min_hits=1, window_seconds=600)
+        upstream = FakeUpstream()
+        now = int(time.time())
+        scheduler.observe(_key(), config, upstream)
+        scheduler._streams[_key()].refresh(now)
+        assert scheduler.lookup(_key(), now - 3600, now) is None
+
+    def test_idle_streams_are_dropped(self):
+        scheduler = StandingQueryScheduler(background=False)
+        config = StandingQueryDetails(min_hits=1, idle_seconds=60)
+        scheduler.observe(_key(), config, FakeUpstream())
+        scheduler.tick(time.time() + 61)
+        assert scheduler.stats()["streams"] == 0
+
+    def test_refresh_bounded_per_datasource(self):
+        scheduler = StandingQueryScheduler(background=False)
+        config = StandingQueryDetails(min_hits=1, max_concurrent_refreshes=1)
+        release = Event()
+        upstream = FakeUpstream()
+
+        def slow_upstream(start, end):
+            release.wait(5)
+            return upstream(start, end)
+
+        for query in ["a", "b", "c"]:
+            scheduler.observe(_key(query), config, slow_upstream)
+        scheduler.tick()
+        release.set()
+        scheduler._executor.shutdown(wait=True)
+        assert len(upstream.calls) == 1
+
+    def test_ambiguous_stream_is_dropped(self):
+        scheduler = StandingQueryScheduler(background=False)
+        config = StandingQueryDetails(min_hits=1)
+        upstream = FakeUpstream()
+        upstream.series = 2
+        scheduler.observe(_key(), config, upstream)
+        with pytest.raises(ValueError):
+            scheduler._streams[_key()].refresh(int(time.time()))
+
+    def test_stream_matching_nothing_is_dropped(self):
+        scheduler = StandingQueryScheduler(background=False)
+        config = StandingQueryDetails(min_hits=1)
+        upstream = FakeUpstream()
+        upstream.series = 0
+        scheduler.observe(_key(), config, upstream)
+        scheduler.tick()
+        scheduler._executor.shutdown(wait=True)
+        assert scheduler.stats()["streams"] == 0
+        assert scheduler.stats()["refresh_failures"] == 1
+
+    def test_future_end_is_refreshed_up_to_now(self):
+        scheduler = StandingQueryScheduler(background=False)
+        config = StandingQueryDetails(min_hits=1, window_seconds=3600)
+        upstream = FakeUpstream()
+        now = int(time.time()) // STEP * STEP - 300
+        scheduler.observe(_key(), config, upstream)
+        scheduler._streams[_key()].refresh(now)
+        values = scheduler.lookup(_key(), now - 600, now + 3600)
+        assert upstream.calls[-1][1] <= time.time()
+        assert scheduler._streams[_key()].covered_until <= time.time()
+        assert values[-1][0] == upstream.calls[-1][1] // STEP * STEP
+
+    def test_overlapping_refresh_is_deduplicated(self):
+        scheduler = StandingQueryScheduler(background=False)
+        config = StandingQueryDetails(min_hits=1, window_seconds=3600)
+        upstream = FakeUpstream()
+        now = int(time.time()) // STEP * STEP - 300
+        # an upstream answering with samples before the requested start
+        scheduler.observe(_key(), config, lambda start, end: upstream(start - 2 * STEP, end))
+        scheduler._streams[_key()].refresh(now - STEP)
+        scheduler._streams[_key()].refresh(now)
+        timestamps = [value[0] for value in scheduler.lookup(_key(), now - 600, now)]
+        assert timestamps == list(range(now - 600, now + 1, STEP))
+
+
+class TestStandingQueryClient:
+    def test_polls_answered_from_memory(self, monkeypatch):
+        scheduler = StandingQueryScheduler(background=False)
+        monkeypatch.setattr(StandingQueryScheduler, "INSTANCE", scheduler)
+        url = "http://standing-client:9090"
+        config = ConnectionDetails(url=url, standing_queries={"min_hits": 1})
+        conditions = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+        now = int(time.time()) // STEP * STEP
+
+        def respond(request, context):
+            start, end = int(request.qs["start"][0]), int(request.qs["end"][0])
+            return {"data": {"result": [{"metric": {}, "values": [[t, "1"] for t in range(start, end + 1, STEP)]}]}}
+
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{url}/api/v1/query_range", json=respond)
+            client = PrometheusClient(config)
+            client.get_series_values_in_range(conditions, now - 600, now)
+            # streams are keyed by the canonical form of the query
+            scheduler._streams[(url, "up", STEP)].refresh(now)
+            assert adapter.call_count == 2
+            values = client.get_series_values_in_range(conditions, now - 600, now, limit=5)
+            assert values == [[t, 1.0] for t in range(now - 600, now - 600 + 5 * STEP, STEP)]
+            assert adapter.call_count == 2
+
+    def test_failed_polls_are_not_counted(self, monkeypatch):
+        scheduler = StandingQueryScheduler(background=False)
+        monkeypatch.setattr(StandingQueryScheduler, "INSTANCE", scheduler)
+        url = "http://standing-client-missing:9090"
+        config = ConnectionDetails(url=url, standing_queries={"min_hits": 1})
+        conditions = [Condition(key="__gauge__", value=ConditionValue(value="missing", _type="StringValue"))]
+        now = int(time.time())
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{url}/api/v1/query_range", json={"data": {"result": []}})
+            with pytest.raises(MetricNotFoundException):
+                PrometheusClient(config).get_series_values_in_range(conditions, now - 600, now)
+        assert scheduler.stats()["streams"] == 0
@@ -0,0 +1,89 @@
+import pytest
+import requests_mock
+
+from prometheus_mirror import shared_cache
+from prometheus_mirror.model import Condition, ConditionValue, ConnectionDetails
+from prometheus_mirror.prometheus import PrometheusClient, TooManyMetricsException
+from prometheus_mirror.shared_cache import LocalCache
+
+URL = "http://preflight:9090"
+
+
+def conditions(kind="__gauge__"):
+    return [
+        Condition(key=kind, value=ConditionValue(value="up", _type="StringValue")),
+        Condition(key="job", value=ConditionValue(value="api", _type="StringValue")),
+    ]
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setattr(shared_cache, "_instance", LocalCache(100))
+
+
+class TestSeriesPreflight:
+    def test_ambiguous_selector_rejected_without_samples(self):
+        client = PrometheusClient(ConnectionDetails(url=URL, series_preflight={}))
+        series = [
+            {"__name__": "up", "job": "api", "instance": "a"},
+            {"__name__": "up", "job": "api", "instance": "b"},
+        ]
+        with requests_mock.Mocker(real_http=False) as m:
+            index = m.register_uri("GET", f"{URL}/api/v1/series", json={"status": "success", "data": series})
+            samples = m.register_uri("GET", f"{URL}/api/v1/query_range", json={"data": {"result": []}})
+            for kind in ("__gauge__", "__counter__"):
+                with pytest.raises(TooManyMetricsException) as e:
+                    client.get_series_values_in_range(conditions(kind), 1000, 1600)
+                assert e.value.fields == ["instance"]
+        assert samples.call_count == 0
+        assert index.request_history[0].qs["match[]"] == ['up{job="api"}']
+        assert (index.request_history[0].qs["start"], index.request_history[0].qs["end"]) == (["960"], ["1620"])
+        # confirmed at the exact bounds before rejecting
+        assert (index.request_history[1].qs["start"], index.request_history[1].qs["end"]) == (["1000"], ["1600"])
+
+    def test_series_only_within_widened_bounds_are_not_rejected(self):
+        client = PrometheusClient(ConnectionDetails(url=URL, series_preflight={}))
+        series = [
+            {"__name__": "up", "job": "api", "instance": "a"},
+            {"__name__": "up", "job": "api", "instance": "b"},
+        ]
+
+        def index_at(request, context):
+            # instance b stopped before the requested range, within the widened bounds
+            return {"data": series if request.qs["start"] == ["960"] else series[:1]}
+
+        body = {"data": {"result": [{"metric": {}, "values": [[1000, "1"]]}]}}
+        with requests_mock.Mocker(real_http=False) as m:
+            m.register_uri("GET", f"{URL}/api/v1/series", json=index_at)
+            samples = m.register_uri("GET", f"{URL}/api/v1/query_range", json=body)
+            assert client.get_series_values_in_range(conditions(), 1000, 1600) == [[1000, "1"]]
+        assert samples.call_count == 1
+
+    def test_unambiguous_selector_goes_through_with_cached_index(self):
+        client = PrometheusClient(ConnectionDetails(url=URL, series_preflight={}))
+        body = {"data": {"result": [{"metric": {}, "values": [[1000, "1"]]}]}}
+        with requests_mock.Mocker(real_http=False) as m:
+            index = m.register_uri("GET", f"{URL}/api/v1/series", json={"data": [{"__name__": "up", "job": "api"}]})
+            samples = m.register_uri("GET", f"{URL}/api/v1/query_range", json=body)
+            client.get_series_values_in_range(conditions(), 1000, 1600)
+            client.get_series_values_in_range(conditions(), 1010, 1610)
+        assert index.call_count == 1
+        assert samples.call_count == 2
+
+    def test_combining_aggregations_skip_preflight(self):
+        client = PrometheusClient(ConnectionDetails(url=URL, series_preflight={}))
+        body = {"data": {"result": [{"metric": {}, "values": [[1000, "1"]]}]}}
+        with requests_mock.Mocker(real_http=False) as m:
+            index = m.register_uri("GET", f"{URL}/api/v1/series", json={"data": []})
+            m.register_uri("GET", f"{URL}/api/v1/query_range", json=body)
+            client.get_series_values_in_range(conditions(), 1000, 1600, "mean", 60)
+        assert index.call_count == 0
+
+    def test_disabled_by_default(self):
+        client = PrometheusClient(ConnectionDetails(url=URL))
+        body = {"data": {"result": [{"metric": {}, "values": [[1000, "1"]]}]}}
+        with requests_mock.Mocker(real_http=False) as m:
+            index = m.register_uri("GET", f"{URL}/api/v1/series", json={"data": []})
+            m.register_uri("GET", f"{URL}/api/v1/query_range", json=body)
+            client.get_series_values_in_range(conditions(), 1000, 1600)
+        assert index.call_count == 0
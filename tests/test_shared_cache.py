@@ -0,0 +1,132 @@
+import time
+from threading import Thread
+
+import requests_mock
+
+from prometheus_mirror import shared_cache
+from prometheus_mirror.model import (
+    AwsConnectionDetails,
+    Condition,
+    ConditionValue,
+    ConnectionDetails,
+)
+from prometheus_mirror.prometheus import PrometheusClient
+from prometheus_mirror.shared_cache import LocalCache, SqliteCache
+
+
+class TestLocalCache:
+    def test_get_set_and_expiry(self):
+        cache = LocalCache(10)
+        assert cache.get("a") is None
+        cache.set("a", ["x"], 60)
+        cache.set("b", ["y"], -1)
+        assert cache.get("a") == ["x"]
+        assert cache.get("b") is None
+        assert cache.snapshot()["hits"] == 1
+
+    def test_cached_none_is_a_hit(self):
+        cache = LocalCache(10)
+        computed = []
+        for _ in range(3):
+            assert cache.get_or_compute("nothing", 60, lambda: computed.append(1)) is None
+        assert len(computed) == 1
+
+
+class TestSqliteCache:
+    def test_shared_between_workers(self, tmp_path):
+        path = str(tmp_path / "cache.db")
+        worker1 = SqliteCache(path, 100, 5)
+        worker2 = SqliteCache(path, 100, 5)
+        worker1.set("labels", ["job", "instance"], 60)
+        assert worker2.get("labels") == ["job", "instance"]
+        worker1.set("expired", [1], -1)
+        assert worker2.get("expired") is None
+        assert (tmp_path / "cache.db").stat().st_mode & 0o777 == 0o600
+
+    def test_value_computed_once_per_node(self, tmp_path):
+        path = str(tmp_path / "cache.db")
+        workers = [SqliteCache(path, 100, 5) for _ in range(4)]
+        computed = []
+        results = []
+
+        def compute():
+            computed.append(1)
+            time.sleep(0.2)
+            return {"token": "abc"}
+
+        threads = [
+            Thread(target=lambda w=worker: results.append(w.get_or_compute("credentials", 60, compute)))
+            for worker in workers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(computed) == 1
+        assert results == [{"token": "abc"}] * 4
+
+    def test_cached_none_is_a_hit(self, tmp_path):
+        cache = SqliteCache(str(tmp_path / "cache.db"), 100, 5)
+        computed = []
+        for _ in range(3):
+            assert cache.get_or_compute("nothing", 60, lambda: computed.append(1)) is None
+        assert len(computed) == 1
+
+    def test_evicts_beyond_max_entries(self, tmp_path):
+        cache = SqliteCache(str(tmp_path / "cache.db"), 10, 5)
+        for i in range(100):
+            cache.set(f"key{i}", i, 60 + i)
+        assert cache.snapshot()["entries"] == 10
+        assert cache.get("key99") == 99
+
+
+class TestCachedClient:
+    url = "http://cached:9090"
+
+    def test_labels_cached(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(shared_cache, "_instance", SqliteCache(str(tmp_path / "cache.db"), 100, 5))
+        client = PrometheusClient(ConnectionDetails(url=self.url, cache={}))
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{self.url}/api/v1/labels", json={"data": ["job", "instance"]})
+            assert client.list_labels(10) == (False, ["job", "instance"])
+            assert PrometheusClient(ConnectionDetails(url=self.url, cache={})).list_labels(1) == (True, ["job"])
+        assert adapter.call_count == 1
+
+    def test_query_results_cached(self, monkeypatch):
+        monkeypatch.setattr(shared_cache, "_instance", LocalCache(100))
+        client = PrometheusClient(ConnectionDetails(url=self.url, cache={}))
+        conditions = [Condition(key="__gauge__", value=ConditionValue(value="up", _type="StringValue"))]
+        body = {"data": {"result": [{"metric": {}, "values": [[1, "1"], [31, "2"]]}]}}
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{self.url}/api/v1/query_range", json=body)
+            for _ in range(3):
+                values = client.get_series_values_in_range(conditions, 0, 60)
+                assert values.decode() == [[1, 1.0], [31, 2.0]]
+        assert adapter.call_count == 1
+
+    def test_not_cached_without_cache_details(self, monkeypatch):
+        monkeypatch.setattr(shared_cache, "_instance", LocalCache(100))
+        client = PrometheusClient(ConnectionDetails(url=self.url))
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{self.url}/api/v1/labels", json={"data": ["job"]})
+            client.list_labels(10)
+            client.list_labels(10)
+        assert adapter.call_count == 2
+
+    def test_cache_entries_kept_apart_per_aws_identity(self, monkeypatch):
+        monkeypatch.setattr(shared_cache, "_instance", LocalCache(100))
+        monkeypatch.setattr(PrometheusClient, "INSTANCES", {})
+
+        def config(access_key):
+            aws = AwsConnectionDetails(
+                aws_access_key_id=access_key, aws_secret_access_key="secret", aws_session_token="t"
+            )
+            return ConnectionDetails(url=self.url, cache={}, aws=aws)
+
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{self.url}/api/v1/labels", json={"data": ["job"]})
+            for access_key in ("a", "b", "a"):
+                PrometheusClient.get_instance(config(access_key)).list_labels(10)
+        assert adapter.call_count == 2
+        assert PrometheusClient.get_instance(config("b")).credentials.access_key == "b"
+        assert not any("secret" in key for key in PrometheusClient.INSTANCES)
@@ -0,0 +1,58 @@
+import os
+import subprocess
+import sys
+
+import requests_mock
+from fastapi.testclient import TestClient
+
+from prometheus_mirror.mirror import app
+from prometheus_mirror.model import AdmissionControlDetails, AwsConnectionDetails, ConnectionDetails, Settings
+from prometheus_mirror.prometheus import PrometheusClient
+from prometheus_mirror.startup import Startup
+
+
+def test_aws_stack_not_imported_without_aws_datasource():
+    code = "import sys, prometheus_mirror.mirror; print('boto3' in sys.modules, 'botocore' in sys.modules)"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, env=env).stdout
+    assert output.split() == ["False", "False"]
+
+
+def test_prewarm_connections_from_settings(monkeypatch):
+    monkeypatch.setenv("PREWARM_CONNECTIONS", '[{"url": "http://warm:9090"}, {"url": "http://cold:9090"}]')
+    startup = Startup()
+    with requests_mock.Mocker(real_http=False) as m:
+        m.register_uri("GET", "http://warm:9090/-/healthy", text="Prometheus is Healthy.")
+        m.register_uri("GET", "http://cold:9090/-/healthy", status_code=503, text="starting")
+        startup.prewarm(Settings().PREWARM_CONNECTIONS)
+    stats = startup.stats()
+    assert stats["prewarmed"] == ["http://warm:9090"]
+    assert stats["prewarm_failed"] == ["http://cold:9090"]
+    assert stats["prewarm_seconds"] >= 0
+    assert "http://warm:9090" in PrometheusClient.SESSIONS
+
+
+def test_prewarm_aws_datasource_builds_credentials():
+    aws = AwsConnectionDetails(aws_access_key_id="a", aws_secret_access_key="b", aws_session_token="c")
+    config = ConnectionDetails(url="http://warm-aws:9090", aws=aws)
+    startup = Startup()
+    with requests_mock.Mocker(real_http=False) as m:
+        m.register_uri("GET", "http://warm-aws:9090/api/v1/labels", json={"status": "success", "data": []})
+        startup.prewarm([config])
+        assert "Authorization" in m.last_request.headers
+    assert startup.stats()["prewarmed"] == ["http://warm-aws:9090"]
+    assert startup.stats()["aws_loaded"]
+    assert PrometheusClient.get_instance(config).credentials.access_key == "a"
+
+
+def test_connection_pool_shared_per_datasource():
+    config = ConnectionDetails(url="http://pooled:9090")
+    first, second = PrometheusClient(config), PrometheusClient(config)
+    assert first.session is second.session
+    resized = ConnectionDetails(url="http://pooled:9090", admission=AdmissionControlDetails(max_concurrent_requests=50))
+    assert PrometheusClient(resized).session is not first.session
+
+
+def test_stats_report_startup():
+    stats = TestClient(app).get("/stats").json()["startup"]
+    assert stats["import_seconds"] > 0
@@ -0,0 +1,114 @@
+import sys
+
+import requests_mock
+from fastapi.testclient import TestClient
+
+from prometheus_mirror.mirror import app
+
+URL = "http://streaming:9090"
+DAY = 24 * 3600
+START = 1_555_200_000
+END = START + 3 * DAY
+
+
+def body(streaming=True, end=END, limit=100_000):
+    connection_details = {"url": URL}
+    if streaming:
+        connection_details["streaming"] = {"min_range_seconds": DAY, "chunk_seconds": DAY}
+    return {
+        "connectionDetails": connection_details,
+        "query": {
+            "conditions": [{"key": "__gauge__", "value": {"value": "up", "_type": "StringValue"}}],
+            "startTime": START * 1000,
+            "endTime": end * 1000,
+            "limit": limit,
+        },
+    }
+
+
+def prometheus(series=1, gap=None, renamed=False, infinite=False):
+    # query_range over a series sampled every 30s, without samples in `gap` and with `series` series after it, or
+    # another single series after it when `renamed`, with ±Inf samples every hour when `infinite`
+    def sample(t):
+        if infinite and t % 3600 == 0:
+            return "+Inf" if t % 7200 == 0 else "-Inf"
+        return str(t % 1000 / 4)
+
+    def query_range(request, context):
+        start, end, step = (int(request.qs[name][0]) for name in ("start", "end", "step"))
+        values = [[t, sample(t)] for t in range(start, end + 1, step) if not gap or not gap[0] <= t < gap[1]]
+        if not values:
+            return {"status": "success", "data": {"result": []}}
+        after_gap = gap and start >= gap[1]
+        count = series if after_gap else 1
+        first = 1 if after_gap and renamed else 0
+        return {
+            "status": "success",
+            "data": {"result": [{"metric": {"pod": str(i)}, "values": values} for i in range(first, first + count)]},
+        }
+
+    return query_range
+
+
+def post(request, upstream):
+    with requests_mock.Mocker(real_http=False) as m:
+        m.register_uri("GET", f"{URL}/api/v1/query_range", json=upstream)
+        response = TestClient(app).post("/api/metric", json=request)
+        return response, [(int(r.qs["start"][0]), int(r.qs["end"][0])) for r in m.request_history]
+
+
+class TestStreaming:
+    def test_same_response_as_in_memory(self):
+        streamed, queries = post(body(), prometheus())
+        in_memory, _ = post(body(streaming=False), prometheus())
+        assert streamed.headers["content-type"] == "application/json"
+        assert streamed.json() == in_memory.json()
+        assert len(streamed.json()["telemetry"]["points"]) == 3 * DAY // 30 + 1
+        assert queries == [
+            (START, START + DAY - 30),
+            (START + DAY, START + 2 * DAY - 30),
+            (START + 2 * DAY, START + 3 * DAY - 30),
+            (START + 3 * DAY, END),
+        ]
+
+    def test_infinite_values(self):
+        streamed, _ = post(body(), prometheus(infinite=True))
+        in_memory, _ = post(body(streaming=False), prometheus(infinite=True))
+        assert streamed.status_code == in_memory.status_code == 200
+        assert streamed.json() == in_memory.json()
+        values = [point[0] for point in streamed.json()["telemetry"]["points"] if point[1] % 3_600_000 == 0]
+        assert set(values) == {sys.float_info.max, -sys.float_info.max}
+        assert not streamed.json()["telemetry"]["isPartial"]
+
+    def test_limit(self):
+        streamed, queries = post(body(limit=5000), prometheus())
+        assert len(streamed.json()["telemetry"]["points"]) == 5000
+        assert len(queries) == 2
+
+    def test_short_ranges_not_streamed(self):
+        _, queries = post(body(end=START + 3600), prometheus())
+        assert queries == [(START, START + 3600)]
+
+    def test_gaps(self):
+        response, _ = post(body(), prometheus(gap=(START, START + DAY + 60)))
+        points = response.json()["telemetry"]["points"]
+        assert points[0][1] == (START + DAY + 60) * 1000
+        assert not response.json()["telemetry"]["isPartial"]
+
+    def test_errors_before_first_chunk(self):
+        response, _ = post(body(), prometheus(gap=(START, END + 1)))
+        assert response.status_code == 500
+        assert response.json()["_type"] == "MetricNotFoundError"
+
+    def test_errors_after_first_chunk_mark_response_partial(self):
+        response, _ = post(body(), prometheus(series=2, gap=(START + DAY - 30, START + DAY)))
+        assert response.status_code == 200
+        telemetry = response.json()["telemetry"]
+        assert telemetry["isPartial"]
+        assert len(telemetry["points"]) == DAY // 30 - 1
+
+    def test_chunks_of_different_series_mark_response_partial(self):
+        response, _ = post(body(), prometheus(gap=(START + DAY - 30, START + DAY), renamed=True))
+        telemetry = response.json()["telemetry"]
+        assert telemetry["isPartial"]
+        assert len(telemetry["points"]) == DAY // 30 - 1
@@ -0,0 +1,111 @@
+import pytest
+import requests_mock
+
+from prometheus_mirror import throttling
+from prometheus_mirror.admission import AdmissionRejectedException
+from prometheus_mirror.model import ConnectionDetails, RateLimitDetails, RetryDetails
+from prometheus_mirror.prometheus import PrometheusClient
+from prometheus_mirror.throttling import RetryBudget, Throttle, TokenBucket, parse_retry_after
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(throttling.time, "sleep", recorded.append)
+    return recorded
+
+
+class TestTokenBucket:
+    def test_burst_then_wait(self, sleeps):
+        bucket = TokenBucket(RateLimitDetails(requests_per_second=10, burst=2, max_wait_seconds=1))
+        assert bucket.acquire("ds") == 0
+        assert bucket.acquire("ds") == 0
+        assert bucket.acquire("ds") == pytest.approx(0.1, abs=0.01)
+        assert len(sleeps) == 1
+
+    def test_rejects_when_wait_too_long(self, sleeps):
+        bucket = TokenBucket(RateLimitDetails(requests_per_second=1, burst=1, max_wait_seconds=0.5))
+        bucket.acquire("ds")
+        with pytest.raises(AdmissionRejectedException):
+            bucket.acquire("ds")
+        assert sleeps == []
+
+
+class TestRetryBudget:
+    def test_budget_is_bounded_by_traffic(self):
+        budget = RetryBudget(RetryDetails(budget_ratio=0.5, budget_max_tokens=1))
+        assert budget.withdraw()
+        assert not budget.withdraw()
+        budget.deposit()
+        assert not budget.withdraw()
+        budget.deposit()
+        assert budget.withdraw()
+
+
+class TestRetryAfter:
+    def test_parse(self):
+        assert parse_retry_after(None) is None
+        assert parse_retry_after("2") == 2.0
+        assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+        assert parse_retry_after("soon") is None
+
+
+class TestThrottledClient:
+    url = "http://throttled:9090"
+
+    def _client(self, **connection) -> PrometheusClient:
+        Throttle.INSTANCES.pop(self.url, None)
+        return PrometheusClient(ConnectionDetails(url=self.url, **connection))
+
+    def test_retries_throttled_calls(self, sleeps):
+        client = self._client()
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri(
+                "GET",
+                f"{self.url}/api/v1/labels",
+                [
+                    {"status_code": 429, "headers": {"Retry-After": "1"}},
+                    {"status_code": 503},
+                    {"json": {"status": "success", "data": ["job"]}, "status_code": 200},
+                ],
+            )
+            assert client.list_labels(10) == (False, ["job"])
+        assert adapter.call_count == 3
+        assert sleeps[0] == 1.0
+        assert 0 <= sleeps[1] <= 0.2
+        assert client.throttle.snapshot()["retries"] == 2
+
+    def test_gives_up_after_max_retries(self, sleeps):
+        client = self._client(retry={"max_retries": 1})
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{self.url}/api/v1/labels", status_code=500)
+            with pytest.raises(Exception, match="Status code 500"):
+                client.list_labels(10)
+        assert adapter.call_count == 2
+
+    def test_client_errors_are_not_retried(self, sleeps):
+        client = self._client()
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{self.url}/api/v1/labels", status_code=400)
+            with pytest.raises(Exception, match="Status code 400"):
+                client.list_labels(10)
+        assert adapter.call_count == 1
+        assert sleeps == []
+
+    def test_long_retry_after_is_not_honoured(self, sleeps):
+        client = self._client(retry={"max_backoff_seconds": 2})
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{self.url}/api/v1/labels", status_code=429, headers={"Retry-After": "30"})
+            with pytest.raises(Exception, match="Status code 429"):
+                client.list_labels(10)
+        assert adapter.call_count == 1
+        assert sleeps == []
+
+    def test_retry_budget_exhausted(self, sleeps):
+        client = self._client(retry={"budget_max_tokens": 1, "budget_ratio": 0})
+        with requests_mock.Mocker(real_http=False) as m:
+            adapter = m.register_uri("GET", f"{self.url}/api/v1/labels", status_code=503)
+            with pytest.raises(Exception):
+                client.list_labels(10)
+        assert adapter.call_count == 2
+        assert client.throttle.snapshot()["budget_exhausted"] == 1